@@ -0,0 +1,134 @@
+"""
+The asyncio counterpart of `db_connect`, for the ASGI server mode
+(see `server/asgi.py`): the same reads, awaited instead of blocking, so
+one process can serve thousands of concurrent slow clients.
+It uses pymongo's own async client, or Motor on older pymongos. Queries
+are built by the same helpers as in `db_connect`, so both modes accept
+the same parameters and cursors.
+Index creation and the cache invalidation listener stay with the sync
+client: the ASGI app calls `db_connect.connect_db()` once at startup.
+"""
+import inspect
+import os
+
+import data.db_connect as dbc
+import data.metrics as metrics
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    try:
+        from motor.motor_asyncio import (
+            AsyncIOMotorClient as AsyncMongoClient)
+    except ImportError:
+        AsyncMongoClient = None
+
+USERS_DB = dbc.USERS_DB
+MONGO_ID = dbc.MONGO_ID
+
+client = None
+
+
+def connect_db():
+    """
+    Set the global async client if it isn't set yet. The client only
+    connects on first use, so this needn't be awaited.
+    """
+    global client
+    if client is None:
+        mongodb_uri = os.environ.get("MONGODB_URI")
+        if not mongodb_uri:
+            raise ValueError("MONGODB_URI environment variable is not set.")
+        if AsyncMongoClient is None:
+            raise RuntimeError('The async mode needs pymongo>=4.9 '
+                               'or motor.')
+        # the profiler explains with the sync client:
+        client = AsyncMongoClient(
+            mongodb_uri,
+            event_listeners=[dbc.query_profiler] if dbc.prof.ENABLED else [],
+            **dbc.client_options())
+
+
+async def close_db():
+    global client
+    if client is not None:
+        closed = client.close()
+        # pymongo's async close() is a coroutine; Motor's isn't:
+        if inspect.isawaitable(closed):
+            await closed
+        client = None
+
+
+@metrics.timed_db
+async def fetch_all_filtered(collection, filt={}, db=USERS_DB,
+                             projection=None):
+    ret = []
+    async for doc in client[db][collection].find(filt, projection):
+        doc.pop(MONGO_ID, None)
+        ret.append(doc)
+    return ret
+
+
+@metrics.timed_db(count=len)
+async def fetch_all_as_dict(key, collection, db=USERS_DB, projection=None):
+    if projection is not None and key not in projection:
+        # we can't key the docs by a field we didn't fetch
+        projection = projection + [key]
+    ret = {}
+    async for doc in client[db][collection].find({}, projection):
+        ret[doc[key]] = doc
+    return ret
+
+
+async def iter_filtered(collection, filt={}, db=USERS_DB,
+                        batch_size=dbc.DEFAULT_BATCH_SIZE, projection=None):
+    """
+    Yield the docs matching a filter one at a time, `batch_size` docs
+    per round-trip.
+    """
+    async for doc in client[db][collection].find(filt, projection,
+                                                 batch_size=batch_size):
+        yield doc
+
+
+@metrics.timed_db
+async def fetch_page(collection, filt={}, limit=dbc.DEFAULT_PAGE_SIZE,
+                     after=None, db=USERS_DB, projection=None):
+    """
+    `db_connect.fetch_page()`, awaited.
+    """
+    page_filt = dbc.page_filter(filt, after)
+    cursor = (client[db][collection].find(page_filt, projection)
+              .sort(MONGO_ID, dbc.pm.ASCENDING).limit(limit + 1))
+    return dbc.page_result(await cursor.to_list(None), limit)
+
+
+@metrics.timed_db
+async def fetch_keyset_page(collection, filt={}, sort_field=MONGO_ID,
+                            direction=dbc.pm.ASCENDING,
+                            limit=dbc.DEFAULT_PAGE_SIZE, after=None,
+                            db=USERS_DB, projection=None) -> tuple:
+    """
+    `db_connect.fetch_keyset_page()`, awaited.
+    """
+    page_filt, projection, sort = dbc.keyset_query(filt, sort_field,
+                                                   direction, after,
+                                                   projection)
+    cursor = (client[db][collection].find(page_filt, projection)
+              .sort(sort).limit(limit + 1))
+    return dbc.keyset_result(await cursor.to_list(None), limit, sort_field)
+
+
+@metrics.timed_db
+async def fetch_text_search(collection, text, filt={}, skip=0, limit=0,
+                            score_field='score', db=USERS_DB,
+                            projection=None):
+    """
+    `db_connect.fetch_text_search()`, awaited.
+    """
+    search_filt, search_projection, sort = dbc.text_search_query(
+        text, filt, score_field, projection)
+    cursor = (client[db][collection].find(search_filt, search_projection,
+                                          skip=skip, limit=limit)
+              .sort(sort))
+    return await cursor.to_list(None)
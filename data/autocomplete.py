@@ -0,0 +1,195 @@
+"""
+This module provides an in-memory prefix index for type-ahead.
+Terms are normalized (case, accents and spacing ignored) and kept in a
+sorted list per kind, so finding the terms starting with a prefix is a
+binary search plus a scan of no more terms than are returned, however
+many terms there are, of that kind or any other.
+Data modules keep their index up to date as they write, and rebuild it
+from the database when they can't tell what changed.
+"""
+import bisect
+import heapq
+import itertools
+import threading
+import unicodedata
+
+TEXT = 'text'
+KIND = 'kind'
+COUNT = 'count'
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+
+def normalize(text: str) -> str:
+    """
+    Lower-cased, accents stripped and runs of whitespace collapsed, so
+    'Café  Rouge' and 'cafe rouge' are the same term.
+    """
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    stripped = ''.join(ch for ch in decomposed
+                       if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
+
+
+class PrefixIndex:
+    """
+    A thread-safe index from terms of several kinds (e.g. names and
+    cities) to the IDs of the docs they come from. Each doc has at most
+    one term of each kind.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._keys = {}  # kind -> sorted normalized terms
+        self._entries = {}  # (normalized term, kind) -> [text, set of IDs]
+        self._by_id = {}  # doc ID -> {kind: key in _keys}
+        # until built, and whenever writes may have been missed:
+        self.dirty = True
+        self.built = False
+        # writes made while a build is running, replayed after it:
+        self._pending = None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(keys) for keys in self._keys.values())
+
+    def _add_term(self, doc_id, kind: str, text: str):
+        norm = normalize(text)
+        if not norm:
+            return
+        key = (norm, kind)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = [text, {doc_id}]
+            bisect.insort(self._keys.setdefault(kind, []), norm)
+        else:
+            entry[1].add(doc_id)
+        self._by_id.setdefault(doc_id, {})[kind] = key
+
+    def _remove_term(self, doc_id, kind: str):
+        key = self._by_id.get(doc_id, {}).pop(kind, None)
+        if key is None:
+            return
+        ids = self._entries[key][1]
+        ids.discard(doc_id)
+        if not ids:
+            del self._entries[key]
+            keys = self._keys[kind]
+            del keys[bisect.bisect_left(keys, key[0])]
+
+    def _update(self, doc_id, terms: dict):
+        for kind, text in terms.items():
+            self._remove_term(doc_id, kind)
+            if text:
+                self._add_term(doc_id, kind, text)
+        if not self._by_id.get(doc_id):
+            self._by_id.pop(doc_id, None)
+
+    def _remove(self, doc_id):
+        for kind in list(self._by_id.get(doc_id, {})):
+            self._remove_term(doc_id, kind)
+        self._by_id.pop(doc_id, None)
+
+    def update(self, doc_id, terms: dict):
+        """
+        Sets the terms of a doc, given as {kind: text}. Kinds not in
+        terms keep their term; a blank text removes the doc's term.
+        """
+        with self.lock:
+            if self._pending is not None:
+                self._pending.append((self._update, (doc_id, terms)))
+            self._update(doc_id, terms)
+
+    def remove(self, doc_id):
+        with self.lock:
+            if self._pending is not None:
+                self._pending.append((self._remove, (doc_id,)))
+            self._remove(doc_id)
+
+    def _clear(self):
+        self._keys = {}
+        self._entries = {}
+        self._by_id = {}
+
+    def clear(self):
+        with self.lock:
+            if self._pending is not None:
+                self._pending.append((self._clear, ()))
+            self._clear()
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    @property
+    def building(self) -> bool:
+        return self._pending is not None
+
+    def build(self, docs):
+        """
+        Replaces the contents of the index with docs, an iterable of
+        (doc ID, {kind: text}) pairs. Reads keep being answered from
+        the old contents until the new ones are ready, and writes made
+        meanwhile are applied on top of them. Returns False without
+        doing anything if another thread is already building.
+        """
+        with self.lock:
+            if self._pending is not None:
+                return False
+            self._pending = []
+            self.dirty = False
+        try:
+            entries = {}
+            by_id = {}
+            for doc_id, terms in docs:
+                for kind, text in terms.items():
+                    norm = normalize(text) if text else ''
+                    if not norm:
+                        continue
+                    key = (norm, kind)
+                    entries.setdefault(key, [text, set()])[1].add(doc_id)
+                    by_id.setdefault(doc_id, {})[kind] = key
+            keys = {}
+            for norm, kind in entries:
+                keys.setdefault(kind, []).append(norm)
+            # one sort beats an insort per term:
+            for terms in keys.values():
+                terms.sort()
+        except Exception:
+            with self.lock:
+                self._pending = None
+                self.dirty = True
+            raise
+        with self.lock:
+            self._keys = keys
+            self._entries = entries
+            self._by_id = by_id
+            for apply, args in self._pending:
+                apply(*args)
+            self._pending = None
+            self.built = True
+        return True
+
+    def search(self, prefix: str, limit: int = DEFAULT_LIMIT,
+               kinds: list = None) -> list:
+        """
+        Returns up to limit terms starting with prefix, in alphabetical
+        order, each with its kind and the number of docs it comes from.
+        """
+        norm = normalize(prefix)
+        ret = []
+        with self.lock:
+            # the terms of each kind come in order: merge them
+            found = heapq.merge(*(
+                self._starting_with(norm, kind, self._keys.get(kind, []))
+                for kind in (self._keys if kinds is None else kinds)))
+            for key in itertools.islice(found, limit):
+                text, ids = self._entries[key]
+                ret.append({TEXT: text, KIND: key[1], COUNT: len(ids)})
+        return ret
+
+    @staticmethod
+    def _starting_with(norm: str, kind: str, keys: list):
+        i = bisect.bisect_left(keys, norm)
+        while i < len(keys) and keys[i].startswith(norm):
+            yield keys[i], kind
+            i += 1
@@ -0,0 +1,141 @@
+"""
+This module provides a small in-process cache for read-heavy queries.
+Each cache is an LRU of bounded size whose entries expire after a TTL.
+Data modules clear their caches on every write they make.
+"""
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+HITS = 'hits'
+MISSES = 'misses'
+SIZE = 'size'
+MAX_SIZE = 'max_size'
+TTL = 'ttl'
+
+# cache name -> cache, so all caches can be listed and invalidated:
+caches = {}
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries expire `ttl` seconds after
+    they are set. A ttl of 0 turns the cache off.
+    """
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        # bumped on every clear, so a read that started before a write
+        # can't store its (now stale) result after the write:
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    def get(self, key):
+        """
+        Returns (True, value) on a hit and (False, None) on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation: int = None):
+        """
+        Stores value under key, unless the cache was cleared since
+        `generation` was read.
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                HITS: self.hits,
+                MISSES: self.misses,
+                SIZE: len(self.entries),
+                MAX_SIZE: self.max_size,
+                TTL: self.ttl,
+            }
+
+
+def _hashable(val):
+    if isinstance(val, list):
+        return tuple(val)
+    return val
+
+
+def _key(func, args, kwargs) -> tuple:
+    return (func.__name__,
+            tuple(_hashable(arg) for arg in args),
+            tuple(sorted((k, _hashable(v)) for k, v in kwargs.items())))
+
+
+def cached(cache: TTLCache):
+    """
+    Decorator caching a function's results in cache, keyed by the
+    function and its arguments. Cached values are shared between
+    callers, so they must not be modified.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _key(func, args, kwargs)
+            found, value = cache.get(key)
+            if found:
+                return value
+            generation = cache.generation
+            value = func(*args, **kwargs)
+            cache.set(key, value, generation)
+            return value
+        return wrapper
+    return decorator
+
+
+def cached_async(cache: TTLCache):
+    """
+    `cached()` for coroutine functions.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = _key(func, args, kwargs)
+            found, value = cache.get(key)
+            if found:
+                return value
+            generation = cache.generation
+            value = await func(*args, **kwargs)
+            cache.set(key, value, generation)
+            return value
+        return wrapper
+    return decorator
+
+
+def get_stats() -> dict:
+    """
+    Returns the stats of every cache, by name.
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -1,6 +1,21 @@
+import atexit
+import base64
+import binascii
+import json
+import logging
 import os
+import threading
+
+import data.indexes as idx
+import data.invalidation as inv
+import data.metrics as metrics
+import data.profiler as prof
 
 import pymongo as pm
+from pymongo import monitoring, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+from bson.errors import InvalidId
 
 LOCAL = "0"
 CLOUD = "1"
@@ -11,6 +26,21 @@ client = None
 
 MONGO_ID = '_id'
 
+DUPLICATE_KEY_CODE = 11000
+
+UPSERTED = 'upserted'
+MODIFIED = 'modified'
+MATCHED = 'matched'
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# IDs per `$in` query, to keep each query document well under the
+# server's 16MB limit:
+IN_CHUNK_SIZE = int(os.environ.get('MONGO_IN_CHUNK_SIZE', 1000))
+
 
 # def connect_db():
 #     """
@@ -40,45 +70,301 @@ MONGO_ID = '_id'
 #             client = pm.MongoClient()
 
 
+# env var -> (MongoClient option, type) for tuning the client per deploy:
+CLIENT_OPTION_VARS = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    'MONGO_COMPRESSORS': ('compressors', str),  # e.g. 'zstd,snappy,zlib'
+    'MONGO_READ_PREFERENCE': ('readPreference', str),
+}
+
+
+def client_options() -> dict:
+    """
+    Collect the MongoClient options set through environment variables.
+    """
+    opts = {}
+    for var, (option, typecast) in CLIENT_OPTION_VARS.items():
+        val = os.environ.get(var)
+        if val:
+            try:
+                opts[option] = typecast(val)
+            except ValueError:
+                raise ValueError(f'{var} must be of type {typecast.__name__}.')
+    return opts
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events, so each worker's pool can be sized
+    from data. Read the counts with `pool_stats()`.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.created = 0
+            self.closed = 0
+            self.checkouts = 0
+            self.checkout_failures = {}
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.checkout_wait = 0.0
+            self.clears = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures[event.reason] = \
+                self.checkout_failures.get(event.reason, 0) + 1
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out,
+                                       self.checked_out)
+            self.checkout_wait += getattr(event, 'duration', None) or 0.0
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'connections_created': self.created,
+                'connections_closed': self.closed,
+                'connections_open': self.created - self.closed,
+                'checkouts': self.checkouts,
+                'checkout_failures': dict(self.checkout_failures),
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'avg_checkout_wait_secs': (self.checkout_wait
+                                           / self.checkouts
+                                           if self.checkouts else 0.0),
+                'pool_clears': self.clears,
+            }
+
+
+pool_listener = PoolStats()
+query_profiler = prof.QueryProfiler(lambda: client)
+
+
+def event_listeners() -> list:
+    return [pool_listener] + ([query_profiler] if prof.ENABLED else [])
+
+
 # connect to MongoDB
-def connect_db():
+def connect_db(ensure_indexes=False):
+    """
+    Set the global client if it isn't set yet, and start the cache
+    invalidation listener if it is turned on.
+    With ensure_indexes, also make sure the indexes registered by the
+    data modules exist. Building an index can take minutes on a big
+    collection, so that is done once at startup (see
+    `indexes.create_all()`), never in a request.
+    Each process gets its own client: see `_forget_client()`.
+    """
     global client
     if client is None:
-        print("Setting client because it is None.")
+        logger.debug('Setting client because it is None.')
         mongodb_uri = os.environ.get("MONGODB_URI")
         if mongodb_uri:
-            print("Connecting to MongoDB.")
-            client = pm.MongoClient(mongodb_uri)
+            logger.info('Connecting to MongoDB.')
+            client = pm.MongoClient(mongodb_uri,
+                                    event_listeners=event_listeners(),
+                                    **client_options())
         else:
             raise ValueError("MONGODB_URI environment variable is not set.")
+    if ensure_indexes:
+        idx.ensure_indexes(client[USERS_DB])
+    inv.start(client[USERS_DB])
+
+
+def close_db():
+    """
+    Close this process's client, if it has one.
+    """
+    global client
+    if client is not None:
+        inv.stop()
+        client.close()
+        client = None
 
 
+def _forget_client():
+    """
+    MongoClient is not fork-safe: a forked gunicorn worker must not use
+    the pool it inherited. Drop (but don't close: the sockets still
+    belong to the parent) the client, so the child builds its own.
+    """
+    global client
+    client = None
+    pool_listener.reset()
+    query_profiler.reset()
+
+
+def pool_stats() -> dict:
+    """
+    Connection pool statistics for this process, plus the pool options
+    in use, to help size `maxPoolSize` per worker.
+    """
+    stats = pool_listener.snapshot()
+    stats['pid'] = os.getpid()
+    stats['options'] = client_options()
+    return stats
+
+
+def top_queries(n: int = prof.DEFAULT_TOP_N,
+                sort: str = prof.TOTAL_MS) -> list:
+    """
+    This process's n slowest query shapes, by total, max or average
+    time or by count, with the plans of those that were slow.
+    """
+    if not 1 <= n <= prof.MAX_TOP_N:
+        raise ValueError(f'n must be between 1 and {prof.MAX_TOP_N}.')
+    if sort not in prof.SORTS:
+        raise ValueError(f'Unknown sort: {sort}. '
+                         f'Choose from: {", ".join(prof.SORTS)}.')
+    return query_profiler.top(n, sort)
+
+
+os.register_at_fork(after_in_child=_forget_client)
+atexit.register(close_db)
+
+
+def to_object_id(object_id):
+    """
+    Convert a string ID into an ObjectId, raising ValueError if it isn't one.
+    """
+    try:
+        return ObjectId(object_id)
+    except (InvalidId, TypeError):
+        raise ValueError(f'{object_id} is not a valid ID.')
+
+
+def make_projection(fields, allowed) -> list:
+    """
+    Turn a list of requested field names into a projection, raising
+    ValueError for any field not in `allowed`. No fields means all
+    fields, and gives a None projection.
+    The `_id` always comes back, as Mongo includes it by default.
+    """
+    if not fields:
+        return None
+    bad = [fld for fld in fields if fld not in allowed]
+    if bad:
+        raise ValueError(f'Unknown fields: {", ".join(bad)}.')
+    return list(fields)
+
+
+@metrics.timed_db
 def insert_one(collection, doc, db=USERS_DB):
     """
     Insert a single doc into collection.
     """
-    print(f'{db=}')
     return client[db][collection].insert_one(doc)
 
 
-def fetch_one(collection, filt, db=USERS_DB):
+@metrics.timed_db
+def insert_many(collection, docs, db=USERS_DB):
+    """
+    Insert docs in a single unordered round-trip: a failed doc doesn't
+    stop the rest from going in. pymongo sets each doc's `_id`.
+    Returns the write errors keyed by the index of the failed doc.
+    """
+    if not docs:
+        return {}
+    try:
+        client[db][collection].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        return {err['index']: err for err in e.details['writeErrors']}
+    return {}
+
+
+@metrics.timed_db
+def upsert_many(collection, key_fields, docs, db=USERS_DB):
     """
-    Find with a filter and return on the first doc found.
+    Insert or overwrite docs, matching existing docs on `key_fields`,
+    in a single unordered `bulk_write()` round-trip.
+    Returns the upserted, modified and matched counts, and the write
+    errors keyed by the index of the failed doc.
     """
-    for doc in client[db][collection].find(filt):
-        if MONGO_ID in doc:
-            # Convert mongo ID to a string so it works as JSON
-            doc[MONGO_ID] = str(doc[MONGO_ID])
-        return doc
+    if not docs:
+        return {UPSERTED: 0, MODIFIED: 0, MATCHED: 0}, {}
+    ops = [UpdateOne({fld: doc[fld] for fld in key_fields},
+                     {'$set': doc}, upsert=True)
+           for doc in docs]
+    try:
+        result = client[db][collection].bulk_write(ops, ordered=False)
+        details = result.bulk_api_result
+        errors = {}
+    except BulkWriteError as e:
+        details = e.details
+        errors = {err['index']: err for err in details['writeErrors']}
+    return {UPSERTED: details['nUpserted'],
+            MODIFIED: details['nModified'],
+            MATCHED: details['nMatched']}, errors
+
 
+@metrics.timed_db
+def fetch_one(collection, filt, db=USERS_DB, projection=None):
+    """
+    Find with a filter and return the first doc found, or None.
+    `projection` is an optional list of the fields to return.
+    """
+    return client[db][collection].find_one(filt, projection)
 
+
+@metrics.timed_db
+def doc_exists(collection, filt, db=USERS_DB) -> bool:
+    """
+    Whether any doc matches a filter. Only the `_id` is fetched.
+    """
+    return client[db][collection].find_one(filt, [MONGO_ID]) is not None
+
+
+@metrics.timed_db
 def del_one(collection, filt, db=USERS_DB):
     """
-    Find with a filter and return on the first doc found.
+    Delete the first doc matching a filter.
+    Check the result's `deleted_count` to learn if there was one.
     """
-    client[db][collection].delete_one(filt)
+    return client[db][collection].delete_one(filt)
 
 
+@metrics.timed_db
 def delete_all(collection, db=USERS_DB):
     """
     Delete all documents in the specified collection.
@@ -87,6 +373,7 @@ def delete_all(collection, db=USERS_DB):
     return result.deleted_count
 
 
+@metrics.timed_db
 def fetch_all(collection, db=USERS_DB):
     ret = []
     for doc in client[db][collection].find():
@@ -94,21 +381,307 @@ def fetch_all(collection, db=USERS_DB):
     return ret
 
 
-def fetch_all_filtered(collection, filt={}, db=USERS_DB):
+@metrics.timed_db
+def fetch_all_filtered(collection, filt={}, db=USERS_DB, projection=None):
     ret = []
-    for doc in client[db][collection].find(filt):
+    for doc in client[db][collection].find(filt, projection):
         doc.pop(MONGO_ID, None)
         ret.append(doc)
     return ret
 
 
-def fetch_all_as_dict(key, collection, db=USERS_DB):
+def iter_filtered(collection, filt={}, db=USERS_DB,
+                  batch_size=DEFAULT_BATCH_SIZE, projection=None):
+    """
+    Yield the docs matching a filter one at a time.
+    The cursor pulls `batch_size` docs per round-trip, so memory use
+    stays flat no matter how big the collection is.
+    """
+    yield from client[db][collection].find(filt, projection,
+                                           batch_size=batch_size)
+
+
+def iter_all(collection, db=USERS_DB, batch_size=DEFAULT_BATCH_SIZE,
+             projection=None):
+    """
+    Yield every doc in collection, `batch_size` docs per round-trip.
+    """
+    return iter_filtered(collection, db=db, batch_size=batch_size,
+                         projection=projection)
+
+
+@metrics.timed_db
+def fetch_page(collection, filt={}, limit=DEFAULT_PAGE_SIZE, after=None,
+               db=USERS_DB, projection=None):
+    """
+    Fetch one page of docs in `_id` order, starting just past the `_id`
+    in `after`. Returns the docs and the cursor for the next page, which
+    is None on the last page.
+    This is keyset pagination: every page is an indexed range scan on
+    `_id`, so it costs O(limit) no matter how deep the client pages.
+    """
+    page_filt = page_filter(filt, after)
+    # ask for one extra doc to learn whether there is a next page
+    cursor = (client[db][collection].find(page_filt, projection)
+              .sort(MONGO_ID, pm.ASCENDING).limit(limit + 1))
+    return page_result(list(cursor), limit)
+
+
+def page_filter(filt: dict, after: str) -> dict:
+    """
+    The filter for the page of `fetch_page()` starting past `after`.
+    """
+    page_filt = dict(filt)
+    if after:
+        page_filt[MONGO_ID] = {'$gt': to_object_id(after)}
+    return page_filt
+
+
+def page_result(docs: list, limit: int) -> tuple:
+    """
+    Trims the extra doc fetched past a page, and returns the page and
+    the cursor for the next one.
+    """
+    next_after = None
+    if len(docs) > limit:
+        docs.pop()
+        next_after = str(docs[-1][MONGO_ID])
+    return docs, next_after
+
+
+def encode_cursor(values: list) -> str:
+    """
+    An opaque, URL-safe page cursor holding JSON-able values.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f'Invalid page cursor: {cursor}')
+    if not isinstance(values, list):
+        raise ValueError(f'Invalid page cursor: {cursor}')
+    return values
+
+
+def _after_filter(field, direction, value, last_id) -> dict:
+    """
+    The docs that come after (value, last_id) when sorting by field in
+    direction, then by `_id` the same way. Mongo sorts missing values
+    lowest: first going up, last going down.
+    """
+    cmp = '$gt' if direction == pm.ASCENDING else '$lt'
+    if field == MONGO_ID:
+        return {MONGO_ID: {cmp: last_id}}
+    if value is None:
+        after = [{field: None, MONGO_ID: {cmp: last_id}}]
+        if direction == pm.ASCENDING:
+            after.append({field: {'$ne': None}})
+    else:
+        after = [{field: {cmp: value}},
+                 {field: value, MONGO_ID: {cmp: last_id}}]
+        if direction == pm.DESCENDING:
+            after.append({field: None})
+    return {'$or': after}
+
+
+@metrics.timed_db
+def fetch_keyset_page(collection, filt={}, sort_field=MONGO_ID,
+                      direction=pm.ASCENDING, limit=DEFAULT_PAGE_SIZE,
+                      after=None, db=USERS_DB, projection=None) -> tuple:
+    """
+    Like `fetch_page()`, but in the order of any field, with `_id`
+    breaking ties. The cursor for the next page is opaque: it holds the
+    sort field, value and `_id` of the last doc, so every page is still
+    a range scan of an index ending in the sort field.
+    """
+    page_filt, projection, sort = keyset_query(filt, sort_field, direction,
+                                               after, projection)
+    # ask for one extra doc to learn whether there is a next page
+    docs = list(client[db][collection].find(page_filt, projection)
+                .sort(sort).limit(limit + 1))
+    return keyset_result(docs, limit, sort_field)
+
+
+def keyset_query(filt, sort_field, direction, after, projection) -> tuple:
+    """
+    The (filter, projection, sort) of the page of `fetch_keyset_page()`
+    starting past the cursor in `after`.
+    """
+    page_filt = filt
+    if after:
+        try:
+            field, value, last_id = decode_cursor(after)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid page cursor: {after}')
+        if field != sort_field:
+            raise ValueError('The page cursor is for a different sort.')
+        last_id = to_object_id(last_id)
+        if field == MONGO_ID:
+            value = last_id
+        page_filt = {'$and': [filt, _after_filter(sort_field, direction,
+                                                  value, last_id)]}
+    if projection is not None and sort_field not in projection:
+        # we can't make a cursor from a field we didn't fetch
+        projection = projection + [sort_field]
+    sort = [(sort_field, direction)]
+    if sort_field != MONGO_ID:
+        sort.append((MONGO_ID, direction))
+    return page_filt, projection, sort
+
+
+def keyset_result(docs: list, limit: int, sort_field) -> tuple:
+    """
+    Trims the extra doc fetched past a page, and returns the page and
+    the opaque cursor for the next one.
+    """
+    next_after = None
+    if len(docs) > limit:
+        docs.pop()
+        last = docs[-1]
+        value = last.get(sort_field)
+        if sort_field == MONGO_ID:
+            value = str(value)
+        next_after = encode_cursor([sort_field, value,
+                                    str(last[MONGO_ID])])
+    return docs, next_after
+
+
+@metrics.timed_db
+def fetch_sorted(collection, filt={}, sort=None, limit=0, db=USERS_DB,
+                 projection=None):
+    """
+    Fetch at most `limit` docs matching a filter, in the order given by
+    `sort`, a list of (field, direction) pairs. With an index on the
+    filter and sort fields this reads only the docs returned.
+    """
+    cursor = client[db][collection].find(filt, projection, limit=limit)
+    if sort:
+        cursor = cursor.sort(sort)
+    return list(cursor)
+
+
+@metrics.timed_db
+def fetch_text_search(collection, text, filt={}, skip=0, limit=0,
+                      score_field='score', db=USERS_DB, projection=None):
+    """
+    Full-text search through the collection's text index: fetch at most
+    `limit` docs matching `text` and filt, most relevant first, after
+    skipping `skip` of them. Each doc's relevance is in `score_field`.
+    """
+    search_filt, search_projection, sort = text_search_query(
+        text, filt, score_field, projection)
+    return list(client[db][collection].find(search_filt, search_projection,
+                                            skip=skip, limit=limit)
+                .sort(sort))
+
+
+def text_search_query(text, filt, score_field, projection) -> tuple:
+    """
+    The (filter, projection, sort) of `fetch_text_search()`.
+    """
+    search_filt = dict(filt)
+    search_filt['$text'] = {'$search': text}
+    score = {'$meta': 'textScore'}
+    search_projection = {fld: 1 for fld in projection or []}
+    search_projection[score_field] = score
+    return search_filt, search_projection, [(score_field, score)]
+
+
+@metrics.timed_db(count=metrics.count_found)
+def fetch_by_ids(collection, ids, db=USERS_DB, projection=None,
+                 chunk_size=IN_CHUNK_SIZE) -> list:
+    """
+    Fetch the docs with the given IDs with one `$in` query per chunk of
+    IDs, instead of one query per ID. Returns a list in the order of
+    ids, with None for IDs that are invalid or have no doc.
+    """
+    object_ids = []
+    for object_id in ids:
+        try:
+            object_ids.append(to_object_id(object_id))
+        except ValueError:
+            object_ids.append(None)
+    wanted = list(dict.fromkeys(oid for oid in object_ids if oid))
+    found = {}
+    for start in range(0, len(wanted), chunk_size):
+        chunk = wanted[start:start + chunk_size]
+        for doc in client[db][collection].find({MONGO_ID: {'$in': chunk}},
+                                               projection):
+            found[doc[MONGO_ID]] = doc
+    return [found.get(oid) for oid in object_ids]
+
+
+@metrics.timed_db(count=len)
+def fetch_all_as_dict(key, collection, db=USERS_DB, projection=None):
+    if projection is not None and key not in projection:
+        # we can't key the docs by a field we didn't fetch
+        projection = projection + [key]
     ret = {}
-    for doc in client[db][collection].find():
-        doc[MONGO_ID] = str(doc[MONGO_ID])
+    for doc in client[db][collection].find({}, projection):
         ret[doc[key]] = doc
     return ret
 
 
+@metrics.timed_db
+def find_and_update(collection, filters, update_dict, db=USERS_DB,
+                    projection=None):
+    """
+    Set fields on the first doc matching filters, in one round-trip.
+    Returns the doc as it was before the update, or None if there
+    was no such doc.
+    """
+    return client[db][collection].find_one_and_update(
+        filters, {'$set': update_dict}, projection=projection)
+
+
+@metrics.timed_db
+def find_and_delete(collection, filt, db=USERS_DB, projection=None):
+    """
+    Delete the first doc matching a filter, in one round-trip.
+    Returns the deleted doc, or None if there was no such doc.
+    """
+    return client[db][collection].find_one_and_delete(filt,
+                                                      projection=projection)
+
+
+@metrics.timed_db
+def update_with_pipeline(collection, filters, pipeline, db=USERS_DB):
+    """
+    Atomically update the first doc matching filters with an aggregation
+    pipeline, whose stages can compute fields from the doc's own values.
+    """
+    return client[db][collection].update_one(filters, pipeline)
+
+
+@metrics.timed_db
+def set_many(collection, updates, db=USERS_DB):
+    """
+    Apply a list of (filters, update_dict) pairs as `$set` updates,
+    in a single unordered `bulk_write()` round-trip.
+    """
+    if not updates:
+        return None
+    ops = [UpdateOne(filters, {'$set': update_dict})
+           for filters, update_dict in updates]
+    return client[db][collection].bulk_write(ops, ordered=False)
+
+
+@metrics.timed_db
+def aggregate(collection, pipeline, db=USERS_DB):
+    """
+    Run an aggregation pipeline on collection and return its results as
+    a list, so they are timed and counted whole.
+    """
+    return list(client[db][collection].aggregate(pipeline))
+
+
+@metrics.timed_db
 def update_doc(collection, filters, update_dict, db=USERS_DB):
+    """
+    Set fields on the first doc matching filters.
+    Check the result's `matched_count` to learn if there was one.
+    """
     return client[db][collection].update_one(filters, {'$set': update_dict})
@@ -0,0 +1,102 @@
+"""
+This module gives restaurants coordinates without an external geocoder:
+a restaurant is placed at the centroid of its zip code, looked up in an
+offline table.
+The bundled table (zip_centroids.csv) covers a sample of zips. For
+national coverage, point ZIP_CENTROIDS_FILE at the Census Bureau's ZCTA
+Gazetteer file, which is read as is.
+Run `python -m data.geo` to backfill the locations of existing
+restaurants.
+"""
+import csv
+import os
+import threading
+
+POINT = 'Point'
+METERS_PER_MILE = 1609.344
+MAX_RADIUS_MILES = 100
+
+DEFAULT_CENTROIDS_FILE = os.path.join(os.path.dirname(__file__),
+                                      'zip_centroids.csv')
+CENTROIDS_FILE = os.environ.get('ZIP_CENTROIDS_FILE', DEFAULT_CENTROIDS_FILE)
+# column names in our table, and in the Census Gazetteer file:
+ZIP_COLUMNS = ('zip_code', 'GEOID')
+LAT_COLUMNS = ('lat', 'INTPTLAT')
+LON_COLUMNS = ('lon', 'INTPTLONG')
+
+_centroids = None
+_lock = threading.Lock()
+
+
+def _column(row: dict, names: tuple) -> str:
+    for name in names:
+        if row.get(name):
+            return row[name].strip()
+    raise ValueError(f'No {" or ".join(names)} column.')
+
+
+def load_centroids(path: str) -> dict:
+    """
+    Reads a zip code -> (lat, lon) table from a CSV file, or from the
+    tab-separated Census Gazetteer file.
+    """
+    with open(path, newline='') as f:
+        delimiter = '\t' if '\t' in f.readline() else ','
+        f.seek(0)
+        reader = csv.reader(f, delimiter=delimiter)
+        # the Gazetteer pads its column names with spaces:
+        header = [name.strip() for name in next(reader)]
+        centroids = {}
+        for values in reader:
+            row = dict(zip(header, values))
+            centroids[_column(row, ZIP_COLUMNS).zfill(5)] = (
+                float(_column(row, LAT_COLUMNS)),
+                float(_column(row, LON_COLUMNS)))
+    return centroids
+
+
+def centroids() -> dict:
+    """
+    The zip code table, loaded on first use.
+    """
+    global _centroids
+    if _centroids is None:
+        with _lock:
+            if _centroids is None:
+                _centroids = load_centroids(CENTROIDS_FILE)
+    return _centroids
+
+
+def point(lat: float, lon: float) -> dict:
+    """
+    A GeoJSON point. Note GeoJSON puts the longitude first.
+    """
+    if not -90 <= lat <= 90:
+        raise ValueError('The latitude must be between -90 and 90.')
+    if not -180 <= lon <= 180:
+        raise ValueError('The longitude must be between -180 and 180.')
+    return {'type': POINT, 'coordinates': [lon, lat]}
+
+
+def locate_zip(zip_code) -> dict:
+    """
+    The GeoJSON point of a zip code's centroid, or None if the zip code
+    isn't in the table. ZIP+4 codes are located by their first 5 digits.
+    """
+    if not zip_code:
+        return None
+    found = centroids().get(str(zip_code).strip()[:5].zfill(5))
+    return point(*found) if found else None
+
+
+def main():
+    # imported here so the data modules can import this one:
+    import data.restaurants as rstr
+
+    located, unknown = rstr.backfill_locations()
+    print(f'Located {located} restaurants; '
+          f'{unknown} have zip codes not in {CENTROIDS_FILE}.')
+
+
+if __name__ == "__main__":
+    main()
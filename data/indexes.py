@@ -0,0 +1,164 @@
+"""
+This module keeps a registry of the indexes our data modules need.
+Each data module declares its indexes here when it is imported, and
+`create_all()` makes sure they exist: gunicorn calls it once as it
+starts, or run `python -m data.indexes create` at deploy.
+Run `python -m data.indexes` to report indexes that are missing or unused.
+"""
+import logging
+import sys
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+ASCENDING = 1
+DESCENDING = -1
+TEXT = 'text'
+GEOSPHERE = '2dsphere'
+
+KEYS = 'keys'
+UNIQUE = 'unique'
+WEIGHTS = 'weights'
+NAME = 'name'
+MISSING = 'missing'
+UNUSED = 'unused'
+MONGO_ID_INDEX = '_id_'
+
+# collection -> {index name -> index spec}
+registry = {}
+# (db name, collection, index name) of the indexes this process created:
+_ensured = set()
+
+
+def index_name(keys: list) -> str:
+    """
+    Mongo's default name for an index on `keys`.
+    """
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def register(collection: str, keys: list, unique: bool = False,
+             weights: dict = None) -> str:
+    """
+    Declare an index on collection. `keys` is a list of
+    (field, direction) pairs, as for pymongo's `create_index()`.
+    `weights` sets the relative importance of the fields of a TEXT index.
+    Returns the index name.
+    """
+    spec = {
+        KEYS: list(keys),
+        UNIQUE: unique,
+        WEIGHTS: weights,
+        NAME: index_name(keys),
+    }
+    registry.setdefault(collection, {})[spec[NAME]] = spec
+    return spec[NAME]
+
+
+def _num_registered() -> int:
+    return sum(len(specs) for specs in registry.values())
+
+
+def ensure_indexes(database):
+    """
+    Create every registered index this process has not created yet.
+    Cheap to call repeatedly: once everything is created it is a no-op.
+    """
+    if len(_ensured) >= _num_registered():
+        return
+    for collection, specs in list(registry.items()):
+        for name, spec in list(specs.items()):
+            key = (database.name, collection, name)
+            if key in _ensured:
+                continue
+            options = {WEIGHTS: spec[WEIGHTS]} if spec.get(WEIGHTS) else {}
+            try:
+                database[collection].create_index(spec[KEYS], name=name,
+                                                  unique=spec[UNIQUE],
+                                                  **options)
+            except OperationFailure as e:
+                # e.g. duplicate data blocking a unique index:
+                # report it, but don't take the app down over it.
+                logger.warning('Could not create index %s on %s: %s',
+                               name, collection, e)
+            _ensured.add(key)
+
+
+def missing_indexes(specs: list, index_info: dict) -> list:
+    """
+    Returns the names of the specs not found in `index_info`,
+    the output of a collection's `index_information()`.
+    """
+    existing = {tuple(info['key']) for info in index_info.values()}
+    return [spec[NAME] for spec in specs
+            if spec[NAME] not in index_info
+            and tuple(spec[KEYS]) not in existing]
+
+
+def unused_indexes(index_stats: list) -> list:
+    """
+    Returns the names of the indexes that have never been used,
+    given the output of a `$indexStats` aggregation.
+    """
+    return [stat[NAME] for stat in index_stats
+            if stat[NAME] != MONGO_ID_INDEX
+            and stat['accesses']['ops'] == 0]
+
+
+def report(database) -> dict:
+    """
+    For each collection with registered indexes, list the registered
+    indexes that are missing and the existing indexes never used
+    since the server last started.
+    """
+    ret = {}
+    for collection, specs in registry.items():
+        coll = database[collection]
+        ret[collection] = {
+            MISSING: missing_indexes(list(specs.values()),
+                                     coll.index_information()),
+        }
+        try:
+            stats = list(coll.aggregate([{'$indexStats': {}}]))
+            ret[collection][UNUSED] = unused_indexes(stats)
+        except OperationFailure as e:
+            ret[collection][UNUSED] = f'Unavailable: {e}'
+    return ret
+
+
+def _register_all():
+    # imported here so the data modules can import this one:
+    import data.restaurants  # noqa: F401 (registers indexes)
+    import data.reviews  # noqa: F401
+    import data.users  # noqa: F401
+
+
+def create_all():
+    """
+    Create every index the data modules register, then let go of the
+    connection: for startup and deploy scripts, not requests.
+    """
+    import data.db_connect as dbc
+    _register_all()
+    dbc.connect_db(ensure_indexes=True)
+    dbc.close_db()
+
+
+def main():
+    import data.db_connect as dbc
+    if sys.argv[1:] == ['create']:
+        create_all()
+        print('Created the registered indexes.')
+        return
+    _register_all()
+    # report what's there, don't create it:
+    dbc.connect_db()
+    for collection, found in report(dbc.client[dbc.USERS_DB]).items():
+        print(f'{collection}:')
+        print(f'    {MISSING}: {found[MISSING]}')
+        print(f'    {UNUSED}: {found[UNUSED]}')
+
+
+if __name__ == "__main__":
+    main()
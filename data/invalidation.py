@@ -0,0 +1,224 @@
+"""
+This module keeps the process-local caches of the data modules
+consistent across gunicorn workers.
+When turned on (CACHE_INVALIDATION=1), `connect_db()` starts a listener
+thread that watches the collections with subscribers through a change
+stream, and passes each change to the subscribers. Change streams need
+a replica set: against a standalone server, the thread instead polls
+per-collection version counters that every write bumps.
+Either way, each process keeps track of those counters, so `version()`
+gives a token, the same in every worker, that changes whenever the
+collection does: the endpoints make ETags of it.
+"""
+import logging
+import os
+import threading
+
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('CACHE_INVALIDATION', '0') == '1'
+POLL_SECS = float(os.environ.get('CACHE_INVALIDATION_POLL_SECS', 1))
+RETRY_SECS = 5
+# how long `stop()` waits for the thread: a change stream waits up to
+# POLL_SECS for the next change:
+JOIN_SECS = POLL_SECS + 5
+
+VERSIONS_COLLECT = 'collection_versions'
+VERSION = 'version'
+MONGO_ID = '_id'
+
+CHANGE_STREAM = 'change_stream'
+POLL = 'poll'
+# server error codes meaning change streams aren't supported here:
+CHANGE_STREAM_UNSUPPORTED = (40573, 40324)
+
+# collection -> callbacks taking the change event (None if unknown):
+subscribers = {}
+# collection -> its latest version we know of; once started, a
+# collection missing here has never been written, i.e. is at version 0:
+versions = {}
+mode = None
+_database = None
+_thread = None
+_stop = threading.Event()
+
+
+def subscribe(collection: str, callback):
+    """
+    Call `callback(change)` whenever collection changes in any process.
+    `change` is the change stream event, or None when the listener only
+    knows that something changed.
+    """
+    subscribers.setdefault(collection, []).append(callback)
+
+
+def publish(collection: str, change: dict = None):
+    """
+    Callbacks run in the listener thread: one that fails is logged, so
+    it can't stop the others, or the listener.
+    """
+    for callback in subscribers.get(collection, []):
+        try:
+            callback(change)
+        except Exception:
+            logger.exception('Subscriber %s to %s failed',
+                             getattr(callback, '__name__', callback),
+                             collection)
+
+
+def record_write(collection: str):
+    """
+    Call after writing to collection. This bumps the collection's
+    version, so the other workers notice the write when polling, and so
+    the version tokens move in every mode, including before the
+    listener knows which it is in.
+    """
+    database = _database  # stop() may clear it meanwhile
+    if database is None:
+        return
+    doc = database[VERSIONS_COLLECT].find_one_and_update(
+        {MONGO_ID: collection}, {'$inc': {VERSION: 1}}, upsert=True,
+        return_document=ReturnDocument.AFTER)
+    _set_version(collection, doc[VERSION])
+
+
+def _set_version(collection: str, version: int):
+    # versions only go up, whichever thread learns of them first:
+    if version > versions.get(collection, 0):
+        versions[collection] = version
+
+
+def version(collection: str):
+    """
+    The version of collection, or None if the listener isn't running,
+    in which case we can't tell when other workers change it.
+    """
+    if _database is None:
+        return None
+    return versions.get(collection, 0)
+
+
+def _load_versions(database):
+    for doc in database[VERSIONS_COLLECT].find():
+        _set_version(doc[MONGO_ID], doc[VERSION])
+
+
+def start(database):
+    """
+    Start this process's listener thread on database, if turned on and
+    not started yet.
+    """
+    global _database, _thread
+    if not ENABLED or _thread is not None:
+        return
+    _load_versions(database)
+    _database = database
+    _stop.clear()
+    _thread = threading.Thread(target=_run, args=(database,),
+                               name='cache-invalidation', daemon=True)
+    _thread.start()
+
+
+def stop():
+    """
+    Stop the listener thread, and wait for it to finish its poll or its
+    wait on the change stream before letting go of the database.
+    """
+    global _thread, _database
+    _stop.set()
+    thread = _thread
+    if thread is not None and thread is not threading.current_thread():
+        thread.join(JOIN_SECS)
+    _thread = None
+    _database = None
+
+
+def _forget():
+    """
+    Threads don't survive a fork: let the child start its own listener.
+    """
+    global _thread, mode, _database
+    _thread = None
+    mode = None
+    _database = None
+
+
+def _invalidate_all():
+    for collection in list(subscribers):
+        publish(collection)
+
+
+def _watch(database):
+    global mode
+    collections = list(subscribers) + [VERSIONS_COLLECT]
+    pipeline = [{'$match': {'ns.coll': {'$in': collections}}}]
+    with database.watch(pipeline, full_document='updateLookup',
+                        max_await_time_ms=int(POLL_SECS * 1000)) as stream:
+        mode = CHANGE_STREAM
+        while not _stop.is_set():
+            change = stream.try_next()
+            if change is None:
+                continue
+            if change['ns']['coll'] == VERSIONS_COLLECT:
+                doc = change.get('fullDocument') or {}
+                if VERSION in doc:
+                    _set_version(doc[MONGO_ID], doc[VERSION])
+            else:
+                publish(change['ns']['coll'], change)
+
+
+def poll_once(database, seen: dict):
+    """
+    Publish a change for every collection whose version moved since
+    `seen`, which is updated in place. A collection never written
+    has no version doc, which counts as version 0.
+    Every version is read, not just those of collections with
+    subscribers, to keep `versions` current.
+    """
+    for doc in database[VERSIONS_COLLECT].find():
+        collection = doc[MONGO_ID]
+        _set_version(collection, doc[VERSION])
+        if seen.get(collection, 0) != doc[VERSION]:
+            publish(collection)
+        seen[collection] = doc[VERSION]
+
+
+def _poll(database):
+    seen = {}
+    # the first poll sets the baseline:
+    for doc in database[VERSIONS_COLLECT].find():
+        _set_version(doc[MONGO_ID], doc[VERSION])
+        seen[doc[MONGO_ID]] = doc[VERSION]
+    while not _stop.wait(POLL_SECS):
+        poll_once(database, seen)
+
+
+def _run(database):
+    global mode
+    while not _stop.is_set():
+        try:
+            if mode == POLL:
+                _poll(database)
+            else:
+                _watch(database)
+        except OperationFailure as e:
+            if e.code in CHANGE_STREAM_UNSUPPORTED:
+                logger.warning('Change streams unavailable: '
+                               'polling for changes.')
+                mode = POLL
+                continue
+            logger.error('Cache invalidation listener failed: %s', e)
+        except PyMongoError as e:
+            logger.error('Cache invalidation listener failed: %s', e)
+        except Exception:
+            # a dead listener would leave `versions` frozen for good:
+            logger.exception('Cache invalidation listener failed')
+        # we may have missed changes while down:
+        _invalidate_all()
+        _stop.wait(RETRY_SECS)
+
+
+os.register_at_fork(after_in_child=_forget)
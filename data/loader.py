@@ -0,0 +1,63 @@
+"""
+This module provides a batching loader, to avoid N+1 queries when
+code looks up many docs by ID one at a time.
+Ask for the IDs you will need with `want()`, then `load()` them: the
+first load fetches everything wanted so far with a single call to the
+batch function, and every doc is fetched at most once per loader.
+Loaders cache without expiry, so make one per request.
+"""
+
+
+class BatchLoader:
+    """
+    Coalesces lookups by ID into batches. `batch_fn(ids)` must return
+    the docs for ids in the same order, with None for missing ones, as
+    the `get_*_by_ids()` functions of the data modules do.
+    """
+    def __init__(self, batch_fn):
+        self.batch_fn = batch_fn
+        self.docs = {}  # ID -> doc, or None if there is none
+        self.queue = {}  # IDs wanted but not fetched yet, in order
+        self.batches = 0
+
+    def want(self, ids):
+        """
+        Queue IDs to be fetched with the next batch.
+        """
+        for doc_id in ids:
+            doc_id = str(doc_id)
+            if doc_id not in self.docs:
+                self.queue[doc_id] = None
+
+    def dispatch(self):
+        """
+        Fetch every queued ID in one batch.
+        """
+        if not self.queue:
+            return
+        ids = list(self.queue)
+        self.queue = {}
+        self.docs.update(zip(ids, self.batch_fn(ids)))
+        self.batches += 1
+
+    def load_many(self, ids) -> list:
+        ids = [str(doc_id) for doc_id in ids]
+        self.want(ids)
+        self.dispatch()
+        return [self.docs.get(doc_id) for doc_id in ids]
+
+    def load(self, doc_id):
+        return self.load_many([doc_id])[0]
+
+    def prime(self, doc_id, doc):
+        """
+        Cache a doc we already have, e.g. one just written.
+        """
+        self.docs[str(doc_id)] = doc
+        self.queue.pop(str(doc_id), None)
+
+    def clear(self, doc_id=None):
+        if doc_id is None:
+            self.docs.clear()
+        else:
+            self.docs.pop(str(doc_id), None)
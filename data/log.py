@@ -0,0 +1,135 @@
+"""
+This module sets up logging for `data` and `server`: leveled, as JSON
+lines, tagged with the ID of the request being served.
+Callers only put records on a queue; a background thread formats and
+writes them, so a slow stdout never holds up a request. When the queue
+is full, records are dropped (and counted) rather than waited on.
+DEBUG records are sampled: only LOG_DEBUG_SAMPLE_RATE of them are kept,
+unless a call asks for another rate with `extra={SAMPLE_RATE: rate}`.
+Modules log through `logging.getLogger(__name__)` as usual.
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10_000))
+
+# the loggers we configure:
+LOGGERS = ['data', 'server']
+SAMPLE_RATE = 'sample_rate'
+REQUEST_ID = 'request_id'
+
+request_id = contextvars.ContextVar(REQUEST_ID, default=None)
+
+# the attributes every LogRecord has; the rest came in through `extra`:
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message',
+                                                        SAMPLE_RATE}
+
+_listener = None
+_listener_pid = None
+dropped = 0
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record: the time, level, logger, message and
+    request ID, plus any `extra` fields.
+    """
+    def format(self, record) -> str:
+        doc = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                doc[key] = value
+        if record.exc_text:
+            doc['exc'] = record.exc_text
+        return json.dumps(doc, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Tags each record with the current request's ID, and samples DEBUG
+    records. Runs in the thread that logs, where the request ID is set.
+    """
+    def filter(self, record) -> bool:
+        if record.levelno == logging.DEBUG:
+            rate = getattr(record, SAMPLE_RATE, DEBUG_SAMPLE_RATE)
+            if rate < 1 and random.random() >= rate:
+                return False
+        if not hasattr(record, REQUEST_ID):
+            record.request_id = request_id.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that drops records when the queue is full instead of
+    reporting an error, and leaves the formatting to the writer thread.
+    """
+    def prepare(self, record):
+        # resolve what can't cross to the other thread, and no more:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+def setup(level: str = LEVEL, stream=None):
+    """
+    Send the `data` and `server` logs through the queue to stream
+    (stdout by default). Call it once per process; calling it again
+    after a fork starts the forked process's own writer thread.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    records = queue.Queue(QUEUE_SIZE)
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JSONFormatter())
+    _listener = logging.handlers.QueueListener(records, writer)
+    _listener.start()
+    _listener_pid = os.getpid()
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    for name in LOGGERS:
+        logger = logging.getLogger(name)
+        logger.handlers = [handler]
+        logger.setLevel(level)
+        logger.propagate = False
+
+
+def stop():
+    """
+    Write out the records still queued, and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+atexit.register(stop)
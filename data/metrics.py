@@ -0,0 +1,315 @@
+"""
+This module records where the time goes: latency histograms, document
+counts and payload sizes per operation, for the database calls and the
+endpoints. They are served at /metrics in the Prometheus text format.
+Recording costs two clock reads, a lock and a bisect: a couple of
+microseconds a call.
+Under gunicorn, each worker keeps its own numbers and writes them to a
+file in METRICS_DIR every METRICS_FLUSH_SECONDS; /metrics adds up the
+files of the live workers. A worker's file goes when it exits (see
+gunicorn.conf.py), and /metrics skips and removes any left by a worker
+that died unseen. Without METRICS_DIR, /metrics shows the serving
+process alone.
+"""
+import bisect
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+# upper bounds of the latency buckets, in seconds:
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+           5, 10)
+
+DB = 'db'
+HTTP = 'http'
+# metric -> (type, help); DB and HTTP are also histograms:
+METRICS = {
+    DB: ('histogram', 'Database call latency in seconds'),
+    HTTP: ('histogram', 'Request latency in seconds, up to the headers'),
+    'db_documents': ('counter', 'Documents returned by database calls'),
+    'http_response_bytes': ('counter', 'Response body bytes sent'),
+}
+PREFIX = 'app_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_lock = threading.Lock()
+# (histogram, labels) -> [count per bucket..., count over, sum]:
+_histograms = {}
+# (counter, labels) -> value:
+_counters = {}
+_flusher = None
+
+
+def observe(metric: str, labels: tuple, seconds: float):
+    """
+    Record one latency. labels is a tuple of (name, value) pairs.
+    """
+    i = bisect.bisect_left(BUCKETS, seconds)
+    key = (metric, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        hist[i] += 1
+        hist[-1] += seconds
+
+
+def inc(metric: str, labels: tuple, amount: float = 1):
+    key = (metric, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def count_docs(result) -> int:
+    """
+    How many documents a database call returned: a list or a page of
+    them, or a single doc. Calls returning anything else pass their
+    own `count` to `timed_db()`.
+    """
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])  # a page and its cursor
+    if isinstance(result, dict):
+        return 1
+    return 0
+
+
+def count_found(result: list) -> int:
+    """
+    For lists with a None for each doc not found.
+    """
+    return sum(doc is not None for doc in result)
+
+
+def timed_db(func=None, *, count=count_docs):
+    """
+    Decorator timing a database call, sync or async, and counting the
+    docs it returns with count(result). Use it bare or with count=.
+    """
+    if func is None:
+        return functools.partial(timed_db, count=count)
+    is_async = inspect.iscoroutinefunction(func)
+    labels = (('op', f'{func.__name__}_async' if is_async
+               else func.__name__),)
+    clock = time.perf_counter
+
+    def record(start, result):
+        observe(DB, labels, clock() - start)
+        docs = count(result) if result is not None else 0
+        if docs:
+            inc('db_documents', labels, docs)
+
+    if is_async:
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = clock()
+            result = None
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                record(start, result)
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            record(start, result)
+        return result
+    return wrapper
+
+
+def record_request(endpoint: str, method: str, status: int, seconds: float,
+                   size: int):
+    labels = (('endpoint', endpoint), ('method', method),
+              ('status', str(status)))
+    observe(HTTP, labels, seconds)
+    if size:
+        inc('http_response_bytes', labels, size)
+
+
+def snapshot() -> dict:
+    """
+    This process's numbers, in a JSON-friendly form.
+    """
+    with _lock:
+        return {
+            'histograms': [[metric, labels, list(values)]
+                           for (metric, labels), values
+                           in _histograms.items()],
+            'counters': [[metric, labels, value]
+                         for (metric, labels), value in _counters.items()],
+        }
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _worker_file(pid: int = None) -> str:
+    return os.path.join(METRICS_DIR, f'worker-{pid or os.getpid()}.json')
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # someone else's process
+    return True
+
+
+def remove_worker(pid: int):
+    """
+    Remove the file of a worker that exited; for the gunicorn master.
+    """
+    if not METRICS_DIR:
+        return
+    try:
+        os.remove(_worker_file(pid))
+    except FileNotFoundError:
+        pass
+
+
+def flush():
+    """
+    Write this process's numbers to its file in METRICS_DIR, atomically
+    so a reader never sees half a file.
+    """
+    if not METRICS_DIR:
+        return
+    path = _worker_file()
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(f'{path}.tmp', path)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass  # try again next time
+
+
+def start_flusher():
+    """
+    Start flushing to METRICS_DIR in the background; once per process.
+    """
+    global _flusher
+    if METRICS_DIR and _flusher is None:
+        _flusher = threading.Thread(target=_flush_forever,
+                                    name='metrics-flush', daemon=True)
+        _flusher.start()
+
+
+def clear_dir():
+    """
+    Remove the files of a previous run; for the gunicorn master at
+    startup.
+    """
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for name in os.listdir(METRICS_DIR):
+        if name.startswith('worker-'):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+def _merge(snapshots) -> tuple:
+    histograms = {}
+    counters = {}
+    for snap in snapshots:
+        for metric, labels, values in snap['histograms']:
+            key = (metric, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for metric, labels, value in snap['counters']:
+            key = (metric, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+
+def collect() -> tuple:
+    """
+    The numbers of every live worker, or of this process alone without
+    METRICS_DIR, as (histograms, counters).
+    """
+    if not METRICS_DIR:
+        return _merge([snapshot()])
+    flush()
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        try:
+            pid = int(name[len('worker-'):-len('.json')])
+        except ValueError:
+            continue
+        if not _alive(pid):
+            remove_worker(pid)
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # a worker that just went away
+    return _merge(snapshots)
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+def render() -> str:
+    """
+    All the numbers, in the Prometheus text exposition format.
+    """
+    histograms, counters = collect()
+    lines = []
+    for metric, (kind, help_text) in METRICS.items():
+        name = PREFIX + (f'{metric}_duration_seconds' if kind == 'histogram'
+                         else f'{metric}_total')
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (hist, labels), values in sorted(histograms.items()):
+                if hist != metric:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    bucket_labels = labels + (('le', bound),)
+                    lines.append(f'{name}_bucket{_labels(bucket_labels)} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {values[-1]}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        else:
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == metric:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
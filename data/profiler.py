@@ -0,0 +1,248 @@
+"""
+This module profiles the queries the app really sends, to tune indexes
+from real traffic. A pymongo command listener, registered by
+`connect_db()`, times every command and files it under its shape: the
+command, the collection, and the filter with its values blanked out, so
+`{'state': 'NY'}` and `{'state': 'CT'}` count as one query.
+Commands slower than SLOW_QUERY_MS are explained in a background thread,
+at most once per shape every EXPLAIN_EVERY_SECS, and logged with a
+summary of the plan: collection scan or index scan, and how many
+documents were examined for how many returned.
+The numbers are per process; read them with `top_queries()`.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('QUERY_PROFILER', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+EXPLAIN_EVERY_SECS = float(os.environ.get('EXPLAIN_EVERY_SECS', 300))
+MAX_SHAPES = int(os.environ.get('QUERY_PROFILER_MAX_SHAPES', 1000))
+DEFAULT_TOP_N = 20
+MAX_TOP_N = 200
+
+# the commands that read or write by filter, and where their filter is:
+FILTERS = {
+    'find': lambda cmd: cmd.get('filter', {}),
+    'count': lambda cmd: cmd.get('query', {}),
+    'distinct': lambda cmd: cmd.get('query', {}),
+    'findAndModify': lambda cmd: cmd.get('query', {}),
+    'aggregate': lambda cmd: next(
+        (stage['$match'] for stage in cmd.get('pipeline', [])
+         if '$match' in stage), {}),
+    'update': lambda cmd: cmd.get('updates', [{}])[0].get('q', {}),
+    'delete': lambda cmd: cmd.get('deletes', [{}])[0].get('q', {}),
+}
+# command fields the driver adds, which explain won't take:
+DRIVER_FIELDS = {'lsid', '$db', '$clusterTime', 'txnNumber',
+                 '$readPreference', 'readConcern', 'writeConcern',
+                 'startTransaction', 'autocommit', 'apiVersion'}
+BLANK = '?'
+
+COLLECTION = 'collection'
+COMMAND = 'command'
+SHAPE = 'shape'
+COUNT = 'count'
+TOTAL_MS = 'total_ms'
+AVG_MS = 'avg_ms'
+MAX_MS = 'max_ms'
+PLAN = 'plan'
+SORTS = [TOTAL_MS, MAX_MS, AVG_MS, COUNT]
+
+COLLSCAN = 'COLLSCAN'
+STAGES = 'stages'
+INDEXES = 'indexes'
+DOCS_EXAMINED = 'docs_examined'
+KEYS_EXAMINED = 'keys_examined'
+RETURNED = 'returned'
+
+
+def shape(value):
+    """
+    value with every literal replaced by BLANK; operators, field names
+    and the structure of $and/$or clauses are kept.
+    """
+    if isinstance(value, dict):
+        return {key: shape(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(val, dict) for val in value):
+            return [shape(val) for val in value]
+        return [BLANK]  # e.g. the values of an $in
+    return BLANK
+
+
+def _find(doc, key):
+    """
+    The first value of key anywhere in doc, depth first, or None:
+    explain output nests differently by command and server version.
+    """
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        values = doc.values()
+    elif isinstance(doc, list):
+        values = doc
+    else:
+        return None
+    for value in values:
+        found = _find(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def _stages(plan, found):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            found[STAGES].append(plan['stage'])
+            if plan.get('indexName'):
+                found[INDEXES].append(plan['indexName'])
+        for key in ('inputStage', 'queryPlan', 'inputStages'):
+            _stages(plan.get(key), found)
+    elif isinstance(plan, list):
+        for stage in plan:
+            _stages(stage, found)
+
+
+def plan_summary(explained: dict) -> dict:
+    """
+    The gist of explain() output: the winning plan's stages and
+    indexes, and the documents and keys it examined for those it
+    returned.
+    """
+    summary = {STAGES: [], INDEXES: []}
+    _stages(_find(explained, 'winningPlan'), summary)
+    summary[COLLSCAN] = COLLSCAN in summary[STAGES]
+    stats = _find(explained, 'executionStats') or {}
+    summary[DOCS_EXAMINED] = stats.get('totalDocsExamined')
+    summary[KEYS_EXAMINED] = stats.get('totalKeysExamined')
+    summary[RETURNED] = stats.get('nReturned')
+    return summary
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """
+    Times commands by shape, and explains the slow ones. get_client
+    returns the client to run explain() with, or None.
+    """
+    def __init__(self, get_client, slow_ms: float = SLOW_QUERY_MS):
+        self.get_client = get_client
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.explain_queue = queue.Queue(100)
+        self._explainer = None
+        self._explainer_pid = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.in_flight = {}  # request ID -> (key, db, command)
+            self.shapes = {}  # key -> stats
+            self.explained_at = {}  # key -> time of the last explain
+
+    def started(self, event):
+        get_filter = FILTERS.get(event.command_name)
+        if get_filter is None:
+            return
+        command = event.command
+        try:
+            filt = get_filter(command)
+        except (AttributeError, IndexError, TypeError):
+            filt = {}
+        key = (command.get(event.command_name), event.command_name,
+               json.dumps(shape(filt), sort_keys=True))
+        with self.lock:
+            self.in_flight[(event.connection_id, event.request_id)] = \
+                (key, event.database_name, command)
+
+    def succeeded(self, event):
+        with self.lock:
+            started = self.in_flight.pop((event.connection_id,
+                                          event.request_id), None)
+            if started is None:
+                return
+            key, db, command = started
+            ms = event.duration_micros / 1000
+            stats = self.shapes.get(key)
+            if stats is None:
+                if len(self.shapes) >= MAX_SHAPES:
+                    return
+                stats = self.shapes[key] = {COUNT: 0, TOTAL_MS: 0.0,
+                                            MAX_MS: 0.0, PLAN: None}
+            stats[COUNT] += 1
+            stats[TOTAL_MS] += ms
+            stats[MAX_MS] = max(stats[MAX_MS], ms)
+            if ms < self.slow_ms:
+                return
+            now = time.monotonic()
+            last = self.explained_at.get(key)
+            if last is not None and now - last < EXPLAIN_EVERY_SECS:
+                return
+            self.explained_at[key] = now
+        self._start_explainer()
+        try:
+            self.explain_queue.put_nowait((key, db, command, ms))
+        except queue.Full:
+            pass  # explaining is best effort
+
+    def failed(self, event):
+        with self.lock:
+            self.in_flight.pop((event.connection_id, event.request_id), None)
+
+    def _start_explainer(self):
+        # threads don't survive a fork: each worker starts its own
+        if self._explainer_pid != os.getpid():
+            self._explainer_pid = os.getpid()
+            self._explainer = threading.Thread(target=self._explain_forever,
+                                               name='query-explainer',
+                                               daemon=True)
+            self._explainer.start()
+
+    def _explain_forever(self):
+        while True:
+            self.explain(*self.explain_queue.get())
+
+    def explain(self, key, db, command, ms):
+        """
+        Explain a slow command, log it with its plan, and keep the plan
+        with the stats of its shape.
+        """
+        client = self.get_client()
+        if client is None:
+            return
+        to_explain = {fld: value for fld, value in command.items()
+                      if fld not in DRIVER_FIELDS}
+        try:
+            explained = client[db].command(
+                {'explain': to_explain, 'verbosity': 'executionStats'})
+        except PyMongoError as e:
+            logger.warning('Could not explain a slow %s on %s: %s',
+                           key[1], key[0], e)
+            return
+        summary = plan_summary(explained)
+        with self.lock:
+            if key in self.shapes:
+                self.shapes[key][PLAN] = summary
+        logger.warning('Slow %s on %s: %.1f ms', key[1], key[0], ms,
+                       extra={SHAPE: key[2], PLAN: summary})
+
+    def top(self, n: int = DEFAULT_TOP_N, sort: str = TOTAL_MS) -> list:
+        """
+        The n query shapes with the most sort (one of SORTS), most
+        first.
+        """
+        with self.lock:
+            queries = [{COLLECTION: key[0], COMMAND: key[1],
+                        SHAPE: json.loads(key[2]),
+                        AVG_MS: stats[TOTAL_MS] / stats[COUNT], **stats}
+                       for key, stats in self.shapes.items()]
+        queries.sort(key=lambda query: query[sort], reverse=True)
+        return queries[:n]
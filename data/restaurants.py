@@ -3,10 +3,20 @@ This file will manage interactions with our data store.
 At first, it will just contain stubs that return fake data.
 Gradually, we will fill in actual calls to our datastore.
 """
+import logging
+import os
 import random
 import re
+import threading
+import time
 
+import data.async_db_connect as adbc
+import data.autocomplete as ac
+import data.cache as cache
 import data.db_connect as dbc
+import data.geo as geo
+import data.indexes as idx
+import data.invalidation as inv
 from bson import ObjectId
 
 
@@ -20,6 +30,28 @@ ADDRESS = 'address'
 CITY = 'city'
 STATE = 'state'
 ZIP_CODE = 'zip_code'
+# kept up to date by the reviews module as reviews come and go:
+RATING_SUM = 'rating_sum'
+RATING_COUNT = 'rating_count'
+RATING_HISTOGRAM = 'rating_histogram'  # rating (as a str) -> review count
+# stored along with them so it can be filtered on, and recomputed on
+# read for restaurants stored before it was:
+AVG_RATING = 'avg_rating'
+# Bayesian average, stored so restaurants can be ranked through an index.
+# Every restaurant starts with PRIOR_WEIGHT imaginary ratings of
+# PRIOR_MEAN, so a couple of 5-star reviews can't top the leaderboard:
+RATING_SCORE = 'rating_score'
+PRIOR_MEAN = float(os.environ.get('RATING_PRIOR_MEAN', 3))
+PRIOR_WEIGHT = float(os.environ.get('RATING_PRIOR_WEIGHT', 10))
+DEFAULT_TOP_N = 10
+MAX_TOP_N = 100
+# relevance of a restaurant to a text search:
+SEARCH_SCORE = 'search_score'
+# a GeoJSON point, at the restaurant's zip code centroid (see data.geo),
+# or missing if we can't locate it:
+LOCATION = 'location'
+# how far a restaurant is from the point searched near:
+DISTANCE_MILES = 'distance_miles'
 
 
 TEST_RESTAURANT_NAME = 'Test Restaurant'
@@ -29,6 +61,113 @@ TEST_OWNER_ID = 100000000000000000000000
 NAME = 'name'
 RESTAURANT_COLLECT = 'restaurants'
 
+# the orders `query_restaurants()` can sort in, as (field, direction):
+SORT_RATING = 'rating'
+SORT_NAME = 'name'
+SORT_NEWEST = 'newest'
+SORTS = {
+    SORT_RATING: (RATING_SCORE, idx.DESCENDING),
+    SORT_NAME: (NAME, idx.ASCENDING),
+    SORT_NEWEST: (dbc.MONGO_ID, idx.DESCENDING),
+}
+
+
+# restaurants are unique by address, and listed and ranked by state
+# and by type. The ranking indexes end in the rating score and then the
+# `_id`, the tie-breaker of the keyset pages of `query_restaurants()`,
+# so they return a page in order without sorting in memory:
+ADDRESS_INDEX = idx.register(RESTAURANT_COLLECT,
+                             [(ADDRESS, idx.ASCENDING),
+                              (CITY, idx.ASCENDING),
+                              (STATE, idx.ASCENDING),
+                              (ZIP_CODE, idx.ASCENDING)],
+                             unique=True)
+STATE_INDEX = idx.register(RESTAURANT_COLLECT,
+                           [(STATE, idx.ASCENDING),
+                            (RATING_SCORE, idx.DESCENDING),
+                            (dbc.MONGO_ID, idx.DESCENDING)])
+# the pages of `get_restaurants_page()` in a state, in `_id` order:
+STATE_PAGE_INDEX = idx.register(RESTAURANT_COLLECT,
+                                [(STATE, idx.ASCENDING),
+                                 (dbc.MONGO_ID, idx.ASCENDING)])
+TYPE_INDEX = idx.register(RESTAURANT_COLLECT,
+                          [(RESTAURANT_TYPE, idx.ASCENDING),
+                           (RATING_SCORE, idx.DESCENDING),
+                           (dbc.MONGO_ID, idx.DESCENDING)])
+LEADERBOARD_INDEX = idx.register(RESTAURANT_COLLECT,
+                                 [(STATE, idx.ASCENDING),
+                                  (RESTAURANT_TYPE, idx.ASCENDING),
+                                  (RATING_SCORE, idx.DESCENDING),
+                                  (dbc.MONGO_ID, idx.DESCENDING)])
+SCORE_INDEX = idx.register(RESTAURANT_COLLECT,
+                           [(RATING_SCORE, idx.DESCENDING),
+                            (dbc.MONGO_ID, idx.DESCENDING)])
+# the query builder's other filters; see `query_restaurants()`. A city
+# is selective enough for its state and type to be checked on the docs
+# found, which keeps the score right after it, for the sort:
+CITY_INDEX = idx.register(RESTAURANT_COLLECT,
+                          [(CITY, idx.ASCENDING),
+                           (RATING_SCORE, idx.DESCENDING),
+                           (dbc.MONGO_ID, idx.DESCENDING)])
+ZIP_INDEX = idx.register(RESTAURANT_COLLECT,
+                         [(ZIP_CODE, idx.ASCENDING),
+                          (RATING_SCORE, idx.DESCENDING),
+                          (dbc.MONGO_ID, idx.DESCENDING)])
+NAME_INDEX = idx.register(RESTAURANT_COLLECT,
+                          [(NAME, idx.ASCENDING),
+                           (dbc.MONGO_ID, idx.ASCENDING)])
+LOCATION_INDEX = idx.register(RESTAURANT_COLLECT,
+                              [(LOCATION, idx.GEOSPHERE)])
+# free-text search; a match in the name counts for more:
+TEXT_INDEX = idx.register(RESTAURANT_COLLECT,
+                          [(NAME, idx.TEXT), (DESCRIPTION, idx.TEXT)],
+                          weights={NAME: 5, DESCRIPTION: 1})
+
+
+# the fields of a new restaurant, in `add_restaurant()` argument order:
+NEW_FIELDS = [NAME, RESTAURANT_TYPE, DESCRIPTION,
+              ADDRESS, CITY, STATE, ZIP_CODE]
+# the fields that make a restaurant unique:
+ADDRESS_FIELDS = [ADDRESS, CITY, STATE, ZIP_CODE]
+
+BULK_CHUNK_SIZE = int(os.environ.get('RESTAURANT_BULK_CHUNK_SIZE', 1000))
+BULK_STATUS = 'status'
+BULK_ID = 'id'
+BULK_ERROR = 'error'
+BULK_INSERTED = 'inserted'
+BULK_DUPLICATE = 'duplicate'
+BULK_INVALID = 'invalid'
+BULK_FAILED = 'failed'
+
+# restaurants change a few times an hour, but are read on most requests:
+RESTAURANT_CACHE = cache.TTLCache(
+    RESTAURANT_COLLECT,
+    max_size=int(os.environ.get('RESTAURANT_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('RESTAURANT_CACHE_TTL', 60)))
+# writes made by other workers clear the cache too:
+inv.subscribe(RESTAURANT_COLLECT, lambda change: RESTAURANT_CACHE.clear())
+
+# type-ahead over names and cities, built on first use (or at worker
+# start, see gunicorn.conf.py) and kept current as restaurants change:
+AUTOCOMPLETE = ac.PrefixIndex()
+# the kinds of term in the index are the fields they come from:
+AUTOCOMPLETE_FIELDS = [NAME, CITY]
+# the invalidation topic, besides the collection, of the writes that
+# may change AUTOCOMPLETE_FIELDS:
+AUTOCOMPLETE_TOPIC = f'{RESTAURANT_COLLECT}.autocomplete'
+_autocomplete_rebuild = threading.Lock()
+# the least time between two rebuilds for other workers' writes, each a
+# scan of every restaurant; names they change are missed until then:
+AUTOCOMPLETE_REBUILD_SECS = float(os.environ.get('AUTOCOMPLETE_REBUILD_SECS',
+                                                 30))
+_autocomplete_rebuilt_at = None
+
+# the fields clients may ask for by name:
+FIELDS = [dbc.MONGO_ID, NAME, RESTAURANT_TYPE, DESCRIPTION,
+          ADDRESS, CITY, STATE, ZIP_CODE,
+          RATING_SUM, RATING_COUNT, RATING_HISTOGRAM, AVG_RATING,
+          RATING_SCORE, LOCATION]
+
 
 TEST_RESTAURANT_FLDS = {
     TEST_RESTAURANT_NAME: 'Test Name',
@@ -37,6 +176,9 @@ TEST_RESTAURANT_FLDS = {
 }
 
 
+logger = logging.getLogger(__name__)
+
+
 def extract_id(s):
     match = re.search(r"ObjectId\('([a-f0-9]{24})'\)", s)
     if match:
@@ -44,17 +186,117 @@ def extract_id(s):
     return None
 
 
-def get_restaurants() -> dict:
+def _written(terms_changed: bool = True):
+    """
+    Call after every write to restaurants, so no cached read is stale,
+    in this process or (see `data.invalidation`) any other.
+    Pass terms_changed=False for writes that can't have changed an
+    AUTOCOMPLETE_FIELDS field, e.g. rating updates, so other workers
+    polling for changes don't rebuild their autocomplete index for them.
+    """
+    RESTAURANT_CACHE.clear()
+    inv.record_write(RESTAURANT_COLLECT)
+    if terms_changed:
+        inv.record_write(AUTOCOMPLETE_TOPIC)
+
+
+def _autocomplete_add(restaurant: dict):
+    AUTOCOMPLETE.update(str(restaurant[dbc.MONGO_ID]),
+                        {fld: restaurant.get(fld)
+                         for fld in AUTOCOMPLETE_FIELDS})
+
+
+def _autocomplete_change(change: dict):
+    """
+    Applies a change made by any worker to the autocomplete index.
+    A change we know nothing about comes on AUTOCOMPLETE_TOPIC too, if
+    it may matter: see `_autocomplete_stale()`.
+    """
+    op = (change or {}).get('operationType')
+    if op in ('insert', 'update', 'replace') and change.get('fullDocument'):
+        _autocomplete_add(change['fullDocument'])
+    elif op == 'delete':
+        AUTOCOMPLETE.remove(str(change['documentKey'][dbc.MONGO_ID]))
+
+
+def _autocomplete_stale(change: dict):
+    """
+    Some worker changed names or cities, we don't know which: the index
+    is rebuilt in the background on next use.
+    """
+    AUTOCOMPLETE.mark_dirty()
+
+
+inv.subscribe(RESTAURANT_COLLECT, _autocomplete_change)
+inv.subscribe(AUTOCOMPLETE_TOPIC, _autocomplete_stale)
+
+
+def _projection(fields: list) -> list:
+    """
+    The projection for the fields a client asked for. The average
+    rating is recomputed on read, so it needs the fields it comes from.
+    """
+    projection = dbc.make_projection(fields, FIELDS)
+    if projection and AVG_RATING in projection:
+        projection.remove(AVG_RATING)
+        projection += [RATING_SUM, RATING_COUNT]
+    return projection
+
+
+def add_avg_rating(restaurant: dict) -> dict:
+    """
+    Sets the restaurant's average rating (None if it has no ratings)
+    from its rating sum and count, if those were fetched.
+    """
+    if restaurant is not None and RATING_COUNT in restaurant:
+        restaurant[AVG_RATING] = average_rating(restaurant[RATING_SUM],
+                                                restaurant[RATING_COUNT])
+    return restaurant
+
+
+def average_rating(rating_sum: float, rating_count: int) -> float:
+    return round(rating_sum / rating_count, 2) if rating_count else None
+
+
+def rating_score(rating_sum: float, rating_count: int) -> float:
+    """
+    The Bayesian average rating: PRIOR_WEIGHT ratings of PRIOR_MEAN
+    plus the restaurant's own.
+    """
+    return ((PRIOR_WEIGHT * PRIOR_MEAN + rating_sum)
+            / (PRIOR_WEIGHT + rating_count))
+
+
+# the same, as aggregation expressions over a restaurant doc:
+RATING_SCORE_EXPR = {'$divide': [
+    {'$add': [PRIOR_WEIGHT * PRIOR_MEAN, f'${RATING_SUM}']},
+    {'$add': [PRIOR_WEIGHT, f'${RATING_COUNT}']},
+]}
+AVG_RATING_EXPR = {'$cond': [
+    {'$gt': [f'${RATING_COUNT}', 0]},
+    {'$round': [{'$divide': [f'${RATING_SUM}', f'${RATING_COUNT}']}, 2]},
+    None,
+]}
+
+
+@cache.cached(RESTAURANT_CACHE)
+def get_restaurants(fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(NAME, RESTAURANT_COLLECT)
+    restaurants = dbc.fetch_all_as_dict(NAME, RESTAURANT_COLLECT,
+                                        projection=_projection(fields))
+    for restaurant in restaurants.values():
+        add_avg_rating(restaurant)
+    return restaurants
 
 
-def get_restaurants_by_state(state: str) -> list:
+@cache.cached(RESTAURANT_CACHE)
+def get_restaurants_by_state(state: str, fields: list = None) -> list:
     """
     Fetches a list of restaurants filtered by the specified state.
 
     Args:
         state (str): The state to filter the restaurants by.
+        fields (list): The fields to fetch; all of them if empty.
 
     Returns:
         list: List of dictionaries representing the restaurants in given state.
@@ -62,16 +304,57 @@ def get_restaurants_by_state(state: str) -> list:
     dbc.connect_db()
     # Fetch all restaurants filtered by the state parameter
     filtered_restaurants = dbc.fetch_all_filtered(
-        RESTAURANT_COLLECT, filt={STATE: state})
-    return filtered_restaurants
+        RESTAURANT_COLLECT, filt={STATE: state},
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in filtered_restaurants]
 
 
-def add_restaurant(name: str, restaurant_type: str, description: str,
-                   address: str, city: str, state: str, zip_code: str) -> str:
-    restaurants = {}
-    if exists(address, city, state, zip_code):
-        raise ValueError('A restaurant with this address already exists.')
+def iter_restaurants(state: str = None,
+                     batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+                     fields: list = None):
+    """
+    Lazily yields restaurants, optionally filtered by state.
+    Used to stream large listings without loading them into memory.
+    """
+    dbc.connect_db()
+    filt = {STATE: state} if state else {}
+    return map(add_avg_rating,
+               dbc.iter_filtered(RESTAURANT_COLLECT, filt=filt,
+                                 batch_size=batch_size,
+                                 projection=_projection(fields)))
+
+
+def get_restaurants_page(limit: int = dbc.DEFAULT_PAGE_SIZE,
+                         after: str = None, state: str = None,
+                         fields: list = None) -> tuple:
+    """
+    Fetches one page of restaurants, optionally filtered by state.
+
+    Args:
+        limit (int): The maximum number of restaurants to return.
+        after (str): The ID of the last restaurant on the previous page.
+        state (str): The state to filter the restaurants by.
+        fields (list): The fields to fetch; all of them if empty.
+
+    Returns:
+        tuple: The list of restaurants and the cursor for the next page.
+    """
+    dbc.connect_db()
+    filt = {STATE: state} if state else {}
+    restaurants, next_after = dbc.fetch_page(RESTAURANT_COLLECT, filt=filt,
+                                             limit=limit, after=after,
+                                             projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants], \
+        next_after
 
+
+def _make_restaurant(name: str, restaurant_type: str, description: str,
+                     address: str, city: str, state: str,
+                     zip_code: str) -> dict:
+    """
+    Validates the fields of a new restaurant and builds its document.
+    """
+    restaurants = {}
     fields = {
         'name': name,
         'restaurant_type': restaurant_type,
@@ -93,65 +376,621 @@ def add_restaurant(name: str, restaurant_type: str, description: str,
     restaurants[CITY] = city
     restaurants[STATE] = state
     restaurants[ZIP_CODE] = zip_code
+    restaurants[RATING_SUM] = 0
+    restaurants[RATING_COUNT] = 0
+    restaurants[RATING_HISTOGRAM] = {}
+    restaurants[RATING_SCORE] = rating_score(0, 0)
+    restaurants[AVG_RATING] = None
+    location = geo.locate_zip(zip_code)
+    if location:
+        restaurants[LOCATION] = location
+    return restaurants
+
+
+def add_restaurant(name: str, restaurant_type: str, description: str,
+                   address: str, city: str, state: str, zip_code: str) -> str:
+    restaurants = _make_restaurant(name, restaurant_type, description,
+                                   address, city, state, zip_code)
 
     dbc.connect_db()
-    _id = dbc.insert_one(RESTAURANT_COLLECT, restaurants)
+    try:
+        _id = dbc.insert_one(RESTAURANT_COLLECT, restaurants)
+    except dbc.DuplicateKeyError:
+        # ADDRESS_INDEX is unique: no need to look before inserting
+        raise ValueError('A restaurant with this address already exists.')
+    _written()
+    _autocomplete_add(restaurants)
     return extract_id(str(_id))
 
 
-def update_restaurant(restaurant_id: str, restaurant_data: dict) -> bool:
-    if not id_exists(restaurant_id):
-        raise ValueError('This ID does not belong to a valid restaurant.')
+def add_restaurants_bulk(rows: list,
+                         chunk_size: int = BULK_CHUNK_SIZE) -> list:
+    """
+    Adds many restaurants with one `insert_many()` per chunk of rows,
+    instead of an existence check and an insert per row.
+    Rows are validated in memory, and a row repeating the address of an
+    earlier row in the batch is a duplicate; the unique address index
+    catches duplicates of restaurants already stored.
+
+    Args:
+        rows (list): Dicts with the same fields as `add_restaurant()`.
+        chunk_size (int): The number of rows to send per round-trip.
+
+    Returns:
+        list: One result dict per row, in order, with its status and
+        either the new restaurant's ID or the reason it was not added.
+    """
+    if chunk_size < 1:
+        raise ValueError('The chunk size must be at least 1.')
+    results = []
+    to_insert = []  # (row index, doc) pairs
+    seen = set()
+    for i, row in enumerate(rows):
+        if not isinstance(row, dict):
+            results.append({BULK_STATUS: BULK_INVALID,
+                            BULK_ERROR: 'Each row must be an object.'})
+            continue
+        try:
+            doc = _make_restaurant(*(row.get(fld) for fld in NEW_FIELDS))
+        except ValueError as e:
+            results.append({BULK_STATUS: BULK_INVALID, BULK_ERROR: str(e)})
+            continue
+        key = tuple(doc[fld] for fld in ADDRESS_FIELDS)
+        if key in seen:
+            results.append({BULK_STATUS: BULK_DUPLICATE,
+                            BULK_ERROR: 'Repeats an earlier row\'s address.'})
+            continue
+        seen.add(key)
+        results.append(None)
+        to_insert.append((i, doc))
+
+    dbc.connect_db()
+    for start in range(0, len(to_insert), chunk_size):
+        chunk = to_insert[start:start + chunk_size]
+        errors = dbc.insert_many(RESTAURANT_COLLECT,
+                                 [doc for _, doc in chunk])
+        _written()
+        for j, (i, doc) in enumerate(chunk):
+            if j not in errors:
+                results[i] = {BULK_STATUS: BULK_INSERTED,
+                              BULK_ID: str(doc[dbc.MONGO_ID])}
+                _autocomplete_add(doc)
+            elif errors[j]['code'] == dbc.DUPLICATE_KEY_CODE:
+                results[i] = {BULK_STATUS: BULK_DUPLICATE,
+                              BULK_ERROR: 'A restaurant with this '
+                                          'address already exists.'}
+            else:
+                results[i] = {BULK_STATUS: BULK_FAILED,
+                              BULK_ERROR: errors[j]['errmsg']}
+    return results
 
-    if not restaurant_data:
-        raise ValueError('There are no valid fields to update.')
 
+def update_restaurant(restaurant_id: str, restaurant_data: dict) -> bool:
+    """
+    Updates a restaurant in a single round-trip: a missing restaurant
+    shows up as a zero `matched_count`.
+    """
     update_data = {}
-    for key in [NAME, RESTAURANT_TYPE, DESCRIPTION,
-                ADDRESS, CITY, STATE, ZIP_CODE]:
-        if key in restaurant_data:
+    for key in NEW_FIELDS:
+        if key in (restaurant_data or {}):
             update_data[key] = restaurant_data[key]
+    if not update_data:
+        raise ValueError('There are no valid fields to update.')
+    if ZIP_CODE in update_data:
+        # moved: the old location is wrong even if we can't find the new
+        update_data[LOCATION] = geo.locate_zip(update_data[ZIP_CODE])
 
     dbc.connect_db()
-    return dbc.update_doc(RESTAURANT_COLLECT,
-                          {"_id": ObjectId(restaurant_id)}, update_data)
+    try:
+        result = dbc.update_doc(RESTAURANT_COLLECT,
+                                {"_id": dbc.to_object_id(restaurant_id)},
+                                update_data)
+    except dbc.DuplicateKeyError:
+        raise ValueError('A restaurant with this address already exists.')
+    _written()
+    if result.matched_count == 0:
+        raise ValueError('This ID does not belong to a valid restaurant.')
+    terms = {fld: update_data[fld] for fld in AUTOCOMPLETE_FIELDS
+             if fld in update_data}
+    if terms:
+        AUTOCOMPLETE.update(str(restaurant_id), terms)
+    return result
 
 
 def del_restaurant(object_id: str):
-    if not id_exists(object_id):
+    """
+    Deletes a restaurant in a single round-trip: a missing restaurant
+    shows up as a zero `deleted_count`.
+    """
+    dbc.connect_db()
+    result = dbc.del_one(RESTAURANT_COLLECT,
+                         {"_id": dbc.to_object_id(object_id)})
+    _written()
+    if result.deleted_count == 0:
         raise ValueError('This ID does not belong to a valid restaurant.')
-    else:
-        dbc.connect_db()
-        return dbc.del_one(RESTAURANT_COLLECT,
-                           {"_id": ObjectId(object_id)})
+    AUTOCOMPLETE.remove(str(object_id))
+    return result
 
 
 def delete_all():
     dbc.connect_db()
-    return dbc.delete_all(RESTAURANT_COLLECT)
+    count = dbc.delete_all(RESTAURANT_COLLECT)
+    _written()
+    AUTOCOMPLETE.clear()
+    return count
 
 
 def exists(address: str, city: str, state: str, zip_code: str) -> bool:
     dbc.connect_db()
-    return dbc.fetch_one(RESTAURANT_COLLECT,
-                         {ADDRESS: address, CITY: city,
-                          STATE: state, ZIP_CODE: zip_code})
+    return dbc.doc_exists(RESTAURANT_COLLECT,
+                          {ADDRESS: address, CITY: city,
+                           STATE: state, ZIP_CODE: zip_code})
 
 
 def id_exists(object_id: str) -> bool:
+    try:
+        _id = dbc.to_object_id(object_id)
+    except ValueError:
+        return False
     dbc.connect_db()
-    return dbc.fetch_one(RESTAURANT_COLLECT,
-                         {"_id": ObjectId(object_id)})
+    return dbc.doc_exists(RESTAURANT_COLLECT, {"_id": _id})
 
 
-def get_restaurant_by_id(object_id: str):
+def get_restaurant_by_id(object_id: str, fields: list = None):
+    """
+    Fetches a restaurant by ID, or None if there is no such restaurant.
+    `fields` optionally limits the fields fetched.
+    """
     dbc.connect_db()
     restaurant = dbc.fetch_one(RESTAURANT_COLLECT,
-                               {"_id": ObjectId(object_id)})
-    return restaurant
+                               {"_id": dbc.to_object_id(object_id)},
+                               projection=_projection(fields))
+    return add_avg_rating(restaurant)
+
+
+def get_restaurants_by_ids(ids: list, fields: list = None) -> list:
+    """
+    Fetches many restaurants by ID in one query (per chunk of IDs).
+    Returns them in the order of ids, with None for unknown IDs.
+    """
+    dbc.connect_db()
+    return [add_avg_rating(restaurant) for restaurant in
+            dbc.fetch_by_ids(RESTAURANT_COLLECT, ids,
+                             projection=_projection(fields))]
+
+
+@cache.cached(RESTAURANT_CACHE)
+def get_restaurants_type(restaurant_type: str, fields: list = None) -> list:
+    dbc.connect_db()
+    restaurants = dbc.fetch_all_filtered(
+        RESTAURANT_COLLECT, filt={RESTAURANT_TYPE: restaurant_type},
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants]
+
+
+def update_rating_aggregates(restaurant_id: str, added: int = None,
+                             removed: int = None):
+    """
+    Atomically adjusts a restaurant's rating counters, and recomputes
+    its score from them, in a single pipeline update, for a review whose
+    rating went from `removed` to `added`. Pass only `added` for a new
+    review and only `removed` for a deleted one. Reviews of restaurants
+    we don't know about are ignored.
+    """
+    inc = {}
+    for rating, sign in ((added, 1), (removed, -1)):
+        if rating is not None:
+            for fld, amount in ((RATING_SUM, rating), (RATING_COUNT, 1),
+                                (f'{RATING_HISTOGRAM}.{rating}', 1)):
+                inc[fld] = inc.get(fld, 0) + sign * amount
+    inc = {fld: amount for fld, amount in inc.items() if amount}
+    if not inc:
+        return
+    try:
+        _id = dbc.to_object_id(restaurant_id)
+    except ValueError:
+        return
+    pipeline = [
+        {'$set': {fld: {'$add': [{'$ifNull': [f'${fld}', 0]}, amount]}
+                  for fld, amount in inc.items()}},
+        {'$set': {RATING_SCORE: RATING_SCORE_EXPR,
+                  AVG_RATING: AVG_RATING_EXPR}},
+    ]
+    dbc.connect_db()
+    dbc.update_with_pipeline(RESTAURANT_COLLECT, {"_id": _id}, pipeline)
+    _written(terms_changed=False)
+
+
+def set_rating_aggregates(aggregates: dict) -> int:
+    """
+    Overwrites the rating counters and scores of restaurants in one
+    round-trip.
+    `aggregates` maps restaurant IDs to a dict with the rating sum,
+    count and histogram, or to None for a restaurant with no ratings.
+    Returns the number of restaurants updated.
+    """
+    updates = []
+    for restaurant_id, counters in aggregates.items():
+        try:
+            _id = dbc.to_object_id(restaurant_id)
+        except ValueError:
+            continue
+        counters = counters or {}
+        rating_sum = counters.get(RATING_SUM, 0)
+        rating_count = counters.get(RATING_COUNT, 0)
+        updates.append(({"_id": _id}, {
+            RATING_SUM: rating_sum,
+            RATING_COUNT: rating_count,
+            RATING_HISTOGRAM: counters.get(RATING_HISTOGRAM, {}),
+            RATING_SCORE: rating_score(rating_sum, rating_count),
+            AVG_RATING: average_rating(rating_sum, rating_count),
+        }))
+    dbc.connect_db()
+    dbc.set_many(RESTAURANT_COLLECT, updates)
+    _written(terms_changed=False)
+    return len(updates)
+
+
+def get_restaurant_ids() -> list:
+    """
+    Returns the IDs of all restaurants, as strings.
+    """
+    dbc.connect_db()
+    return [str(doc[dbc.MONGO_ID])
+            for doc in dbc.iter_all(RESTAURANT_COLLECT,
+                                    projection=[dbc.MONGO_ID])]
+
+
+@cache.cached(RESTAURANT_CACHE)
+def get_top_restaurants(n: int = DEFAULT_TOP_N, state: str = None,
+                        restaurant_type: str = None,
+                        fields: list = None) -> list:
+    """
+    Returns the n best-rated restaurants, optionally in one state and
+    of one type, best first. Each combination of filters has an index
+    ending in the score, so this reads n docs however many there are.
+    """
+    if not 1 <= n <= MAX_TOP_N:
+        raise ValueError(f'n must be between 1 and {MAX_TOP_N}.')
+    filt = {}
+    if state:
+        filt[STATE] = state
+    if restaurant_type:
+        filt[RESTAURANT_TYPE] = restaurant_type
+    dbc.connect_db()
+    restaurants = dbc.fetch_sorted(RESTAURANT_COLLECT, filt,
+                                   sort=[(RATING_SCORE, idx.DESCENDING)],
+                                   limit=n, projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants]
+
+
+@cache.cached(RESTAURANT_CACHE)
+def search_restaurants(text: str, restaurant_type: str = None,
+                       page: int = 1, limit: int = dbc.DEFAULT_PAGE_SIZE,
+                       fields: list = None) -> tuple:
+    """
+    Full-text search on restaurant names and descriptions, most relevant
+    first, optionally of one type. Returns one page of restaurants, each
+    with its SEARCH_SCORE, and the number of the next page, which is
+    None on the last page.
+    """
+    filt = _search_filter(text, restaurant_type, page, limit)
+    dbc.connect_db()
+    # ask for one extra doc to learn whether there is a next page
+    found = dbc.fetch_text_search(RESTAURANT_COLLECT, text, filt,
+                                  skip=(page - 1) * limit, limit=limit + 1,
+                                  score_field=SEARCH_SCORE,
+                                  projection=_projection(fields))
+    return _search_result(found, page, limit)
 
 
-def get_restaurants_type(restaurant_type: str) -> list:
+def _search_filter(text: str, restaurant_type: str, page: int,
+                   limit: int) -> dict:
+    """
+    Validates the arguments of a text search, and returns its filter
+    besides the text.
+    """
+    if not text or not text.strip():
+        raise ValueError('The search text may not be blank.')
+    if page < 1:
+        raise ValueError('The page must be at least 1.')
+    if not 1 <= limit <= dbc.MAX_PAGE_SIZE:
+        raise ValueError(f'The limit must be between 1 '
+                         f'and {dbc.MAX_PAGE_SIZE}.')
+    return {RESTAURANT_TYPE: restaurant_type} if restaurant_type else {}
+
+
+def _search_result(found: list, page: int, limit: int) -> tuple:
+    next_page = None
+    if len(found) > limit:
+        found.pop()
+        next_page = page + 1
+    return [add_avg_rating(restaurant) for restaurant in found], next_page
+
+
+def build_autocomplete():
+    """
+    (Re)builds the autocomplete index from every restaurant, streaming
+    just the fields it needs.
+    """
+    dbc.connect_db()
+    docs = dbc.iter_all(RESTAURANT_COLLECT,
+                        projection=[dbc.MONGO_ID] + AUTOCOMPLETE_FIELDS)
+    AUTOCOMPLETE.build((str(doc[dbc.MONGO_ID]),
+                        {fld: doc.get(fld) for fld in AUTOCOMPLETE_FIELDS})
+                       for doc in docs)
+
+
+def autocomplete(prefix: str, limit: int = ac.DEFAULT_LIMIT,
+                 kinds: list = None) -> list:
+    """
+    Restaurant names and cities starting with prefix, for type-ahead.
+    `kinds` optionally limits the suggestions to some of
+    AUTOCOMPLETE_FIELDS.
+    """
+    if not ac.normalize(prefix):
+        raise ValueError('The prefix may not be blank.')
+    if not 1 <= limit <= ac.MAX_LIMIT:
+        raise ValueError(f'The limit must be between 1 and {ac.MAX_LIMIT}.')
+    bad = [kind for kind in kinds or [] if kind not in AUTOCOMPLETE_FIELDS]
+    if bad:
+        raise ValueError(f'Unknown kinds: {", ".join(bad)}.')
+    if not AUTOCOMPLETE.built:
+        ensure_autocomplete()
+    elif AUTOCOMPLETE.dirty:
+        rebuild_autocomplete_later()
+    return AUTOCOMPLETE.search(prefix, limit, kinds)
+
+
+def ensure_autocomplete():
+    """
+    Builds the autocomplete index if it was never built. Only one
+    thread builds it: the others wait for that build, rather than each
+    scanning every restaurant.
+    """
+    with _autocomplete_rebuild:
+        if not AUTOCOMPLETE.built:
+            build_autocomplete()
+
+
+def _rebuild_autocomplete():
+    try:
+        build_autocomplete()
+    except Exception:
+        logger.exception('Could not rebuild the autocomplete index.')
+    finally:
+        _autocomplete_rebuild.release()
+
+
+def rebuild_autocomplete_later():
+    """
+    Rebuilds the autocomplete index in a background thread, unless one
+    is already at it, or one started less than AUTOCOMPLETE_REBUILD_SECS
+    ago: the index stays dirty, for a later call to rebuild. Searches
+    keep using the current index meanwhile.
+    """
+    global _autocomplete_rebuilt_at
+    if not _autocomplete_rebuild.acquire(blocking=False):
+        return
+    now = time.monotonic()
+    if (_autocomplete_rebuilt_at is not None
+            and now - _autocomplete_rebuilt_at < AUTOCOMPLETE_REBUILD_SECS):
+        _autocomplete_rebuild.release()
+        return
+    _autocomplete_rebuilt_at = now
+    threading.Thread(target=_rebuild_autocomplete,
+                     name='autocomplete-rebuild', daemon=True).start()
+
+
+def backfill_locations(chunk_size: int = BULK_CHUNK_SIZE) -> tuple:
+    """
+    Sets the location of every restaurant that has none from its zip
+    code, one bulk write per chunk of restaurants.
+    Returns the number of restaurants located, and the number whose zip
+    codes aren't in the table.
+    """
+    dbc.connect_db()
+    located = unknown = 0
+    updates = []
+    for doc in dbc.iter_filtered(RESTAURANT_COLLECT, {LOCATION: None},
+                                 projection=[dbc.MONGO_ID, ZIP_CODE]):
+        location = geo.locate_zip(doc.get(ZIP_CODE))
+        if location is None:
+            unknown += 1
+            continue
+        updates.append(({dbc.MONGO_ID: doc[dbc.MONGO_ID]},
+                        {LOCATION: location}))
+        if len(updates) >= chunk_size:
+            dbc.set_many(RESTAURANT_COLLECT, updates)
+            located += len(updates)
+            updates = []
+    dbc.set_many(RESTAURANT_COLLECT, updates)
+    located += len(updates)
+    _written(terms_changed=False)
+    return located, unknown
+
+
+def get_restaurants_near(lat: float, lon: float, radius_miles: float,
+                         limit: int = dbc.DEFAULT_PAGE_SIZE,
+                         restaurant_type: str = None,
+                         fields: list = None) -> list:
+    """
+    Returns the restaurants within radius_miles of a point, nearest
+    first, each with its DISTANCE_MILES, using the 2dsphere index.
+    Restaurants we couldn't locate are left out.
+    """
+    if not 0 < radius_miles <= geo.MAX_RADIUS_MILES:
+        raise ValueError(f'The radius must be more than 0 and at most '
+                         f'{geo.MAX_RADIUS_MILES} miles.')
+    if not 1 <= limit <= dbc.MAX_PAGE_SIZE:
+        raise ValueError(f'The limit must be between 1 '
+                         f'and {dbc.MAX_PAGE_SIZE}.')
+    near = {
+        'near': geo.point(lat, lon),
+        'distanceField': DISTANCE_MILES,
+        'distanceMultiplier': 1 / geo.METERS_PER_MILE,
+        'maxDistance': radius_miles * geo.METERS_PER_MILE,
+        'spherical': True,
+        'key': LOCATION,
+    }
+    if restaurant_type:
+        near['query'] = {RESTAURANT_TYPE: restaurant_type}
+    pipeline = [{'$geoNear': near}, {'$limit': limit}]
+    projection = _projection(fields)
+    if projection:
+        pipeline.append({'$project': {fld: 1 for fld in
+                                      projection + [DISTANCE_MILES]}})
+    dbc.connect_db()
+    return [add_avg_rating(restaurant)
+            for restaurant in dbc.aggregate(RESTAURANT_COLLECT, pipeline)]
+
+
+@cache.cached(RESTAURANT_CACHE)
+def query_restaurants(restaurant_type: str = None, state: str = None,
+                      city: str = None, zip_code: str = None,
+                      min_rating: float = None, sort: str = SORT_RATING,
+                      limit: int = dbc.DEFAULT_PAGE_SIZE, after: str = None,
+                      fields: list = None) -> tuple:
+    """
+    Fetches one page of the restaurants matching any combination of
+    filters, in one indexed query.
+    There is an index for each single equality filter, and for state
+    and type together, ending in the rating score and then the `_id`, so
+    the default sort reads the page in index order instead of sorting
+    every match in memory. Other combinations use one of those indexes
+    and check the rest of the filter on the docs it finds, as they do
+    the minimum average rating, a range. The name sort has its own
+    index, but with filters it may sort in memory.
+
+    Args:
+        min_rating (float): The lowest average rating to include.
+        sort (str): One of SORTS.
+        limit (int): The maximum number of restaurants to return.
+        after (str): The cursor returned with the previous page.
+        fields (list): The fields to fetch; all of them if empty.
+
+    Returns:
+        tuple: The list of restaurants and the cursor for the next page,
+        which is None on the last page.
+    """
+    filt, sort_field, direction = _query_spec(restaurant_type, state, city,
+                                              zip_code, min_rating, sort,
+                                              limit)
     dbc.connect_db()
-    return dbc.fetch_all_filtered(RESTAURANT_COLLECT,
-                                  filt={RESTAURANT_TYPE: restaurant_type})
+    found, next_after = dbc.fetch_keyset_page(
+        RESTAURANT_COLLECT, filt, sort_field, direction, limit, after,
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in found], next_after
+
+
+def _query_spec(restaurant_type: str, state: str, city: str, zip_code: str,
+                min_rating: float, sort: str, limit: int) -> tuple:
+    """
+    Validates the arguments of `query_restaurants()`, and returns its
+    filter, sort field and sort direction.
+    """
+    if sort not in SORTS:
+        raise ValueError(f'Unknown sort: {sort}. '
+                         f'Choose from: {", ".join(SORTS)}.')
+    if not 1 <= limit <= dbc.MAX_PAGE_SIZE:
+        raise ValueError(f'The limit must be between 1 '
+                         f'and {dbc.MAX_PAGE_SIZE}.')
+    filt = {fld: value
+            for fld, value in ((RESTAURANT_TYPE, restaurant_type),
+                               (STATE, state), (CITY, city),
+                               (ZIP_CODE, zip_code))
+            if value}
+    if min_rating is not None:
+        if not 0 <= min_rating <= 5:
+            raise ValueError('The minimum rating must be from 0 to 5.')
+        filt[AVG_RATING] = {'$gte': min_rating}
+    return (filt, *SORTS[sort])
+
+
+# The async versions of the hot reads, for the ASGI server mode. They
+# share the validation above and the cache with the sync versions.
+
+@cache.cached_async(RESTAURANT_CACHE)
+async def get_restaurants_async(fields: list = None) -> dict:
+    adbc.connect_db()
+    restaurants = await adbc.fetch_all_as_dict(
+        NAME, RESTAURANT_COLLECT, projection=_projection(fields))
+    for restaurant in restaurants.values():
+        add_avg_rating(restaurant)
+    return restaurants
+
+
+@cache.cached_async(RESTAURANT_CACHE)
+async def get_restaurants_by_state_async(state: str,
+                                         fields: list = None) -> list:
+    adbc.connect_db()
+    restaurants = await adbc.fetch_all_filtered(
+        RESTAURANT_COLLECT, filt={STATE: state},
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants]
+
+
+@cache.cached_async(RESTAURANT_CACHE)
+async def get_restaurants_type_async(restaurant_type: str,
+                                     fields: list = None) -> list:
+    adbc.connect_db()
+    restaurants = await adbc.fetch_all_filtered(
+        RESTAURANT_COLLECT, filt={RESTAURANT_TYPE: restaurant_type},
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants]
+
+
+async def iter_restaurants_async(state: str = None,
+                                 batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+                                 fields: list = None):
+    adbc.connect_db()
+    filt = {STATE: state} if state else {}
+    async for restaurant in adbc.iter_filtered(
+            RESTAURANT_COLLECT, filt=filt, batch_size=batch_size,
+            projection=_projection(fields)):
+        yield add_avg_rating(restaurant)
+
+
+async def get_restaurants_page_async(limit: int = dbc.DEFAULT_PAGE_SIZE,
+                                     after: str = None, state: str = None,
+                                     fields: list = None) -> tuple:
+    adbc.connect_db()
+    filt = {STATE: state} if state else {}
+    restaurants, next_after = await adbc.fetch_page(
+        RESTAURANT_COLLECT, filt=filt, limit=limit, after=after,
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in restaurants], \
+        next_after
+
+
+@cache.cached_async(RESTAURANT_CACHE)
+async def search_restaurants_async(text: str, restaurant_type: str = None,
+                                   page: int = 1,
+                                   limit: int = dbc.DEFAULT_PAGE_SIZE,
+                                   fields: list = None) -> tuple:
+    filt = _search_filter(text, restaurant_type, page, limit)
+    adbc.connect_db()
+    found = await adbc.fetch_text_search(
+        RESTAURANT_COLLECT, text, filt, skip=(page - 1) * limit,
+        limit=limit + 1, score_field=SEARCH_SCORE,
+        projection=_projection(fields))
+    return _search_result(found, page, limit)
+
+
+@cache.cached_async(RESTAURANT_CACHE)
+async def query_restaurants_async(restaurant_type: str = None,
+                                  state: str = None, city: str = None,
+                                  zip_code: str = None,
+                                  min_rating: float = None,
+                                  sort: str = SORT_RATING,
+                                  limit: int = dbc.DEFAULT_PAGE_SIZE,
+                                  after: str = None,
+                                  fields: list = None) -> tuple:
+    filt, sort_field, direction = _query_spec(restaurant_type, state, city,
+                                              zip_code, min_rating, sort,
+                                              limit)
+    adbc.connect_db()
+    found, next_after = await adbc.fetch_keyset_page(
+        RESTAURANT_COLLECT, filt, sort_field, direction, limit, after,
+        projection=_projection(fields))
+    return [add_avg_rating(restaurant) for restaurant in found], next_after
@@ -3,7 +3,13 @@ import random
 This module interfaces to our user data
 """
 
+import os
+
+import data.async_db_connect as adbc
 import data.db_connect as dbc
+import data.indexes as idx
+import data.invalidation as inv
+import data.restaurants as rstr
 
 
 BIG_NUM = 10000000000000
@@ -16,8 +22,36 @@ USER_ID = "USER_ID"
 RESTAURANT_ID = "RESTAURANT_ID"
 
 MIN_CUST_NAME_LEN = 1
+MIN_RATING = 1
+MAX_RATING = 5
+VALID_RATINGS = list(range(MIN_RATING, MAX_RATING + 1))
 REVIEW_COLLECT = 'reviews'
 
+# the fields clients may ask for by name:
+FIELDS = [dbc.MONGO_ID, USER_ID, RESTAURANT_ID, REVIEW_SENTENCE, RATING]
+
+BULK_CHUNK_SIZE = int(os.environ.get('REVIEW_BULK_CHUNK_SIZE', 1000))
+BULK_RECEIVED = 'received'
+BULK_UPSERTED = 'upserted'
+BULK_MODIFIED = 'modified'
+BULK_MATCHED = 'matched'
+BULK_INVALID = 'invalid'
+BULK_INDEX = 'index'
+BULK_ERROR = 'error'
+
+# one review per user per restaurant:
+USER_RESTAURANT_INDEX = idx.register(REVIEW_COLLECT,
+                                     [(USER_ID, idx.ASCENDING),
+                                      (RESTAURANT_ID, idx.ASCENDING)],
+                                     unique=True)
+# a restaurant's and a user's reviews, newest first:
+RESTAURANT_REVIEWS_INDEX = idx.register(REVIEW_COLLECT,
+                                        [(RESTAURANT_ID, idx.ASCENDING),
+                                         (dbc.MONGO_ID, idx.DESCENDING)])
+USER_REVIEWS_INDEX = idx.register(REVIEW_COLLECT,
+                                  [(USER_ID, idx.ASCENDING),
+                                   (dbc.MONGO_ID, idx.DESCENDING)])
+
 
 def _get_test_rvw():
     rvw = 'test'
@@ -34,22 +68,113 @@ def get_test_review():
     test_rvw[REVIEW_SENTENCE] = _get_test_rvw()
     test_rvw[USER_ID] = _get_test_id()
     test_rvw[RESTAURANT_ID] = _get_test_id()
-    test_rvw[RATING] = _get_test_id()
+    test_rvw[RATING] = random.randint(MIN_RATING, MAX_RATING)
     return test_rvw
 
 
-def get_reviews() -> dict:
+def get_reviews(fields: list = None) -> dict:
+    dbc.connect_db()
+    return dbc.fetch_all_as_dict(REVIEW_SENTENCE, REVIEW_COLLECT,
+                                 projection=dbc.make_projection(fields,
+                                                                FIELDS))
+
+
+def iter_reviews(batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+                 fields: list = None):
+    """
+    Lazily yields reviews so large listings can be streamed.
+    """
+    dbc.connect_db()
+    return dbc.iter_all(REVIEW_COLLECT, batch_size=batch_size,
+                        projection=dbc.make_projection(fields, FIELDS))
+
+
+def get_reviews_page(limit: int = dbc.DEFAULT_PAGE_SIZE,
+                     after: str = None, fields: list = None) -> tuple:
+    """
+    Returns one page of reviews and the cursor for the next page.
+    """
+    dbc.connect_db()
+    return dbc.fetch_page(REVIEW_COLLECT, limit=limit, after=after,
+                          projection=dbc.make_projection(fields, FIELDS))
+
+
+def _get_reviews_newest(filt: dict, limit: int, after: str,
+                        fields: list) -> tuple:
+    if not 1 <= limit <= dbc.MAX_PAGE_SIZE:
+        raise ValueError(f'The limit must be between 1 '
+                         f'and {dbc.MAX_PAGE_SIZE}.')
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(REVIEW_SENTENCE, REVIEW_COLLECT)
+    return dbc.fetch_keyset_page(REVIEW_COLLECT, filt, dbc.MONGO_ID,
+                                 idx.DESCENDING, limit, after,
+                                 projection=dbc.make_projection(fields,
+                                                                FIELDS))
+
+
+def get_restaurant_reviews(restaurant_id: str,
+                           limit: int = dbc.DEFAULT_PAGE_SIZE,
+                           after: str = None, fields: list = None) -> tuple:
+    """
+    Returns one page of a restaurant's reviews, newest first, and the
+    cursor for the next page.
+    """
+    return _get_reviews_newest({RESTAURANT_ID: restaurant_id}, limit, after,
+                               fields)
+
+
+def get_user_reviews(user_id: str, limit: int = dbc.DEFAULT_PAGE_SIZE,
+                     after: str = None, fields: list = None) -> tuple:
+    """
+    Returns one page of a user's reviews, newest first, and the cursor
+    for the next page.
+    """
+    return _get_reviews_newest({USER_ID: user_id}, limit, after, fields)
+
+
+async def get_reviews_async(fields: list = None) -> dict:
+    adbc.connect_db()
+    return await adbc.fetch_all_as_dict(
+        REVIEW_SENTENCE, REVIEW_COLLECT,
+        projection=dbc.make_projection(fields, FIELDS))
+
+
+async def iter_reviews_async(batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+                             fields: list = None):
+    adbc.connect_db()
+    async for review in adbc.iter_filtered(
+            REVIEW_COLLECT, batch_size=batch_size,
+            projection=dbc.make_projection(fields, FIELDS)):
+        yield review
+
+
+async def get_reviews_page_async(limit: int = dbc.DEFAULT_PAGE_SIZE,
+                                 after: str = None,
+                                 fields: list = None) -> tuple:
+    adbc.connect_db()
+    return await adbc.fetch_page(REVIEW_COLLECT, limit=limit, after=after,
+                                 projection=dbc.make_projection(fields,
+                                                                FIELDS))
 
 
 def exists(user: int, rstr: int) -> bool:
     dbc.connect_db()
-    return dbc.fetch_one(REVIEW_COLLECT, {USER_ID: user, RESTAURANT_ID: rstr})
+    return dbc.doc_exists(REVIEW_COLLECT, {USER_ID: user, RESTAURANT_ID: rstr})
+
+
+def check_rating(rating) -> int:
+    """
+    Ratings are whole numbers from MIN_RATING to MAX_RATING.
+    """
+    if isinstance(rating, bool) or not isinstance(rating, int) \
+            or not MIN_RATING <= rating <= MAX_RATING:
+        raise ValueError(f'Review {RATING} must be a whole number '
+                         f'from {MIN_RATING} to {MAX_RATING}.')
+    return rating
 
 
 def add_review(user_id: int, rest_id: int, review_str: str,
                rating: int) -> bool:
+    check_rating(rating)
     reviews_in = {}
     if id in reviews_in:
         raise ValueError(f'Duplicate user id: {id=}')
@@ -61,28 +186,164 @@ def add_review(user_id: int, rest_id: int, review_str: str,
     reviews_in[RATING] = rating
 
     dbc.connect_db()
-    if not exists(user_id, rest_id):
+    try:
         _id = dbc.insert_one(REVIEW_COLLECT, reviews_in)
-    else:
+    except dbc.DuplicateKeyError:
+        # USER_RESTAURANT_INDEX is unique: no need to look before inserting
         raise ValueError('User has already reviewed this restaurant')
+    inv.record_write(REVIEW_COLLECT)
+    rstr.update_rating_aggregates(rest_id, added=rating)
     return _id is not None
 
 
+def _old_rating(review: dict) -> int:
+    """
+    The rating a review had, if it counts towards the aggregates.
+    """
+    try:
+        return check_rating(review.get(RATING))
+    except ValueError:
+        return None
+
+
 def update_review(user_id: int, rest_id: int,
                   review_str: str, rating: int) -> bool:
-    if not exists(user_id, rest_id):
-        raise ValueError('Update failure: review not in database.')
-    else:
-        dbc.connect_db()
-        return dbc.update_doc(REVIEW_COLLECT,
+    check_rating(rating)
+    dbc.connect_db()
+    old = dbc.find_and_update(REVIEW_COLLECT,
                               {USER_ID: user_id, RESTAURANT_ID: rest_id},
-                              {RATING: rating, REVIEW_SENTENCE: review_str})
+                              {RATING: rating, REVIEW_SENTENCE: review_str},
+                              projection=[RATING])
+    if old is None:
+        raise ValueError('Update failure: review not in database.')
+    inv.record_write(REVIEW_COLLECT)
+    rstr.update_rating_aggregates(rest_id, added=rating,
+                                  removed=_old_rating(old))
+    return True
 
 
 def del_review(user_id: int, rest_id: int) -> bool:
-    if not exists(user_id, rest_id):
+    dbc.connect_db()
+    old = dbc.find_and_delete(REVIEW_COLLECT,
+                              {USER_ID: user_id, RESTAURANT_ID: rest_id},
+                              projection=[RATING])
+    if old is None:
         raise ValueError('Update failure: review not in database.')
-    else:
-        dbc.connect_db()
-        return dbc.del_one(REVIEW_COLLECT,
-                           {USER_ID: user_id, RESTAURANT_ID: rest_id})
+    inv.record_write(REVIEW_COLLECT)
+    rstr.update_rating_aggregates(rest_id, removed=_old_rating(old))
+    return True
+
+
+def _check_bulk_review(row) -> dict:
+    """
+    Validates one row of a bulk import and returns the review doc.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('Each row must be a JSON object.')
+    for fld in (USER_ID, RESTAURANT_ID, REVIEW_SENTENCE):
+        if not row.get(fld):
+            raise ValueError(f'Review {fld} may not be blank.')
+    check_rating(row.get(RATING))
+    return {fld: row[fld]
+            for fld in (USER_ID, RESTAURANT_ID, REVIEW_SENTENCE, RATING)}
+
+
+def upsert_reviews_bulk(rows, chunk_size: int = BULK_CHUNK_SIZE) -> dict:
+    """
+    Imports reviews, inserting new ones and overwriting existing ones
+    by (user, restaurant), with one `bulk_write()` per chunk of rows.
+    `rows` can be any iterable, such as a generator over a request body:
+    only one chunk is held in memory at a time.
+
+    Returns:
+        dict: Counts of the rows received, upserted, modified and
+        matched, plus the index and reason for each invalid row.
+    """
+    if chunk_size < 1:
+        raise ValueError('The chunk size must be at least 1.')
+    summary = {BULK_RECEIVED: 0, BULK_UPSERTED: 0, BULK_MODIFIED: 0,
+               BULK_MATCHED: 0, BULK_INVALID: []}
+
+    def flush(chunk, indexes):
+        counts, errors = dbc.upsert_many(REVIEW_COLLECT,
+                                         [USER_ID, RESTAURANT_ID], chunk)
+        summary[BULK_UPSERTED] += counts[dbc.UPSERTED]
+        summary[BULK_MODIFIED] += counts[dbc.MODIFIED]
+        summary[BULK_MATCHED] += counts[dbc.MATCHED]
+        inv.record_write(REVIEW_COLLECT)
+        for j, err in errors.items():
+            summary[BULK_INVALID].append({BULK_INDEX: indexes[j],
+                                          BULK_ERROR: err['errmsg']})
+        # upserts may replace old ratings we never saw: recount
+        repair_rating_aggregates({doc[RESTAURANT_ID] for doc in chunk})
+
+    dbc.connect_db()
+    chunk = []
+    indexes = []
+    for i, row in enumerate(rows):
+        summary[BULK_RECEIVED] += 1
+        try:
+            chunk.append(_check_bulk_review(row))
+            indexes.append(i)
+        except ValueError as e:
+            summary[BULK_INVALID].append({BULK_INDEX: i,
+                                          BULK_ERROR: str(e)})
+        if len(chunk) >= chunk_size:
+            flush(chunk, indexes)
+            chunk = []
+            indexes = []
+    if chunk:
+        flush(chunk, indexes)
+    return summary
+
+
+def repair_rating_aggregates(restaurant_ids=None) -> int:
+    """
+    Recomputes restaurants' rating sum, count and histogram from their
+    reviews with an aggregation pipeline, fixing any drift in the
+    incrementally maintained counters.
+
+    Args:
+        restaurant_ids: The restaurants to repair; all of them if None.
+
+    Returns:
+        int: The number of restaurants updated.
+    """
+    dbc.connect_db()
+    # only the ratings `check_rating()` accepts are counted:
+    match = {RATING: {'$in': VALID_RATINGS}}
+    if restaurant_ids is not None:
+        restaurant_ids = list(restaurant_ids)
+        match[RESTAURANT_ID] = {'$in': restaurant_ids}
+    pipeline = [
+        {'$match': match},
+        # count the reviews per (restaurant, rating)...
+        {'$group': {'_id': {'restaurant': f'${RESTAURANT_ID}',
+                            'rating': f'${RATING}'},
+                    'n': {'$sum': 1}}},
+        # ...then roll those up per restaurant
+        {'$group': {'_id': '$_id.restaurant',
+                    rstr.RATING_SUM: {'$sum': {'$multiply': ['$_id.rating',
+                                                             '$n']}},
+                    rstr.RATING_COUNT: {'$sum': '$n'},
+                    rstr.RATING_HISTOGRAM: {'$push': {
+                        'k': {'$toString': '$_id.rating'},
+                        'v': '$n'}}}},
+        {'$set': {rstr.RATING_HISTOGRAM: {
+            '$arrayToObject': f'${rstr.RATING_HISTOGRAM}'}}},
+    ]
+    counted = {str(doc[dbc.MONGO_ID]): doc
+               for doc in dbc.aggregate(REVIEW_COLLECT, pipeline)}
+    if restaurant_ids is None:
+        restaurant_ids = rstr.get_restaurant_ids()
+    return rstr.set_rating_aggregates({rest_id: counted.get(str(rest_id))
+                                       for rest_id in restaurant_ids})
+
+
+def main():
+    count = repair_rating_aggregates()
+    print(f'Repaired the rating counters of {count} restaurants.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import data.autocomplete as ac
+import data.invalidation as inv
+import data.restaurants as rstr
+
+NAME = 'name'
+CITY = 'city'
+
+
+@pytest.fixture(scope='function')
+def index():
+    index = ac.PrefixIndex()
+    index.build([('1', {NAME: 'Café Rouge', CITY: 'New York'}),
+                 ('2', {NAME: 'Cafe  rouge', CITY: 'Newark'}),
+                 ('3', {NAME: 'Pho 1', CITY: None})])
+    return index
+
+
+def texts(suggestions):
+    return [s[ac.TEXT] for s in suggestions]
+
+
+def test_normalize():
+    assert ac.normalize(' Café  ROUGE ') == 'cafe rouge'
+
+
+def test_search(index):
+    assert not index.dirty
+    found = index.search('CAFE r')
+    assert found == [{ac.TEXT: 'Café Rouge', ac.KIND: NAME, ac.COUNT: 2}]
+    assert texts(index.search('new')) == ['New York', 'Newark']
+    assert index.search('zzz') == []
+
+
+def test_search_limit_and_kinds(index):
+    assert len(index.search('n', limit=1)) == 1
+    assert index.search('new', kinds=[NAME]) == []
+
+
+def test_update(index):
+    index.update('3', {NAME: 'Pho 2'})
+    assert texts(index.search('pho')) == ['Pho 2']
+    index.update('1', {CITY: 'Boston'})
+    assert texts(index.search('new')) == ['Newark']
+    # the name is untouched:
+    assert index.search('cafe')[0][ac.COUNT] == 2
+
+
+def test_remove(index):
+    index.remove('1')
+    assert index.search('cafe')[0][ac.COUNT] == 1
+    index.remove('2')
+    assert index.search('cafe') == []
+    assert len(index) == 1
+
+
+def test_writes_during_build_are_kept():
+    index = ac.PrefixIndex()
+    started = threading.Event()
+    go_on = threading.Event()
+
+    def docs():
+        started.set()
+        go_on.wait()
+        yield '1', {NAME: 'Pho 1'}
+
+    builder = threading.Thread(target=index.build, args=(docs(),))
+    builder.start()
+    started.wait()
+    # a concurrent build is a no-op:
+    assert not index.build([])
+    index.update('2', {NAME: 'Pho 2'})
+    go_on.set()
+    builder.join()
+    assert texts(index.search('pho')) == ['Pho 1', 'Pho 2']
+
+
+def test_restaurant_change_events():
+    rstr.AUTOCOMPLETE.build([])
+    rstr._autocomplete_change({
+        'operationType': 'insert',
+        'fullDocument': {'_id': rstr.MOCK_ID, rstr.NAME: 'Pho 1',
+                         rstr.CITY: 'Boston'}})
+    assert texts(rstr.AUTOCOMPLETE.search('pho')) == ['Pho 1']
+    rstr._autocomplete_change({'operationType': 'delete',
+                               'documentKey': {'_id': rstr.MOCK_ID}})
+    assert rstr.AUTOCOMPLETE.search('pho') == []
+    rstr._autocomplete_change(None)
+    assert not rstr.AUTOCOMPLETE.dirty
+    inv.publish(rstr.AUTOCOMPLETE_TOPIC)
+    assert rstr.AUTOCOMPLETE.dirty
+
+
+@patch('data.invalidation.record_write', autospec=True)
+def test_rating_writes_keep_autocomplete(mock_record):
+    rstr._written(terms_changed=False)
+    mock_record.assert_called_once_with(rstr.RESTAURANT_COLLECT)
+
+
+@patch('data.restaurants._autocomplete_rebuilt_at', None)
+@patch('data.restaurants.build_autocomplete', autospec=True)
+def test_dirty_index_rebuilt_in_background(mock_build):
+    rstr.AUTOCOMPLETE.build([('1', {NAME: 'Pho 1'})])
+    rstr.AUTOCOMPLETE.mark_dirty()
+    built = threading.Event()
+    mock_build.side_effect = lambda: built.wait(5)
+    # the search is answered from the current index, while it rebuilds:
+    assert texts(rstr.autocomplete('pho')) == ['Pho 1']
+    assert texts(rstr.autocomplete('pho')) == ['Pho 1']
+    built.set()
+    assert rstr._autocomplete_rebuild.acquire(timeout=5)
+    rstr._autocomplete_rebuild.release()
+    # one rebuild at a time:
+    mock_build.assert_called_once_with()
+
+
+@patch('data.restaurants.build_autocomplete', autospec=True)
+def test_rebuilds_rate_limited(mock_build):
+    rstr.AUTOCOMPLETE.build([('1', {NAME: 'Pho 1'})])
+    rstr.AUTOCOMPLETE.mark_dirty()
+    with patch('data.restaurants._autocomplete_rebuilt_at',
+               time.monotonic()):
+        rstr.autocomplete('pho')
+        mock_build.assert_not_called()
+        # it is rebuilt once the interval is over:
+        assert rstr.AUTOCOMPLETE.dirty
+        with patch('data.restaurants.AUTOCOMPLETE_REBUILD_SECS', 0):
+            rstr.autocomplete('pho')
+        assert rstr._autocomplete_rebuild.acquire(timeout=5)
+        rstr._autocomplete_rebuild.release()
+    mock_build.assert_called_once_with()
+
+
+@patch('data.restaurants.AUTOCOMPLETE', new_callable=ac.PrefixIndex)
+@patch('data.restaurants.build_autocomplete', autospec=True)
+def test_first_build_once(mock_build, mock_index):
+    started = threading.Event()
+    go_on = threading.Event()
+
+    def build():
+        started.set()
+        go_on.wait(5)
+        mock_index.build([('1', {NAME: 'Pho 1'})])
+
+    mock_build.side_effect = build
+    found = []
+    first = threading.Thread(target=lambda: found.append(
+        rstr.autocomplete('pho')))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: found.append(
+        rstr.autocomplete('pho')))
+    second.start()
+    go_on.set()
+    first.join(5)
+    second.join(5)
+    mock_build.assert_called_once_with()
+    assert [texts(suggestions) for suggestions in found] == [['Pho 1']] * 2
+
+
+def test_search_kinds_skips_other_kinds():
+    index = ac.PrefixIndex()
+    index.build([(str(i), {CITY: f'New {i:05}'}) for i in range(10_000)]
+                + [('name', {NAME: 'New Pho'})])
+    with patch('data.autocomplete.PrefixIndex._starting_with',
+               wraps=ac.PrefixIndex._starting_with) as mock_scan:
+        found = index.search('new', limit=1, kinds=[NAME])
+    assert texts(found) == ['New Pho']
+    # the cities were never walked:
+    assert [call.args[1] for call in mock_scan.call_args_list] == [NAME]
+
+
+def test_clear_during_build_is_kept():
+    index = ac.PrefixIndex()
+    started = threading.Event()
+    go_on = threading.Event()
+
+    def docs():
+        started.set()
+        go_on.wait()
+        yield '1', {NAME: 'Pho 1'}
+
+    builder = threading.Thread(target=index.build, args=(docs(),))
+    builder.start()
+    started.wait()
+    index.clear()
+    go_on.set()
+    builder.join()
+    assert index.search('pho') == []
+    assert len(index) == 0
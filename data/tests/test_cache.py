@@ -0,0 +1,77 @@
+from unittest.mock import patch
+
+import pytest
+
+import data.cache as cache
+import data.restaurants as rstr
+
+TEST_CACHE = 'test_cache'
+
+
+@pytest.fixture(scope='function')
+def temp_cache():
+    yield cache.TTLCache(TEST_CACHE, max_size=2, ttl=60)
+    del cache.caches[TEST_CACHE]
+
+
+def test_get_set(temp_cache):
+    assert temp_cache.get('a') == (False, None)
+    temp_cache.set('a', 1)
+    assert temp_cache.get('a') == (True, 1)
+    stats = temp_cache.stats()
+    assert stats[cache.HITS] == 1
+    assert stats[cache.MISSES] == 1
+
+
+def test_lru_eviction(temp_cache):
+    temp_cache.set('a', 1)
+    temp_cache.set('b', 2)
+    temp_cache.get('a')
+    temp_cache.set('c', 3)
+    assert temp_cache.get('b') == (False, None)
+    assert temp_cache.get('a') == (True, 1)
+
+
+def test_expiry(temp_cache):
+    temp_cache.set('a', 1)
+    with patch('time.monotonic', return_value=cache.time.monotonic() + 61):
+        assert temp_cache.get('a') == (False, None)
+
+
+def test_stale_set_after_clear(temp_cache):
+    generation = temp_cache.generation
+    temp_cache.clear()
+    temp_cache.set('a', 1, generation)
+    assert temp_cache.get('a') == (False, None)
+
+
+def test_cached(temp_cache):
+    calls = []
+
+    @cache.cached(temp_cache)
+    def double(x, fields=None):
+        calls.append(x)
+        return 2 * x
+
+    assert double(2, fields=['a']) == 4
+    assert double(2, fields=['a']) == 4
+    assert calls == [2]
+    temp_cache.clear()
+    assert double(2, fields=['a']) == 4
+    assert calls == [2, 2]
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+def test_restaurant_writes_invalidate(mock_connect):
+    rstr.RESTAURANT_CACHE.clear()
+    with patch('data.db_connect.fetch_all_filtered', return_value=[],
+               autospec=True) as mock_fetch:
+        rstr.get_restaurants_by_state('NY')
+        rstr.get_restaurants_by_state('NY')
+        assert mock_fetch.call_count == 1
+        with patch('data.db_connect.delete_all', return_value=0,
+                   autospec=True):
+            rstr.delete_all()
+        rstr.get_restaurants_by_state('NY')
+        assert mock_fetch.call_count == 2
+    rstr.RESTAURANT_CACHE.clear()
@@ -1,4 +1,8 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
 import pytest
+from bson import ObjectId
 
 import data.db_connect as dbc
 
@@ -25,3 +29,125 @@ def test_fetch_one(temp_rec):
 def test_fetch_one_not_there(temp_rec):
     ret = dbc.fetch_one(TEST_COLLECT, {TEST_NAME: 'not a field value in db!'})
     assert ret is None
+
+
+def test_iter_all(temp_rec):
+    docs = list(dbc.iter_all(TEST_COLLECT, batch_size=1))
+    assert any(doc.get(TEST_NAME) == TEST_NAME for doc in docs)
+    assert all(isinstance(doc[dbc.MONGO_ID], ObjectId) for doc in docs)
+
+
+def test_fetch_page(temp_rec):
+    docs, next_after = dbc.fetch_page(TEST_COLLECT, limit=1)
+    assert len(docs) == 1
+    if next_after is not None:
+        more, _ = dbc.fetch_page(TEST_COLLECT, limit=1, after=next_after)
+        assert more[0][dbc.MONGO_ID] > docs[0][dbc.MONGO_ID]
+        assert isinstance(next_after, str)
+
+
+def test_fetch_page_bad_cursor():
+    with pytest.raises(ValueError):
+        dbc.fetch_page(TEST_COLLECT, after='not an id')
+
+
+def test_cursor_round_trip():
+    values = ['rating_score', 3.5, '0' * 24]
+    assert dbc.decode_cursor(dbc.encode_cursor(values)) == values
+    with pytest.raises(ValueError):
+        dbc.decode_cursor('not a cursor')
+
+
+def test_after_filter_descending():
+    last_id = ObjectId()
+    filt = dbc._after_filter('score', dbc.pm.DESCENDING, 3.5, last_id)
+    # docs without a score sort last going down, so they come after:
+    assert filt == {'$or': [{'score': {'$lt': 3.5}},
+                            {'score': 3.5, '_id': {'$lt': last_id}},
+                            {'score': None}]}
+
+
+def test_after_filter_ascending_from_missing():
+    last_id = ObjectId()
+    filt = dbc._after_filter('name', dbc.pm.ASCENDING, None, last_id)
+    assert filt == {'$or': [{'name': None, '_id': {'$gt': last_id}},
+                            {'name': {'$ne': None}}]}
+
+
+def test_keyset_page_wrong_sort():
+    cursor = dbc.encode_cursor(['name', 'Pho', '0' * 24])
+    with pytest.raises(ValueError):
+        dbc.fetch_keyset_page(TEST_COLLECT, sort_field='rating_score',
+                              after=cursor)
+
+
+def test_fetch_by_ids_chunks_and_orders(monkeypatch):
+    ids = [ObjectId() for _ in range(3)]
+    docs = {oid: {'_id': oid} for oid in ids[1:]}
+    queries = []
+
+    def find(filt, projection):
+        queries.append(filt['_id']['$in'])
+        return [docs[oid] for oid in filt['_id']['$in'] if oid in docs]
+
+    client = MagicMock()
+    client.__getitem__.return_value.__getitem__.return_value.find = find
+    monkeypatch.setattr(dbc, 'client', client)
+    wanted = [str(ids[2]), 'bad id', str(ids[0]), str(ids[1]), str(ids[2])]
+    found = dbc.fetch_by_ids(TEST_COLLECT, wanted, chunk_size=2)
+    assert found == [docs[ids[2]], None, None, docs[ids[1]], docs[ids[2]]]
+    assert queries == [[ids[2], ids[0]], [ids[1]]]
+
+
+def test_client_options(monkeypatch):
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '20')
+    monkeypatch.setenv('MONGO_READ_PREFERENCE', 'secondaryPreferred')
+    opts = dbc.client_options()
+    assert opts['maxPoolSize'] == 20
+    assert opts['readPreference'] == 'secondaryPreferred'
+
+
+def test_client_options_bad_value(monkeypatch):
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', 'lots')
+    with pytest.raises(ValueError):
+        dbc.client_options()
+
+
+def test_pool_stats_counts():
+    stats = dbc.PoolStats()
+    event = SimpleNamespace(duration=0.5, reason='timeout')
+    stats.connection_created(event)
+    stats.connection_checked_out(event)
+    stats.connection_checked_out(event)
+    stats.connection_checked_in(event)
+    stats.connection_check_out_failed(event)
+    snap = stats.snapshot()
+    assert snap['connections_open'] == 1
+    assert snap['checked_out'] == 1
+    assert snap['max_checked_out'] == 2
+    assert snap['avg_checkout_wait_secs'] == 0.5
+    assert snap['checkout_failures'] == {'timeout': 1}
+
+
+def test_fetch_one_projection(temp_rec):
+    ret = dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME},
+                        projection=[dbc.MONGO_ID])
+    assert list(ret) == [dbc.MONGO_ID]
+
+
+def test_doc_exists(temp_rec):
+    assert dbc.doc_exists(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    assert not dbc.doc_exists(TEST_COLLECT, {TEST_NAME: 'not in db!'})
+
+
+def test_connect_db_leaves_indexes(monkeypatch):
+    ensure_indexes = MagicMock()
+    monkeypatch.setenv('MONGODB_URI', 'mongodb://localhost')
+    monkeypatch.setattr(dbc, 'client', None)
+    monkeypatch.setattr(dbc.pm, 'MongoClient', MagicMock())
+    monkeypatch.setattr(dbc.idx, 'ensure_indexes', ensure_indexes)
+    monkeypatch.setattr(dbc.inv, 'start', MagicMock())
+    dbc.connect_db()
+    ensure_indexes.assert_not_called()
+    dbc.connect_db(ensure_indexes=True)
+    ensure_indexes.assert_called_once_with(dbc.client[dbc.USERS_DB])
@@ -0,0 +1,45 @@
+import pytest
+
+import data.geo as geo
+import data.restaurants as rstr
+
+GAZETTEER = ('GEOID\tALAND\tAWATER\tALAND_SQMI\tAWATER_SQMI\tINTPTLAT\t'
+             'INTPTLONG                 \n'
+             '00601\t166847909\t799292\t64.42\t0.31\t18.180555\t'
+             '-66.749961               \n')
+
+
+def test_bundled_centroids():
+    centroids = geo.load_centroids(geo.DEFAULT_CENTROIDS_FILE)
+    lat, lon = centroids['10012']
+    assert 40 < lat < 41 and -75 < lon < -73
+
+
+def test_gazetteer_centroids(tmp_path):
+    path = tmp_path / 'gazetteer.txt'
+    path.write_text(GAZETTEER)
+    assert geo.load_centroids(path) == {'00601': (18.180555, -66.749961)}
+
+
+def test_locate_zip():
+    location = geo.locate_zip('10012-1234')
+    assert location['type'] == geo.POINT
+    lon, lat = location['coordinates']
+    assert (lat, lon) == geo.centroids()['10012']
+    assert geo.locate_zip('99999') is None
+    assert geo.locate_zip(None) is None
+
+
+@pytest.mark.parametrize('lat, lon', [(91, 0), (0, -181)])
+def test_point_bad(lat, lon):
+    with pytest.raises(ValueError):
+        geo.point(lat, lon)
+
+
+def test_new_restaurant_located():
+    doc = rstr._make_restaurant('Pho 1', 'Vietnamese', 'Noodles',
+                                '1 Bleecker St', 'New York', 'NY', '10012')
+    assert doc[rstr.LOCATION] == geo.locate_zip('10012')
+    doc = rstr._make_restaurant('Pho 1', 'Vietnamese', 'Noodles',
+                                '1 Main St', 'Nowhere', 'NY', '99999')
+    assert rstr.LOCATION not in doc
@@ -0,0 +1,108 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+import data.indexes as idx
+import data.restaurants as rstr
+import data.reviews as rvws
+import data.users as usrs
+
+TEST_COLLECT = 'test_collect'
+TEST_KEYS = [('a', idx.ASCENDING), ('b', idx.DESCENDING)]
+
+
+@pytest.fixture(scope='function')
+def temp_index():
+    name = idx.register(TEST_COLLECT, TEST_KEYS, unique=True)
+    yield name
+    del idx.registry[TEST_COLLECT]
+    idx._ensured.clear()
+
+
+def test_register(temp_index):
+    assert temp_index == 'a_1_b_-1'
+    spec = idx.registry[TEST_COLLECT][temp_index]
+    assert spec[idx.UNIQUE]
+
+
+def test_modules_register_indexes():
+    assert usrs.EMAIL_INDEX in idx.registry[usrs.USERS_COLLECT]
+    assert rvws.USER_RESTAURANT_INDEX in idx.registry[rvws.REVIEW_COLLECT]
+    assert rstr.STATE_INDEX in idx.registry[rstr.RESTAURANT_COLLECT]
+
+
+def test_ensure_indexes_once(temp_index):
+    database = MagicMock()
+    idx.ensure_indexes(database)
+    calls = database.__getitem__.return_value.create_index.call_count
+    assert calls == sum(len(specs) for specs in idx.registry.values())
+    idx.ensure_indexes(database)
+    assert (database.__getitem__.return_value.create_index.call_count
+            == calls)
+
+
+def test_ensure_text_index_weights():
+    database = MagicMock()
+    idx.ensure_indexes(database)
+    create_index = database.__getitem__.return_value.create_index
+    weights = [call.kwargs[idx.WEIGHTS] for call in create_index.call_args_list
+               if call.kwargs['name'] == rstr.TEXT_INDEX]
+    assert weights == [{rstr.NAME: 5, rstr.DESCRIPTION: 1}]
+    idx._ensured.clear()
+
+
+def test_missing_indexes(temp_index):
+    specs = list(idx.registry[TEST_COLLECT].values())
+    assert idx.missing_indexes(specs, {}) == [temp_index]
+    same_keys = {'other_name': {'key': TEST_KEYS}}
+    assert idx.missing_indexes(specs, same_keys) == []
+
+
+def test_unused_indexes():
+    stats = [
+        {idx.NAME: idx.MONGO_ID_INDEX, 'accesses': {'ops': 0}},
+        {idx.NAME: 'used', 'accesses': {'ops': 5}},
+        {idx.NAME: 'unused', 'accesses': {'ops': 0}},
+    ]
+    assert idx.unused_indexes(stats) == ['unused']
+
+
+def keyset_index_keys(equality_fields, sort):
+    sort_field, direction = rstr.SORTS[sort]
+    return ([(fld, idx.ASCENDING) for fld in equality_fields]
+            + [(sort_field, direction), ('_id', direction)])
+
+
+@pytest.mark.parametrize('equality_fields, sort', [
+    ((), rstr.SORT_RATING),
+    ((rstr.STATE,), rstr.SORT_RATING),
+    ((rstr.RESTAURANT_TYPE,), rstr.SORT_RATING),
+    ((rstr.CITY,), rstr.SORT_RATING),
+    ((rstr.ZIP_CODE,), rstr.SORT_RATING),
+    ((rstr.STATE, rstr.RESTAURANT_TYPE), rstr.SORT_RATING),
+    ((), rstr.SORT_NAME),
+])
+def test_keyset_sorts_have_indexes(equality_fields, sort):
+    """
+    The keyset pages of `query_restaurants()` sort on the sort field
+    then the `_id`: an index with the equality filters first, then
+    those, returns a page without an in-memory sort.
+    """
+    keys = [spec[idx.KEYS]
+            for spec in idx.registry[rstr.RESTAURANT_COLLECT].values()]
+    assert keyset_index_keys(equality_fields, sort) in keys
+
+
+def test_state_pages_have_index():
+    """
+    `get_restaurants_page()` in a state filters on the state and sorts
+    on the `_id`, like `fetch_page()`: without an index on both, every
+    page sorts all the state's restaurants in memory.
+    """
+    page_keys = [(rstr.STATE, idx.ASCENDING), ('_id', idx.ASCENDING)]
+    wanted = [{idx.NAME: 'state_page', idx.KEYS: page_keys}]
+    registered = {name: {'key': spec[idx.KEYS]} for name, spec
+                  in idx.registry[rstr.RESTAURANT_COLLECT].items()}
+    assert idx.missing_indexes(wanted, registered) == []
+    del registered[rstr.STATE_PAGE_INDEX]
+    assert idx.missing_indexes(wanted, registered) == ['state_page']
@@ -0,0 +1,133 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import data.invalidation as inv
+import data.restaurants as rstr
+
+TEST_COLLECT = 'test_collect'
+
+
+@pytest.fixture(scope='function')
+def temp_subscriber():
+    changes = []
+    inv.subscribe(TEST_COLLECT, changes.append)
+    yield changes
+    del inv.subscribers[TEST_COLLECT]
+
+
+def versions_db(version):
+    database = MagicMock()
+    database[inv.VERSIONS_COLLECT].find.return_value = [
+        {inv.MONGO_ID: TEST_COLLECT, inv.VERSION: version}]
+    return database
+
+
+def test_publish(temp_subscriber):
+    change = {'operationType': 'insert'}
+    inv.publish(TEST_COLLECT, change)
+    assert temp_subscriber == [change]
+
+
+def test_restaurant_cache_subscribed():
+    rstr.RESTAURANT_CACHE.set('key', 'value')
+    inv.publish(rstr.RESTAURANT_COLLECT)
+    assert rstr.RESTAURANT_CACHE.get('key') == (False, None)
+
+
+def test_poll_once(temp_subscriber):
+    versions = {TEST_COLLECT: 1}
+    inv.poll_once(versions_db(1), versions)
+    assert temp_subscriber == []
+    inv.poll_once(versions_db(2), versions)
+    assert temp_subscriber == [None]
+    assert versions[TEST_COLLECT] == 2
+
+
+def test_poll_once_first_write(temp_subscriber):
+    inv.poll_once(versions_db(1), {})
+    assert temp_subscriber == [None]
+
+
+@pytest.fixture(scope='function')
+def versions():
+    saved = dict(inv.versions)
+    inv.versions.clear()
+    yield inv.versions
+    inv.versions.clear()
+    inv.versions.update(saved)
+
+
+def bumping_db(version):
+    database = MagicMock()
+    database[inv.VERSIONS_COLLECT].find_one_and_update.return_value = {
+        inv.MONGO_ID: TEST_COLLECT, inv.VERSION: version}
+    return database
+
+
+@pytest.mark.parametrize('mode', [inv.POLL, inv.CHANGE_STREAM,
+                                  # a write before the mode is known:
+                                  None])
+def test_record_write(mode, versions):
+    database = bumping_db(7)
+    with patch('data.invalidation.mode', mode), \
+            patch('data.invalidation._database', database):
+        inv.record_write(TEST_COLLECT)
+        assert inv.version(TEST_COLLECT) == 7
+    database[inv.VERSIONS_COLLECT].find_one_and_update.assert_called_once()
+
+
+def test_version_unknown_when_not_started():
+    with patch('data.invalidation._database', None):
+        inv.record_write(TEST_COLLECT)
+        assert inv.version(TEST_COLLECT) is None
+
+
+def test_poll_once_tracks_versions(versions):
+    inv.poll_once(versions_db(4), {})
+    assert versions[TEST_COLLECT] == 4
+    # versions only go up:
+    inv.poll_once(versions_db(3), {})
+    assert versions[TEST_COLLECT] == 4
+
+
+def test_falls_back_to_polling(temp_subscriber):
+    database = MagicMock()
+    database.watch.side_effect = OperationFailure(
+        'not a replica set', code=inv.CHANGE_STREAM_UNSUPPORTED[0])
+
+    def stop_polling(database):
+        assert inv.mode == inv.POLL
+        inv._stop.set()
+
+    with patch('data.invalidation._poll', side_effect=stop_polling):
+        inv._run(database)
+    inv._stop.clear()
+    inv._forget()
+
+
+def test_failing_subscriber_isolated(temp_subscriber):
+    def fail(change):
+        raise KeyError('documentKey')
+
+    inv.subscribers[TEST_COLLECT].insert(0, fail)
+    first = {'operationType': 'delete'}
+    second = {'operationType': 'insert'}
+    inv.publish(TEST_COLLECT, first)
+    inv.publish(TEST_COLLECT, second)
+    assert temp_subscriber == [first, second]
+
+
+def test_stop_waits_for_thread():
+    database = MagicMock()
+    database.watch.side_effect = OperationFailure('down')
+    with patch('data.invalidation.ENABLED', True), \
+            patch('data.invalidation.RETRY_SECS', 0.01):
+        inv.start(database)
+        thread = inv._thread
+        inv.stop()
+    assert not thread.is_alive()
+    assert inv.version(TEST_COLLECT) is None
+    inv._stop.clear()
+    inv._forget()
@@ -0,0 +1,39 @@
+import data.loader as loader
+
+
+def fake_batch(calls):
+    def batch_fn(ids):
+        calls.append(list(ids))
+        return [{'id': doc_id} if doc_id != 'missing' else None
+                for doc_id in ids]
+    return batch_fn
+
+
+def test_wanted_ids_load_in_one_batch():
+    calls = []
+    batch = loader.BatchLoader(fake_batch(calls))
+    batch.want(['a', 'b', 'a'])
+    batch.want(['c'])
+    assert batch.load('b') == {'id': 'b'}
+    assert batch.load('c') == {'id': 'c'}
+    assert calls == [['a', 'b', 'c']]
+
+
+def test_docs_are_fetched_once():
+    calls = []
+    batch = loader.BatchLoader(fake_batch(calls))
+    assert batch.load_many(['a', 'missing']) == [{'id': 'a'}, None]
+    found = batch.load_many(['missing', 'b', 'a'])
+    assert found == [None, {'id': 'b'}, {'id': 'a'}]
+    assert calls == [['a', 'missing'], ['b']]
+    assert batch.batches == 2
+
+
+def test_prime_and_clear():
+    calls = []
+    batch = loader.BatchLoader(fake_batch(calls))
+    batch.prime('a', {'id': 'primed'})
+    assert batch.load('a') == {'id': 'primed'}
+    batch.clear('a')
+    assert batch.load('a') == {'id': 'a'}
+    assert calls == [['a']]
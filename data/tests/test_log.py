@@ -0,0 +1,64 @@
+import json
+import logging
+import queue
+import sys
+
+import data.log as log
+
+
+def make_record(level=logging.INFO, msg='hello %s', args=('world',),
+                **extra):
+    record = logging.makeLogRecord({'name': 'data.test', 'levelno': level,
+                                    'levelname': logging.getLevelName(level),
+                                    'msg': msg, 'args': args})
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter():
+    record = make_record(request_id='abc', seconds=0.5)
+    doc = json.loads(log.JSONFormatter().format(record))
+    assert doc['message'] == 'hello world'
+    assert doc['level'] == 'INFO'
+    assert doc['logger'] == 'data.test'
+    assert doc['request_id'] == 'abc'
+    assert doc['seconds'] == 0.5
+
+
+def test_filter_tags_request_id():
+    token = log.request_id.set('req-1')
+    try:
+        record = make_record()
+        assert log.ContextFilter().filter(record)
+        assert record.request_id == 'req-1'
+    finally:
+        log.request_id.reset(token)
+
+
+def test_filter_samples_debug():
+    filt = log.ContextFilter()
+    assert not filt.filter(make_record(logging.DEBUG,
+                                       **{log.SAMPLE_RATE: 0}))
+    assert filt.filter(make_record(logging.DEBUG, **{log.SAMPLE_RATE: 1}))
+    assert filt.filter(make_record(logging.WARNING, **{log.SAMPLE_RATE: 0}))
+
+
+def test_queue_handler_drops_when_full():
+    handler = log.DroppingQueueHandler(queue.Queue(1))
+    before = log.dropped
+    handler.handle(make_record())
+    handler.handle(make_record())
+    assert log.dropped == before + 1
+
+
+def test_queue_handler_keeps_exceptions():
+    records = queue.Queue()
+    handler = log.DroppingQueueHandler(records)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = make_record()
+        record.exc_info = sys.exc_info()
+    handler.handle(record)
+    doc = json.loads(log.JSONFormatter().format(records.get_nowait()))
+    assert 'ValueError: boom' in doc['exc']
@@ -0,0 +1,118 @@
+import asyncio
+import os
+from unittest.mock import patch
+
+import pytest
+
+import data.metrics as metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_timed_db_counts_docs():
+    @metrics.timed_db
+    def fetch_things():
+        return [{}, {}, {}]
+
+    assert fetch_things() == [{}, {}, {}]
+    histograms, counters = metrics.collect()
+    labels = (('op', 'fetch_things'),)
+    assert sum(histograms[(metrics.DB, labels)][:-1]) == 1
+    assert counters[('db_documents', labels)] == 3
+
+
+def test_timed_db_records_failures():
+    @metrics.timed_db
+    def broken():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        broken()
+    histograms, _ = metrics.collect()
+    assert sum(histograms[(metrics.DB, (('op', 'broken'),))][:-1]) == 1
+
+
+def test_render_histogram():
+    metrics.observe(metrics.DB, (('op', 'fetch_one'),), .003)
+    metrics.observe(metrics.DB, (('op', 'fetch_one'),), 20)
+    text = metrics.render()
+    assert 'app_db_duration_seconds_bucket{op="fetch_one",le="0.0025"} 0' \
+        in text
+    assert 'app_db_duration_seconds_bucket{op="fetch_one",le="0.005"} 1' \
+        in text
+    assert 'app_db_duration_seconds_bucket{op="fetch_one",le="+Inf"} 2' \
+        in text
+    assert 'app_db_duration_seconds_count{op="fetch_one"} 2' in text
+
+
+def test_render_escapes_labels():
+    metrics.inc('http_response_bytes', (('endpoint', 'a"b'),), 10)
+    assert 'app_http_response_bytes_total{endpoint="a\\"b"} 10' \
+        in metrics.render()
+
+
+def test_workers_add_up(tmp_path):
+    with patch('data.metrics.METRICS_DIR', str(tmp_path)):
+        metrics.inc('db_documents', (('op', 'fetch_one'),), 2)
+        # another worker's file:
+        (tmp_path / f'worker-{os.getppid()}.json').write_text(
+            '{"histograms": [], '
+            '"counters": [["db_documents", [["op", "fetch_one"]], 5]]}')
+        _, counters = metrics.collect()
+    assert counters[('db_documents', (('op', 'fetch_one'),))] == 7
+
+
+def test_timed_db_custom_count():
+    @metrics.timed_db(count=len)
+    def fetch_as_dict():
+        return {'a': {}, 'b': {}}
+
+    @metrics.timed_db(count=metrics.count_found)
+    def fetch_by_ids():
+        return [{}, None, {}]
+
+    fetch_as_dict()
+    fetch_by_ids()
+    _, counters = metrics.collect()
+    assert counters[('db_documents', (('op', 'fetch_as_dict'),))] == 2
+    assert counters[('db_documents', (('op', 'fetch_by_ids'),))] == 2
+
+
+def test_timed_db_async():
+    @metrics.timed_db
+    async def fetch_things():
+        return [{}, {}]
+
+    assert asyncio.run(fetch_things()) == [{}, {}]
+    histograms, counters = metrics.collect()
+    labels = (('op', 'fetch_things_async'),)
+    assert sum(histograms[(metrics.DB, labels)][:-1]) == 1
+    assert counters[('db_documents', labels)] == 2
+
+
+def test_dead_workers_skipped(tmp_path):
+    dead = tmp_path / 'worker-4242.json'
+    dead.write_text('{"histograms": [], '
+                    '"counters": [["db_documents", [["op", "gone"]], 5]]}')
+    with patch('data.metrics.METRICS_DIR', str(tmp_path)), \
+            patch('data.metrics._alive', side_effect=lambda pid: pid != 4242):
+        _, counters = metrics.collect()
+    assert ('db_documents', (('op', 'gone'),)) not in counters
+    assert not dead.exists()
+
+
+def test_remove_worker(tmp_path):
+    with patch('data.metrics.METRICS_DIR', str(tmp_path)):
+        metrics.flush()
+        metrics.remove_worker(os.getpid())
+        metrics.remove_worker(os.getpid())  # already gone
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_alive():
+    assert metrics._alive(os.getpid())
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import data.profiler as prof
+
+EXPLAINED = {
+    'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}},
+    'executionStats': {'nReturned': 2, 'totalDocsExamined': 5000,
+                       'totalKeysExamined': 0},
+}
+
+
+def event(request_id, command=None, duration_micros=0):
+    return SimpleNamespace(command_name='find', command=command,
+                           connection_id=('localhost', 27017),
+                           request_id=request_id, database_name='db',
+                           duration_micros=duration_micros)
+
+
+def test_shape():
+    filt = {'state': 'NY', 'rating': {'$gte': 4},
+            '$or': [{'city': 'A'}, {'zip': '1'}], 'type': {'$in': [1, 2]}}
+    assert prof.shape(filt) == {
+        'state': prof.BLANK, 'rating': {'$gte': prof.BLANK},
+        '$or': [{'city': prof.BLANK}, {'zip': prof.BLANK}],
+        'type': {'$in': [prof.BLANK]},
+    }
+
+
+def test_plan_summary():
+    summary = prof.plan_summary(EXPLAINED)
+    assert summary[prof.COLLSCAN]
+    assert summary[prof.DOCS_EXAMINED] == 5000
+    assert summary[prof.RETURNED] == 2
+    nested = {'stage': 'FETCH',
+              'inputStage': {'stage': 'IXSCAN', 'indexName': 'state_1'}}
+    summary = prof.plan_summary({'queryPlanner': {'winningPlan': nested}})
+    assert summary[prof.STAGES] == ['FETCH', 'IXSCAN']
+    assert summary[prof.INDEXES] == ['state_1']
+    assert not summary[prof.COLLSCAN]
+
+
+def test_profiler_groups_by_shape():
+    profiler = prof.QueryProfiler(lambda: None, slow_ms=1000)
+    for i, state in enumerate(['NY', 'CT']):
+        profiler.started(event(i, {'find': 'restaurants',
+                                   'filter': {'state': state}}))
+        profiler.succeeded(event(i, duration_micros=2000 * (i + 1)))
+    [query] = profiler.top()
+    assert query[prof.COLLECTION] == 'restaurants'
+    assert query[prof.SHAPE] == {'state': prof.BLANK}
+    assert query[prof.COUNT] == 2
+    assert query[prof.MAX_MS] == 4
+    assert query[prof.AVG_MS] == 3
+
+
+def test_profiler_explains_slow_queries():
+    client = MagicMock()
+    client.__getitem__.return_value.command.return_value = EXPLAINED
+    profiler = prof.QueryProfiler(lambda: client, slow_ms=1)
+    # explain in this thread instead:
+    profiler._start_explainer = lambda: None
+    command = {'find': 'restaurants', 'filter': {'state': 'NY'},
+               'lsid': {'id': 1}}
+    profiler.started(event(1, command))
+    profiler.succeeded(event(1, duration_micros=5000))
+    profiler.explain(*profiler.explain_queue.get(timeout=1))
+    explain = client.__getitem__.return_value.command.call_args.args[0]
+    assert 'lsid' not in explain['explain']
+    [query] = profiler.top()
+    assert query[prof.PLAN][prof.COLLSCAN]
@@ -1,5 +1,6 @@
 import server.endpoints as ep
 import pytest
+import data.restaurants as rstr
 import data.reviews as rvws
 from http.client import (
     BAD_REQUEST,
@@ -42,3 +43,79 @@ def test_review_add_rvws_failure(mock_add):
     """
     resp = TEST_CLIENT.post(ep.REVIEWS_EP, json=rvws.get_test_review())
     assert resp.status_code == SERVICE_UNAVAILABLE
+
+
+@pytest.mark.parametrize('rating', [0, 6, 4.5, '4', True, None])
+def test_check_rating_bad(rating):
+    with pytest.raises(ValueError):
+        rvws.check_rating(rating)
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.update_with_pipeline', autospec=True)
+def test_update_rating_aggregates_changed(mock_update, mock_connect):
+    rstr.update_rating_aggregates(rstr.MOCK_ID, added=5, removed=3)
+    counters, score = mock_update.call_args.args[2]
+    assert set(counters['$set']) == {rstr.RATING_SUM,
+                                     f'{rstr.RATING_HISTOGRAM}.5',
+                                     f'{rstr.RATING_HISTOGRAM}.3'}
+    assert counters['$set'][rstr.RATING_SUM]['$add'][1] == 2
+    assert score['$set'] == {rstr.RATING_SCORE: rstr.RATING_SCORE_EXPR,
+                             rstr.AVG_RATING: rstr.AVG_RATING_EXPR}
+
+
+@patch('data.db_connect.update_with_pipeline', autospec=True)
+def test_update_rating_aggregates_unchanged(mock_update):
+    rstr.update_rating_aggregates(rstr.MOCK_ID, added=4, removed=4)
+    mock_update.assert_not_called()
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.find_and_delete', return_value={rvws.RATING: 2},
+       autospec=True)
+@patch('data.restaurants.update_rating_aggregates', autospec=True)
+def test_del_review_updates_aggregates(mock_agg, mock_del, mock_connect):
+    rvws.del_review('u', rstr.MOCK_ID)
+    mock_agg.assert_called_once_with(rstr.MOCK_ID, removed=2)
+
+
+def test_add_avg_rating():
+    restaurant = {rstr.RATING_SUM: 9, rstr.RATING_COUNT: 2}
+    assert rstr.add_avg_rating(restaurant)[rstr.AVG_RATING] == 4.5
+    restaurant = {rstr.RATING_SUM: 0, rstr.RATING_COUNT: 0}
+    assert rstr.add_avg_rating(restaurant)[rstr.AVG_RATING] is None
+
+
+def test_rating_score():
+    assert rstr.rating_score(0, 0) == rstr.PRIOR_MEAN
+    # one 5-star review shouldn't beat many 4.5-star ones:
+    assert rstr.rating_score(5, 1) < rstr.rating_score(450, 100)
+
+
+@patch('data.restaurants.set_rating_aggregates', return_value=1,
+       autospec=True)
+@patch('data.db_connect.aggregate', return_value=[], autospec=True)
+@patch('data.db_connect.connect_db', autospec=True)
+def test_repair_skips_invalid_ratings(mock_connect, mock_aggregate,
+                                      mock_set):
+    rvws.repair_rating_aggregates([rstr.MOCK_ID])
+    pipeline = mock_aggregate.call_args.args[1]
+    counted = pipeline[0]['$match'][rvws.RATING]['$in']
+    for stored in [0, 4.5, 7, -1, '5']:
+        with pytest.raises(ValueError):
+            rvws.check_rating(stored)
+        assert stored not in counted
+    for stored in counted:
+        assert rvws.check_rating(stored) == stored
+
+
+@patch('data.reviews.exists', autospec=True)
+@patch('data.db_connect.insert_one', autospec=True,
+       side_effect=rvws.dbc.DuplicateKeyError('dup'))
+@patch('data.db_connect.connect_db', autospec=True)
+def test_add_review_duplicate(mock_connect, mock_insert, mock_exists):
+    with pytest.raises(ValueError):
+        rvws.add_review('user', rstr.MOCK_ID, 'Again', 4)
+    # the unique index decides, in the one round-trip:
+    mock_insert.assert_called_once()
+    mock_exists.assert_not_called()
@@ -80,3 +80,27 @@ def test_user_add_failure(mock_add):
     """
     resp = TEST_CLIENT.post(ep.USERS_EP, json=usrs.get_test_user())
     assert resp.status_code == SERVICE_UNAVAILABLE
+
+
+@pytest.mark.parametrize('func, fetch', [
+    (usrs.get_users, 'data.db_connect.fetch_all_as_dict'),
+    (usrs.iter_users, 'data.db_connect.iter_all'),
+    (usrs.get_users_page, 'data.db_connect.fetch_page'),
+])
+@patch('data.db_connect.connect_db', autospec=True)
+def test_users_default_to_public_fields(mock_connect, func, fetch):
+    with patch(fetch) as mock_fetch:
+        func()
+    assert mock_fetch.call_args.kwargs['projection'] == usrs.PUBLIC_FIELDS
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+def test_update_email_duplicate(mock_connect):
+    with patch('data.db_connect.update_doc',
+               side_effect=usrs.dbc.DuplicateKeyError('dup')):
+        with pytest.raises(ValueError):
+            usrs.update_email('0' * 24, 'taken@example.com')
+
+
+def test_update_email_bad_id():
+    assert not usrs.update_email('nope', 'new@example.com')
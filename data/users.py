@@ -4,6 +4,7 @@ This module interfaces to our user data
 """
 
 import data.db_connect as dbc
+import data.indexes as idx
 import re
 
 from bson import ObjectId
@@ -32,6 +33,12 @@ USERS_COLLECT = 'users'
 NAME = 'not'
 USER_NAME = 'not'
 
+# the fields clients may ask for by name (never the password):
+PUBLIC_FIELDS = [USER_ID, FIRST_NAME, LAST_NAME, EMAIL, RESTAURANT_IDS]
+
+EMAIL_INDEX = idx.register(USERS_COLLECT, [(EMAIL, idx.ASCENDING)],
+                           unique=True)
+
 # def get_users() -> dict:
 #     dbc.connect_db()
 #     return dbc.fetch_all_as_dict(USERNAME, USERS_COLLECT)
@@ -53,9 +60,48 @@ def get_test_user():
     return test_user
 
 
-def get_users() -> dict:
+def get_users(fields: list = None) -> dict:
+    """
+    All users, keyed by email. Without fields, the PUBLIC_FIELDS: a
+    password never leaves the users collection.
+    """
+    dbc.connect_db()
+    return dbc.fetch_all_as_dict(EMAIL, USERS_COLLECT,
+                                 projection=dbc.make_projection(
+                                     fields or PUBLIC_FIELDS, PUBLIC_FIELDS))
+
+
+def iter_users(batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+               fields: list = None):
+    """
+    Lazily yields users so large listings can be streamed.
+    """
+    dbc.connect_db()
+    return dbc.iter_all(USERS_COLLECT, batch_size=batch_size,
+                        projection=dbc.make_projection(
+                            fields or PUBLIC_FIELDS, PUBLIC_FIELDS))
+
+
+def get_users_page(limit: int = dbc.DEFAULT_PAGE_SIZE,
+                   after: str = None, fields: list = None) -> tuple:
+    """
+    Returns one page of users and the cursor for the next page.
+    """
+    dbc.connect_db()
+    return dbc.fetch_page(USERS_COLLECT, limit=limit, after=after,
+                          projection=dbc.make_projection(
+                              fields or PUBLIC_FIELDS, PUBLIC_FIELDS))
+
+
+def get_users_by_ids(ids: list, fields: list = None) -> list:
+    """
+    Fetches many users by ID in one query (per chunk of IDs).
+    Returns them in the order of ids, with None for unknown IDs.
+    """
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(EMAIL, USERS_COLLECT)
+    return dbc.fetch_by_ids(USERS_COLLECT, ids,
+                            projection=dbc.make_projection(
+                                fields or PUBLIC_FIELDS, PUBLIC_FIELDS))
 
 
 def extract_id(s):
@@ -74,12 +120,16 @@ def _gen_id() -> str:
 
 def exists(email: str) -> bool:
     dbc.connect_db()
-    return dbc.fetch_one(USERS_COLLECT, {EMAIL: email})
+    return dbc.doc_exists(USERS_COLLECT, {EMAIL: email})
 
 
 def id_exists(user_id: str) -> bool:
+    try:
+        _id = dbc.to_object_id(user_id)
+    except ValueError:
+        return False
     dbc.connect_db()
-    return dbc.fetch_one(USERS_COLLECT, {USER_ID: ObjectId(user_id)})
+    return dbc.doc_exists(USERS_COLLECT, {USER_ID: _id})
 
 
 def add_user(first_name: str, last_name: str,
@@ -106,21 +156,34 @@ def add_user(first_name: str, last_name: str,
     users[RESTAURANT_IDS] = []
 
     dbc.connect_db()
-    _id = dbc.insert_one(USERS_COLLECT, users)
+    try:
+        _id = dbc.insert_one(USERS_COLLECT, users)
+    except dbc.DuplicateKeyError:
+        raise ValueError('A user with this email already exists.')
     return extract_id(str(_id))
 
 
 def del_user(user_id: str):
-    if not id_exists(user_id):
+    dbc.connect_db()
+    result = dbc.del_one(USERS_COLLECT, {USER_ID: dbc.to_object_id(user_id)})
+    if result.deleted_count == 0:
         raise ValueError(f'Delete failure: {user_id} not in database.')
-    else:
-        dbc.connect_db()
-        return dbc.del_one(USERS_COLLECT, {USER_ID: ObjectId(user_id)})
+    return result
 
 
 def update_email(user_id: str, new_email: str) -> bool:
-    if not id_exists(user_id):
-        raise ValueError(f'Update failure: {user_id} not in database.')
+    """
+    Returns False if there is no such user, and raises ValueError if
+    another user has new_email.
+    """
+    try:
+        _id = dbc.to_object_id(user_id)
+    except ValueError:
+        return False
     dbc.connect_db()
-    return dbc.update_doc(USERS_COLLECT, {"_id": ObjectId(user_id)},
-                          {EMAIL: new_email})
+    try:
+        result = dbc.update_doc(USERS_COLLECT, {"_id": _id},
+                                {EMAIL: new_email})
+    except dbc.DuplicateKeyError:
+        raise ValueError('A user with this email already exists.')
+    return result.matched_count > 0
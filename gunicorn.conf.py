@@ -0,0 +1,55 @@
+"""
+gunicorn settings, read automatically when gunicorn starts in this
+directory (see the Procfile).
+"""
+import os
+import tempfile
+import threading
+
+AUTOCOMPLETE_WARM = os.environ.get('AUTOCOMPLETE_WARM', '1') == '1'
+# create the indexes in the master, once, before any worker serves:
+ENSURE_INDEXES = os.environ.get('ENSURE_INDEXES', '1') == '1'
+# where the workers share their metrics; set before the app is imported:
+os.environ.setdefault('METRICS_DIR',
+                      os.path.join(tempfile.gettempdir(), 'app-metrics'))
+
+
+def on_starting(server):
+    """
+    Forget the metrics of the previous run, and create any missing
+    indexes.
+    """
+    import data.metrics as metrics
+    metrics.clear_dir()
+    if ENSURE_INDEXES:
+        import data.indexes as idx
+        try:
+            idx.create_all()
+        except Exception as e:
+            # serve without them rather than not at all:
+            server.log.warning(f'Could not create the indexes: {e}')
+
+
+def child_exit(server, worker):
+    """
+    Drop the metrics of a worker that exited, so /metrics stops adding
+    them up.
+    """
+    import data.metrics as metrics
+    metrics.remove_worker(worker.pid)
+
+
+def post_fork(server, worker):
+    """
+    Build each worker's in-memory indexes in the background as it
+    starts, so the first requests don't pay for it, start its log
+    writer and start sharing its metrics with the other workers.
+    """
+    import data.log as log
+    import data.metrics as metrics
+    log.setup()
+    metrics.start_flusher()
+    if AUTOCOMPLETE_WARM:
+        import data.restaurants as rstr
+        threading.Thread(target=rstr.ensure_autocomplete,
+                         name='autocomplete-warm', daemon=True).start()
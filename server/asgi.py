@@ -0,0 +1,205 @@
+"""
+An asyncio (ASGI) server mode for the hot read endpoints:
+`/restaurants`, `/restaurants/search` and `/reviews`. Mongo I/O is
+awaited instead of blocking a worker, so one process can serve
+thousands of concurrent slow clients. Run it beside the Flask app,
+e.g. behind the same proxy:
+    uvicorn server.asgi:app --workers 4
+Parameters, validation, response keys and errors are those of
+`server.endpoints`. Responses aren't compressed and carry no ETags:
+leave those to the proxy in this mode.
+"""
+from http import HTTPStatus
+import asyncio
+from urllib.parse import parse_qsl
+
+import werkzeug.exceptions as wz
+
+import data.async_db_connect as adbc
+import data.db_connect as dbc
+import data.log as log
+import data.restaurants as restaurants
+import data.reviews as rvws
+import server.endpoints as ep
+import server.fast_json as fast_json
+
+JSON_HEADERS = [(b'content-type', fast_json.MIMETYPE.encode())]
+MESSAGE = 'message'
+
+
+class Stream:
+    """
+    A handler result to send as a chunked JSON array: docs is an async
+    iterable of docs.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+
+
+async def get_restaurants(args: dict):
+    state = args.get('state')
+    fields = ep.fields_arg(restaurants.FIELDS, args)
+    if ep.wants_stream(args):
+        return Stream(restaurants.iter_restaurants_async(state,
+                                                         fields=fields))
+    page = ep.page_args(args)
+    title = f'Restaurants in {state}' if state else 'Current Restaurants'
+    if page:
+        found, next_after = await restaurants.get_restaurants_page_async(
+            *page, state=state, fields=fields)
+        return {ep.TYPE: ep.DATA, ep.TITLE: title, ep.DATA: found,
+                ep.NEXT: next_after}
+    if state:
+        found = await restaurants.get_restaurants_by_state_async(state,
+                                                                 fields)
+    else:
+        found = await restaurants.get_restaurants_async(fields)
+    return {ep.TYPE: ep.DATA, ep.TITLE: title, ep.DATA: found}
+
+
+async def search_restaurants(args: dict):
+    text = args.get(ep.SEARCH_TEXT)
+    restaurant_type = args.get('restaurant_type')
+    fields = ep.fields_arg(restaurants.FIELDS, args)
+    if text is not None:
+        page = int(args.get(ep.PAGE, 1))
+        limit = int(args.get(ep.LIMIT, dbc.DEFAULT_PAGE_SIZE))
+        found, next_page = await restaurants.search_restaurants_async(
+            text, restaurant_type, page, limit, fields)
+        return {ep.TYPE: ep.DATA, ep.TITLE: f'Restaurants matching {text}',
+                ep.DATA: found, ep.NEXT: next_page}
+    if not restaurant_type or set(args) - {'restaurant_type', ep.FIELDS}:
+        limit = int(args.get(ep.LIMIT, dbc.DEFAULT_PAGE_SIZE))
+        min_rating = args.get(ep.MIN_RATING)
+        if min_rating is not None:
+            min_rating = float(min_rating)
+        found, next_after = await restaurants.query_restaurants_async(
+            **{fld: args.get(fld) for fld in ep.QUERY_FILTERS},
+            min_rating=min_rating,
+            sort=args.get(ep.SORT, restaurants.SORT_RATING),
+            limit=limit, after=args.get(ep.AFTER), fields=fields)
+        return {ep.TYPE: ep.DATA, ep.TITLE: 'Restaurants', ep.DATA: found,
+                ep.NEXT: next_after}
+    # just a type: the full list, as before paging was added
+    try:
+        found = await restaurants.get_restaurants_type_async(
+            restaurant_type, fields)
+    except ValueError as e:
+        raise wz.NotAcceptable(f'{str(e)}')
+    return {ep.TYPE: ep.DATA,
+            ep.TITLE: 'Restaurants of that {restaurant_type}',
+            ep.DATA: found}
+
+
+async def get_reviews(args: dict):
+    fields = ep.fields_arg(rvws.FIELDS, args)
+    if ep.wants_stream(args):
+        return Stream(rvws.iter_reviews_async(fields=fields))
+    page = ep.page_args(args)
+    ret = {ep.TYPE: ep.DATA, ep.TITLE: 'All reviews',
+           ep.MENU: ep.REVIEWS_MENU_NM, ep.RETURN: ep.MAIN_MENU_EP}
+    if page:
+        ret[ep.DATA], ret[ep.NEXT] = await rvws.get_reviews_page_async(
+            *page, fields=fields)
+    else:
+        ret[ep.DATA] = await rvws.get_reviews_async(fields)
+    return ret
+
+
+ROUTES = {
+    ep.RESTAURANTS_EP: get_restaurants,
+    ep.RESTAURANTS_SEARCH_EP: search_restaurants,
+    ep.REVIEWS_EP: get_reviews,
+}
+
+
+async def send_json(send, status: int, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': JSON_HEADERS})
+    await send({'type': 'http.response.body',
+                'body': fast_json.dumps(body).encode()})
+
+
+async def send_stream(send, docs):
+    """
+    `endpoints.stream_json_array()`: only one chunk of output is held in
+    memory at once. Without a content-length, the server sends it with
+    chunked transfer encoding.
+    """
+    await send({'type': 'http.response.start', 'status': HTTPStatus.OK,
+                'headers': JSON_HEADERS})
+    buf = ['[']
+    size = 1
+    sep = ''
+    async for doc in docs:
+        encoded = sep + fast_json.dumps(doc)
+        sep = ','
+        buf.append(encoded)
+        size += len(encoded)
+        if size >= ep.STREAM_CHUNK_SIZE:
+            await send({'type': 'http.response.body',
+                        'body': ''.join(buf).encode(), 'more_body': True})
+            buf = []
+            size = 0
+    buf.append(']')
+    await send({'type': 'http.response.body', 'body': ''.join(buf).encode()})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                # indexes and the cache invalidation listener:
+                await asyncio.to_thread(dbc.connect_db,
+                                        ensure_indexes=True)
+                adbc.connect_db()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed',
+                            'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await adbc.close_db()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    handler = ROUTES.get(scope['path'].rstrip('/') or '/')
+    if handler is None:
+        await send_json(send, HTTPStatus.NOT_FOUND,
+                        {MESSAGE: f'No such endpoint: {scope["path"]}'})
+        return
+    if scope['method'] not in ('GET', 'HEAD'):
+        await send_json(send, HTTPStatus.METHOD_NOT_ALLOWED,
+                        {MESSAGE: f'{scope["method"]} is served by the '
+                                  f'Flask app.'})
+        return
+    # each request runs in its own task, with its own copy of the context:
+    headers = dict(scope.get('headers', []))
+    log.request_id.set(ep.new_request_id(
+        headers.get(ep.REQUEST_ID_HEADER.lower().encode(), b'')
+        .decode('latin-1')))
+    # like request.args.get(), the first value of a repeated parameter:
+    args = {}
+    for key, value in parse_qsl(scope['query_string'].decode('latin-1'),
+                                keep_blank_values=True):
+        args.setdefault(key, value)
+    try:
+        result = await handler(args)
+    except wz.HTTPException as e:
+        await send_json(send, e.code, {MESSAGE: e.description})
+        return
+    except ValueError as e:
+        await send_json(send, HTTPStatus.BAD_REQUEST, {MESSAGE: str(e)})
+        return
+    if isinstance(result, Stream):
+        await send_stream(send, result.docs)
+    else:
+        await send_json(send, HTTPStatus.OK, result)
@@ -0,0 +1,55 @@
+"""
+Response compression for the app: brotli when it is installed and the
+client accepts it, gzip otherwise. Responses smaller than
+COMPRESS_MIN_SIZE bytes aren't worth the CPU and go out as they are.
+"""
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+BROTLI = 'br'
+GZIP = 'gzip'
+
+
+def choose_encoding(accept_encodings) -> str:
+    """
+    Returns the best encoding the client accepts, or None.
+    `accept_encodings` is the request's parsed Accept-Encoding header.
+    """
+    if brotli is not None and accept_encodings[BROTLI]:
+        return BROTLI
+    if accept_encodings[GZIP]:
+        return GZIP
+    return None
+
+
+def compress_response(response, accept_encodings):
+    """
+    Compress response in place if it is big enough and the client
+    accepts an encoding we can produce.
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not 200 <= response.status_code < 300):
+        return response
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+    encoding = choose_encoding(accept_encodings)
+    if encoding == BROTLI:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    elif encoding == GZIP:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -3,22 +3,43 @@ This is the file containing all of the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
 from http import HTTPStatus
+import hashlib
+import logging
+import os
+import time
+import uuid
 
-from flask import Flask, jsonify, request
+from flask import (Flask, g, jsonify, request, Response,
+                   stream_with_context)
 from flask_restx import Resource, Api, fields
 from flask_cors import CORS
 
 import werkzeug.exceptions as wz
 import sys
 
+import data.autocomplete as ac
+import data.db_connect as dbc
+import data.geo as geo
+import data.invalidation as inv
+import data.loader as loader
+import data.log as log
+import data.metrics as metrics
+import data.profiler as prof
 import data.restaurants as restaurants
 import data.users as usrs
 import data.reviews as rvws
 import forms.restaurant_form as rst
+import server.compression as compression
+import server.fast_json as fast_json
+
+log.setup()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.json = fast_json.FastJSONProvider(app)
 CORS(app)
 api = Api(app)
+api.representation(fast_json.MIMETYPE)(fast_json.output_json)
 
 DELETE = 'delete'
 MAIN_MENU = 'MainMenu'
@@ -54,6 +75,328 @@ RETURN = 'Return'
 DEL_RESTAURANT_EP = f'{RESTAURANTS_EP}/{DELETE}'
 DEL_USER_EP = f'{USERS_EP}/{DELETE}'
 DEL_REVIEW_EP = f'{REVIEWS_EP}/{DELETE}'
+RESTAURANTS_BULK_EP = f'{RESTAURANTS_EP}/bulk'
+CHUNK_SIZE = 'chunk_size'
+REVIEWS_BULK_EP = f'{REVIEWS_EP}/bulk'
+RESTAURANTS_TOP_EP = f'{RESTAURANTS_EP}/top'
+RESTAURANTS_SEARCH_EP = f'{RESTAURANTS_EP}/search'
+METRICS_EP = '/metrics'
+SLOW_QUERIES_EP = '/debug/slow_queries'
+# serve the /debug endpoints, which show query shapes to anyone asking:
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', '0') == '1'
+# the endpoint label of requests matching no route:
+UNMATCHED = 'unmatched'
+REQUEST_ID_HEADER = 'X-Request-ID'
+MAX_REQUEST_ID_LEN = 128
+RESTAURANTS_AUTOCOMPLETE_EP = f'{RESTAURANTS_EP}/autocomplete'
+RESTAURANTS_NEAR_EP = f'{RESTAURANTS_EP}/near'
+LAT = 'lat'
+LON = 'lon'
+RADIUS = 'radius'
+DEFAULT_RADIUS_MILES = 5
+PREFIX = 'prefix'
+KINDS = 'kinds'
+TOP_N = 'n'
+STREAM = 'stream'
+TRUE_VALUES = ('1', 'true', 'yes')
+# flush streamed output once this many characters have been buffered:
+STREAM_CHUNK_SIZE = 64 * 1024
+LIMIT = 'limit'
+AFTER = 'after'
+NEXT = 'next'
+FIELDS = 'fields'
+SEARCH_TEXT = 'q'
+PAGE = 'page'
+MIN_RATING = 'min_rating'
+SORT = 'sort'
+EXPAND = 'expand'
+RESTAURANT = 'restaurant'
+USER = 'user'
+# what a review list can expand, as (review field, batch function):
+REVIEW_EXPANSIONS = {
+    RESTAURANT: (rvws.RESTAURANT_ID, restaurants.get_restaurants_by_ids),
+    USER: (rvws.USER_ID, usrs.get_users_by_ids),
+}
+# the filters of the structured restaurant search:
+QUERY_FILTERS = ['restaurant_type', 'state', 'city', 'zip_code']
+FIELDS_PARAM_DESCR = 'Comma-separated list of the fields to return'
+# Cache-Control header per resource, overridable through the env.
+# `no-cache` lets clients keep a copy but revalidate it every time,
+# which the ETags make cheap.
+CACHE_CONTROL = {
+    RESTAURANTS_EP: os.environ.get('CACHE_CONTROL_RESTAURANTS', 'no-cache'),
+    RESTAURANTS_SEARCH_EP: os.environ.get('CACHE_CONTROL_SEARCH',
+                                          'no-cache'),
+    RESTAURANTS_TOP_EP: os.environ.get('CACHE_CONTROL_TOP', 'no-cache'),
+    # suggestions can be a little stale, and are asked for per keystroke:
+    RESTAURANTS_AUTOCOMPLETE_EP: os.environ.get('CACHE_CONTROL_AUTOCOMPLETE',
+                                                'max-age=60'),
+    USERS_EP: os.environ.get('CACHE_CONTROL_USERS', 'private, no-cache'),
+    REVIEWS_EP: os.environ.get('CACHE_CONTROL_REVIEWS', 'no-cache'),
+}
+# the collections each resource's GETs read, so an ETag can be made of
+# their versions and the query before anything is fetched; see
+# `version_etag()`:
+VERSIONED = {
+    RESTAURANTS_EP: [restaurants.RESTAURANT_COLLECT],
+    RESTAURANTS_SEARCH_EP: [restaurants.RESTAURANT_COLLECT],
+    RESTAURANTS_TOP_EP: [restaurants.RESTAURANT_COLLECT],
+    REVIEWS_EP: [rvws.REVIEW_COLLECT],
+}
+PAGE_PARAMS = {
+    LIMIT: f'Page size, at most {dbc.MAX_PAGE_SIZE}',
+    AFTER: 'The `next` cursor returned with the previous page',
+}
+
+
+def new_request_id(given: str = None) -> str:
+    """
+    The client's request ID if it sent a sensible one, so its logs and
+    ours can be matched up, or else a fresh one.
+    """
+    if given and len(given) <= MAX_REQUEST_ID_LEN and given.isprintable():
+        return given
+    return uuid.uuid4().hex
+
+
+@app.before_request
+def start_request():
+    g.start_time = time.perf_counter()
+    log.request_id.set(new_request_id(request.headers.get(REQUEST_ID_HEADER)))
+
+
+# after_request hooks run in reverse order: this one runs last, so it
+# times the whole request and counts the bytes actually sent.
+@app.after_request
+def record_metrics(response):
+    start = g.get('start_time')
+    if start is not None:
+        rule = request.url_rule
+        endpoint = rule.rule if rule is not None else UNMATCHED
+        seconds = time.perf_counter() - start
+        metrics.record_request(endpoint, request.method,
+                               response.status_code, seconds,
+                               response.content_length or 0)
+        logger.debug('%s %s %s', request.method, endpoint,
+                     response.status_code,
+                     extra={'seconds': round(seconds, 6)})
+    request_id = log.request_id.get()
+    if request_id:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+# this one runs just before record_metrics, so the ETag below is
+# computed on the uncompressed body.
+@app.after_request
+def compress(response):
+    return compression.compress_response(response, request.accept_encodings)
+
+
+def version_etag() -> str:
+    """
+    An ETag for this GET made of the versions of the collections it
+    reads and of its query, or None if we can't make one: the resource
+    isn't in VERSIONED, or the versions aren't tracked because the
+    invalidation listener is off. The versions are shared by every
+    worker, so the ETag is the same whichever one serves the request.
+    """
+    rule = request.url_rule
+    if rule is None or rule.rule not in VERSIONED or wants_stream():
+        return None
+    versions = [inv.version(collection) for collection in VERSIONED[rule.rule]]
+    if None in versions:
+        return None
+    query = sorted(request.args.items(multi=True))
+    return hashlib.sha1(repr((rule.rule, versions, query)).encode()) \
+        .hexdigest()
+
+
+def set_cache_control(response):
+    if request.url_rule is not None \
+            and request.url_rule.rule in CACHE_CONTROL:
+        response.headers['Cache-Control'] = \
+            CACHE_CONTROL[request.url_rule.rule]
+
+
+@app.before_request
+def answer_not_modified():
+    """
+    Answer 304 Not Modified before fetching or encoding anything, when
+    the client already has the version of the data its ETag names.
+    """
+    if request.method != 'GET':
+        return None
+    etag = version_etag()
+    if etag is None:
+        return None
+    g.etag = etag
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=HTTPStatus.NOT_MODIFIED)
+    response.set_etag(etag, weak=True)
+    set_cache_control(response)
+    return response
+
+
+@app.after_request
+def make_conditional(response):
+    """
+    Give every successful GET an ETag, and answer 304 Not Modified,
+    with no body, when the client's If-None-Match says it already has
+    that version.
+    The ETag comes from `version_etag()` when there is one. Otherwise
+    it is hashed from the body, which keeps it the same whichever
+    worker serves the request, but only saves sending the body. The
+    ETag is weak since the compressed and uncompressed bodies share it.
+    """
+    if (request.method != 'GET' or response.status_code != HTTPStatus.OK
+            or response.is_streamed):
+        return response
+    set_cache_control(response)
+    if g.get('etag'):
+        response.set_etag(g.etag, weak=True)
+    else:
+        response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+
+def wants_stream(args=None) -> bool:
+    """
+    True if the client asked for a streamed (chunked) list response.
+    The helpers taking args default to the request's query parameters;
+    the ASGI app passes its own.
+    """
+    args = request.args if args is None else args
+    return args.get(STREAM, '').lower() in TRUE_VALUES
+
+
+def page_args(args=None):
+    """
+    Returns the (limit, after) paging parameters of the request, or None
+    if the client did not ask for a page.
+    """
+    args = request.args if args is None else args
+    if LIMIT not in args and AFTER not in args:
+        return None
+    try:
+        limit = int(args.get(LIMIT, dbc.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise wz.BadRequest(f'{LIMIT} must be an integer.')
+    if not 1 <= limit <= dbc.MAX_PAGE_SIZE:
+        raise wz.BadRequest(f'{LIMIT} must be between 1 '
+                            f'and {dbc.MAX_PAGE_SIZE}.')
+    return limit, args.get(AFTER)
+
+
+def fields_arg(allowed: list, args=None) -> list:
+    """
+    Returns the list of fields the client asked for in `fields=`,
+    or None for all fields. Fields not in `allowed` are a bad request.
+    """
+    args = request.args if args is None else args
+    fields = [fld.strip() for fld in args.get(FIELDS, '').split(',')
+              if fld.strip()]
+    bad = [fld for fld in fields if fld not in allowed]
+    if bad:
+        raise wz.BadRequest(f'Unknown {FIELDS}: {", ".join(bad)}. '
+                            f'Choose from: {", ".join(allowed)}.')
+    return fields or None
+
+
+def ndjson_rows(stream):
+    """
+    Lazily parse a newline-delimited JSON body, one line at a time, so
+    the body is never buffered whole. Lines that aren't valid JSON come
+    out as None, for the data layer to report as invalid rows.
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield fast_json.loads(line)
+        except ValueError:
+            yield None
+
+
+def stream_json_array(docs) -> Response:
+    """
+    Encode an iterable of docs as a JSON array, one doc at a time,
+    and send it as a chunked response. Only one chunk of output is
+    held in memory at once, whatever the size of the listing.
+    """
+    def generate():
+        buf = ['[']
+        size = 1
+        sep = ''
+        for doc in docs:
+            encoded = sep + fast_json.dumps(doc)
+            sep = ','
+            buf.append(encoded)
+            size += len(encoded)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']')
+        yield ''.join(buf)
+
+    return Response(stream_with_context(generate()),
+                    mimetype=fast_json.MIMETYPE)
+
+
+def get_loader(name: str) -> loader.BatchLoader:
+    """
+    This request's loader for name, one of REVIEW_EXPANSIONS. Lookups
+    through it are batched and cached for the rest of the request.
+    """
+    if 'loaders' not in g:
+        g.loaders = {}
+    if name not in g.loaders:
+        g.loaders[name] = loader.BatchLoader(REVIEW_EXPANSIONS[name][1])
+    return g.loaders[name]
+
+
+def expand_reviews(reviews: list):
+    """
+    Attach the docs asked for in `expand=` to each review, with one
+    batched query per kind of doc rather than one per review.
+    """
+    names = [name.strip() for name in request.args.get(EXPAND, '')
+             .split(',') if name.strip()]
+    bad = [name for name in names if name not in REVIEW_EXPANSIONS]
+    if bad:
+        raise wz.BadRequest(f'Unknown {EXPAND}: {", ".join(bad)}. '
+                            f'Choose from: {", ".join(REVIEW_EXPANSIONS)}.')
+    for name in names:
+        id_field = REVIEW_EXPANSIONS[name][0]
+        get_loader(name).want(review[id_field] for review in reviews
+                              if id_field in review)
+    for name in names:
+        id_field = REVIEW_EXPANSIONS[name][0]
+        for review in reviews:
+            if id_field in review:
+                review[name] = get_loader(name).load(review[id_field])
+
+
+def reviews_page(get_page, owner_id: str, title: str) -> dict:
+    """
+    One page of the reviews of a restaurant or user, newest first.
+    """
+    fields = fields_arg(rvws.FIELDS)
+    limit, after = page_args() or (dbc.DEFAULT_PAGE_SIZE, None)
+    try:
+        reviews, next_after = get_page(owner_id, limit, after, fields)
+    except ValueError as e:
+        raise wz.BadRequest(f'{str(e)}')
+    expand_reviews(reviews)
+    return {
+        TYPE: DATA,
+        TITLE: title,
+        DATA: reviews,
+        NEXT: next_after,
+    }
 
 
 @api.route('/endpoints')
@@ -70,6 +413,53 @@ class Endpoints(Resource):
         return {"Available endpoints": endpoints}
 
 
+@api.route(METRICS_EP)
+class Metrics(Resource):
+    """
+    Latency, document and payload metrics for Prometheus to scrape.
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    def get(self):
+        """
+        Get the metrics of every worker, in the Prometheus text format.
+        """
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+class SlowQueries(Resource):
+    """
+    The slowest query shapes this worker has sent, for index tuning.
+    Only routed when DEBUG_ENDPOINTS is set.
+    """
+    @api.doc(params={
+        TOP_N: f'How many shapes to return, at most {prof.MAX_TOP_N}',
+        SORT: f'One of {", ".join(prof.SORTS)}; {prof.TOTAL_MS} by '
+              f'default',
+    })
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self):
+        """
+        Get the query shapes that took the most time, with the plans of
+        those slower than SLOW_QUERY_MS.
+        """
+        try:
+            queries = dbc.top_queries(
+                int(request.args.get(TOP_N, prof.DEFAULT_TOP_N)),
+                request.args.get(SORT, prof.TOTAL_MS))
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        return {
+            TYPE: DATA,
+            TITLE: 'Slowest queries',
+            DATA: queries,
+        }
+
+
+if DEBUG_ENDPOINTS:
+    api.add_resource(SlowQueries, SLOW_QUERIES_EP)
+
+
 @api.route(f'/{MAIN_MENU_EP}')
 # @api.route('/')
 class MainMenu(Resource):
@@ -128,14 +518,35 @@ users_fields = api.model('NewUser', {
 
 @api.route(f'{USERS_EP}')
 class Users(Resource):
+    @api.doc(params={STREAM: 'Stream the users as a chunked JSON array',
+                     FIELDS: FIELDS_PARAM_DESCR,
+                     **PAGE_PARAMS})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
     def get(self):
         """
         Get list of all users
         """
+        fields = fields_arg(usrs.PUBLIC_FIELDS)
+        if wants_stream():
+            return stream_json_array(usrs.iter_users(fields=fields))
+        page = page_args()
+        if page:
+            try:
+                users_page, next_after = usrs.get_users_page(*page,
+                                                             fields=fields)
+            except ValueError as e:
+                raise wz.BadRequest(f'{str(e)}')
+            return {
+                TYPE: DATA,
+                TITLE: 'Current Users',
+                DATA: users_page,
+                NEXT: next_after,
+            }
         return {
             TYPE: DATA,
             TITLE: 'Current Users',
-            DATA: usrs.get_users(),
+            DATA: usrs.get_users(fields),
         }
 
     @api.expect(users_fields)
@@ -161,6 +572,23 @@ class Users(Resource):
             raise wz.NotAcceptable(f'{str(e)}')
 
 
+@api.route(f'{USERS_EP}/<user_id>/{REVIEWS}')
+class UserReviews(Resource):
+    @api.doc(params={'user_id': 'The ID of the user',
+                     FIELDS: FIELDS_PARAM_DESCR,
+                     EXPAND: f'Comma-separated docs to include with each '
+                             f'review: {", ".join(REVIEW_EXPANSIONS)}',
+                     **PAGE_PARAMS})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self, user_id):
+        """
+        Get a user's reviews, newest first.
+        """
+        return reviews_page(rvws.get_user_reviews, user_id,
+                            f'Reviews by user {user_id}')
+
+
 @api.route(f'{DEL_USER_EP}/<user_id>')
 class DelUser(Resource):
     @api.response(HTTPStatus.OK, 'Success')
@@ -182,18 +610,19 @@ class DelUser(Resource):
 @api.route(f'{USERS_EP}/<user_id>/<new_email>')
 class UpdateEmail(Resource):
     @api.response(HTTPStatus.OK, 'Success')
-    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'Not Acceptable')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @api.response(HTTPStatus.CONFLICT, 'Email Already Used')
     def put(self, user_id, new_email):
         """
         Update the email of a user.
         """
         try:
-            if not usrs.update_email(user_id, new_email):
-                raise wz.NotFound(f'User with ID'
-                                  f'{user_id} not found')
-            return {'Updated email with User ID': f'{user_id}'}
+            updated = usrs.update_email(user_id, new_email)
         except ValueError as e:
-            raise wz.NotFound(f'{str(e)}')
+            raise wz.Conflict(f'{str(e)}')
+        if not updated:
+            raise wz.NotFound(f'User with ID {user_id} not found')
+        return {'Updated email with User ID': f'{user_id}'}
 
 
 # Restaurants
@@ -210,6 +639,29 @@ restaurant_fields = api.model('NewRestaurant', {
 
 @api.route(f'{RESTAURANTS_EP}/<restaurant_id>')
 class UpdateRestaurant(Resource):
+    @api.doc(params={'restaurant_id': 'The unique ID of the restaurant',
+                     FIELDS: FIELDS_PARAM_DESCR})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    def get(self, restaurant_id):
+        """
+        Get a restaurant, with its average rating, by its unique ID.
+        """
+        fields = fields_arg(restaurants.FIELDS)
+        try:
+            restaurant = restaurants.get_restaurant_by_id(restaurant_id,
+                                                          fields)
+        except ValueError as e:
+            raise wz.NotFound(f'{str(e)}')
+        if restaurant is None:
+            raise wz.NotFound(f'Restaurant with ID '
+                              f'{restaurant_id} not found')
+        return {
+            TYPE: DATA,
+            TITLE: 'Restaurant',
+            DATA: restaurant,
+        }
+
     @api.doc(params={'restaurant_id': 'The unique ID of the restaurant'})
     @api.expect(restaurant_fields)
     @api.response(HTTPStatus.OK, 'Success')
@@ -229,26 +681,94 @@ class UpdateRestaurant(Resource):
             raise wz.BadRequest(f'{str(e)}')
 
 
-@api.route(f'{RESTAURANTS_EP}/search')
+@api.route(f'{RESTAURANTS_EP}/<restaurant_id>/{REVIEWS}')
+class RestaurantReviews(Resource):
+    @api.doc(params={'restaurant_id': 'The unique ID of the restaurant',
+                     FIELDS: FIELDS_PARAM_DESCR,
+                     EXPAND: f'Comma-separated docs to include with each '
+                             f'review: {", ".join(REVIEW_EXPANSIONS)}',
+                     **PAGE_PARAMS})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self, restaurant_id):
+        """
+        Get a restaurant's reviews, newest first.
+        """
+        return reviews_page(rvws.get_restaurant_reviews, restaurant_id,
+                            f'Reviews of restaurant {restaurant_id}')
+
+
+@api.route(f'{RESTAURANTS_SEARCH_EP}')
 class RestaurantSearch(Resource):
     @api.doc(params={
-        'restaurant_type': 'A type to filter the restaurants by'
+        SEARCH_TEXT: 'Words to look for in restaurant names and '
+                     'descriptions',
+        'restaurant_type': 'A type to filter the restaurants by',
+        'state': f'Without {SEARCH_TEXT}: a state to filter by',
+        'city': f'Without {SEARCH_TEXT}: a city to filter by',
+        'zip_code': f'Without {SEARCH_TEXT}: a zip code to filter by',
+        MIN_RATING: f'Without {SEARCH_TEXT}: the lowest average rating',
+        SORT: f'Without {SEARCH_TEXT}: one of '
+              f'{", ".join(restaurants.SORTS)}',
+        PAGE: f'With {SEARCH_TEXT}: the page of results, from 1',
+        LIMIT: f'Page size, at most {dbc.MAX_PAGE_SIZE}',
+        AFTER: f'Without {SEARCH_TEXT}: the `next` cursor returned with '
+               f'the previous page',
+        FIELDS: FIELDS_PARAM_DESCR,
     })
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
     def get(self):
         """
-        Get a list of all restaurants filtered by type.
+        Search restaurants by text, most relevant first, or by any
+        combination of type, state, city, zip code and minimum rating,
+        a page at a time.
         """
-        restaurant_type = str(request.args.get('restaurant_type'))
+        text = request.args.get(SEARCH_TEXT)
+        restaurant_type = request.args.get('restaurant_type')
+        fields = fields_arg(restaurants.FIELDS)
 
-        if not restaurant_type:
-            raise HTTPStatus.BAD_REQUEST('A restaurant type '
-                                         'parameter is required')
+        if text is not None:
+            try:
+                page = int(request.args.get(PAGE, 1))
+                limit = int(request.args.get(LIMIT, dbc.DEFAULT_PAGE_SIZE))
+                found, next_page = restaurants.search_restaurants(
+                    text, restaurant_type, page, limit, fields)
+            except ValueError as e:
+                raise wz.BadRequest(f'{str(e)}')
+            return {
+                TYPE: DATA,
+                TITLE: f'Restaurants matching {text}',
+                DATA: found,
+                NEXT: next_page,
+            }
 
+        if not restaurant_type or set(request.args) - {'restaurant_type',
+                                                       FIELDS}:
+            try:
+                limit = int(request.args.get(LIMIT, dbc.DEFAULT_PAGE_SIZE))
+                min_rating = request.args.get(MIN_RATING)
+                if min_rating is not None:
+                    min_rating = float(min_rating)
+                found, next_after = restaurants.query_restaurants(
+                    **{fld: request.args.get(fld) for fld in QUERY_FILTERS},
+                    min_rating=min_rating,
+                    sort=request.args.get(SORT, restaurants.SORT_RATING),
+                    limit=limit, after=request.args.get(AFTER),
+                    fields=fields)
+            except ValueError as e:
+                raise wz.BadRequest(f'{str(e)}')
+            return {
+                TYPE: DATA,
+                TITLE: 'Restaurants',
+                DATA: found,
+                NEXT: next_after,
+            }
+
+        # just a type: the full list, as before paging was added
         try:
             restaurants_list = restaurants.get_restaurants_type(
-                restaurant_type
+                restaurant_type, fields
                 )
             return {
                 TYPE: DATA,
@@ -259,6 +779,106 @@ class RestaurantSearch(Resource):
             raise wz.NotAcceptable(f'{str(e)}')
 
 
+@api.route(f'{RESTAURANTS_TOP_EP}')
+class TopRestaurants(Resource):
+    @api.doc(params={
+        'state': 'A state to rank the restaurants of',
+        'restaurant_type': 'A type to rank the restaurants of',
+        TOP_N: f'How many restaurants to return, at most '
+               f'{restaurants.MAX_TOP_N}',
+        FIELDS: FIELDS_PARAM_DESCR,
+    })
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self):
+        """
+        Get the best-rated restaurants, best first, ranked by a
+        Bayesian average so a few reviews can't dominate.
+        """
+        state = request.args.get('state')
+        restaurant_type = request.args.get('restaurant_type')
+        fields = fields_arg(restaurants.FIELDS)
+        try:
+            n = int(request.args.get(TOP_N, restaurants.DEFAULT_TOP_N))
+            top = restaurants.get_top_restaurants(n, state, restaurant_type,
+                                                  fields)
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        return {
+            TYPE: DATA,
+            TITLE: f'Top {n} restaurants',
+            DATA: top,
+        }
+
+
+@api.route(f'{RESTAURANTS_AUTOCOMPLETE_EP}')
+class RestaurantAutocomplete(Resource):
+    @api.doc(params={
+        PREFIX: 'What the user has typed so far',
+        LIMIT: f'How many suggestions to return, at most {ac.MAX_LIMIT}',
+        KINDS: f'Comma-separated kinds of suggestion to return, from: '
+               f'{", ".join(restaurants.AUTOCOMPLETE_FIELDS)}',
+    })
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self):
+        """
+        Suggest restaurant names and cities starting with a prefix,
+        for type-ahead.
+        """
+        kinds = [kind.strip() for kind in request.args.get(KINDS, '')
+                 .split(',') if kind.strip()]
+        try:
+            limit = int(request.args.get(LIMIT, ac.DEFAULT_LIMIT))
+            suggestions = restaurants.autocomplete(
+                request.args.get(PREFIX, ''), limit, kinds or None)
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        return {
+            TYPE: DATA,
+            TITLE: 'Suggestions',
+            DATA: suggestions,
+        }
+
+
+@api.route(f'{RESTAURANTS_NEAR_EP}')
+class RestaurantsNear(Resource):
+    @api.doc(params={
+        LAT: 'Latitude of the point to search around',
+        LON: 'Longitude of the point to search around',
+        RADIUS: f'Search radius in miles, at most {geo.MAX_RADIUS_MILES} '
+                f'(default {DEFAULT_RADIUS_MILES})',
+        LIMIT: f'How many restaurants to return, at most '
+               f'{dbc.MAX_PAGE_SIZE}',
+        'restaurant_type': 'A type to filter the restaurants by',
+        FIELDS: FIELDS_PARAM_DESCR,
+    })
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def get(self):
+        """
+        Get the restaurants near a point, nearest first.
+        """
+        fields = fields_arg(restaurants.FIELDS)
+        try:
+            lat = float(request.args[LAT])
+            lon = float(request.args[LON])
+            radius = float(request.args.get(RADIUS, DEFAULT_RADIUS_MILES))
+            limit = int(request.args.get(LIMIT, dbc.DEFAULT_PAGE_SIZE))
+            found = restaurants.get_restaurants_near(
+                lat, lon, radius, limit,
+                request.args.get('restaurant_type'), fields)
+        except KeyError:
+            raise wz.BadRequest(f'{LAT} and {LON} are required.')
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        return {
+            TYPE: DATA,
+            TITLE: f'Restaurants within {radius} miles',
+            DATA: found,
+        }
+
+
 @api.route(f'{DEL_RESTAURANT_EP}/<restaurant_id>')
 class DelRestaurant(Resource):
     @api.response(HTTPStatus.OK, 'Success')
@@ -300,15 +920,43 @@ class Restaurants(Resource):
     This class supports various operations on restaurants, such as
     listing them, adding a restaurant, and deleting a restaurant
     """
+    @api.doc(params={
+        'state': 'A state to filter the restaurants by',
+        STREAM: 'Stream the restaurants as a chunked JSON array',
+        FIELDS: FIELDS_PARAM_DESCR,
+        **PAGE_PARAMS,
+    })
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
     def get(self):
         """
         Get a list of all restaurants.
         """
         # Get the state from the query parameters
         state = request.args.get('state')
+        fields = fields_arg(restaurants.FIELDS)
+        if wants_stream():
+            return stream_json_array(
+                restaurants.iter_restaurants(state, fields=fields))
+        page = page_args()
+        if page:
+            try:
+                restaurants_page, next_after = \
+                    restaurants.get_restaurants_page(*page, state=state,
+                                                     fields=fields)
+            except ValueError as e:
+                raise wz.BadRequest(f'{str(e)}')
+            return {
+                TYPE: DATA,
+                TITLE: f'Restaurants in {state}' if state
+                else 'Current Restaurants',
+                DATA: restaurants_page,
+                NEXT: next_after,
+            }
         if state:
             # If state is provided in query, filter restaurants by the state
-            filtered_restaurants = restaurants.get_restaurants_by_state(state)
+            filtered_restaurants = restaurants.get_restaurants_by_state(
+                state, fields)
             return {
                 TYPE: DATA,
                 TITLE: f'Restaurants in {state}',
@@ -316,7 +964,7 @@ class Restaurants(Resource):
             }
         else:
             # If no state is provided, return all restaurants
-            all_restaurants = restaurants.get_restaurants()
+            all_restaurants = restaurants.get_restaurants(fields)
             return {
                 TYPE: DATA,
                 TITLE: 'Current Restaurants',
@@ -350,6 +998,38 @@ class Restaurants(Resource):
             raise wz.NotAcceptable(f'{str(e)}')
 
 
+@api.route(f'{RESTAURANTS_BULK_EP}')
+class RestaurantsBulk(Resource):
+    """
+    Adds many restaurants at once, for onboarding a whole city.
+    """
+    @api.doc(params={CHUNK_SIZE: 'Rows to insert per database round-trip'})
+    @api.expect([restaurant_fields])
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def post(self):
+        """
+        Add a list of restaurants. Returns a result for each row.
+        """
+        rows = request.json
+        if not isinstance(rows, list):
+            raise wz.BadRequest('Expected a list of restaurants.')
+        try:
+            chunk_size = int(request.args.get(CHUNK_SIZE,
+                                              restaurants.BULK_CHUNK_SIZE))
+            results = restaurants.add_restaurants_bulk(rows, chunk_size)
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        inserted = sum(1 for res in results
+                       if res[restaurants.BULK_STATUS]
+                       == restaurants.BULK_INSERTED)
+        return {
+            TYPE: DATA,
+            TITLE: f'Added {inserted} of {len(results)} restaurants',
+            DATA: results,
+        }
+
+
 review_fields = api.model('NewReview', {
     rvws.USER_ID: fields.String,
     rvws.RESTAURANT_ID: fields.String,
@@ -360,14 +1040,37 @@ review_fields = api.model('NewReview', {
 
 @api.route(f'{REVIEWS_EP}')
 class Reviews(Resource):
+    @api.doc(params={STREAM: 'Stream the reviews as a chunked JSON array',
+                     FIELDS: FIELDS_PARAM_DESCR,
+                     **PAGE_PARAMS})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
     def get(self):
         """
         Get list of all reviews
         """
+        fields = fields_arg(rvws.FIELDS)
+        if wants_stream():
+            return stream_json_array(rvws.iter_reviews(fields=fields))
+        page = page_args()
+        if page:
+            try:
+                reviews_page, next_after = rvws.get_reviews_page(*page,
+                                                                 fields=fields)
+            except ValueError as e:
+                raise wz.BadRequest(f'{str(e)}')
+            return {
+                TYPE: DATA,
+                TITLE: 'All reviews',
+                DATA: reviews_page,
+                NEXT: next_after,
+                MENU: REVIEWS_MENU_NM,
+                RETURN: MAIN_MENU_EP,
+            }
         return {
             TYPE: DATA,
             TITLE: 'All reviews',
-            DATA: rvws.get_reviews(),
+            DATA: rvws.get_reviews(fields),
             MENU: REVIEWS_MENU_NM,
             RETURN: MAIN_MENU_EP,
         }
@@ -395,6 +1098,34 @@ class Reviews(Resource):
             raise wz.NotAcceptable(f'{str(e)}')
 
 
+@api.route(f'{REVIEWS_BULK_EP}')
+class ReviewsBulk(Resource):
+    """
+    Imports reviews in bulk, e.g. when migrating review history.
+    """
+    @api.doc(params={CHUNK_SIZE: 'Reviews to write per database round-trip'},
+             description='The body is newline-delimited JSON (NDJSON): '
+                         'one review object per line.')
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid Parameters')
+    def post(self):
+        """
+        Add or overwrite reviews, keyed by user and restaurant.
+        """
+        try:
+            chunk_size = int(request.args.get(CHUNK_SIZE,
+                                              rvws.BULK_CHUNK_SIZE))
+            summary = rvws.upsert_reviews_bulk(ndjson_rows(request.stream),
+                                               chunk_size)
+        except ValueError as e:
+            raise wz.BadRequest(f'{str(e)}')
+        return {
+            TYPE: DATA,
+            TITLE: f'Imported {summary[rvws.BULK_RECEIVED]} reviews',
+            DATA: summary,
+        }
+
+
 @api.route(f'{REVIEWS_EP}/<user_id>/<restaurant_id>/<review>/<rating>')
 class UpdateReview(Resource):
     """
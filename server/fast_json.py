@@ -0,0 +1,64 @@
+"""
+Fast JSON encoding for the app: orjson when it is installed, the
+standard library otherwise. Either way, ObjectIds encode as their hex
+strings and datetimes in ISO 8601, so the data layer can hand back
+Mongo documents as they come.
+"""
+import datetime
+import json
+
+from bson import ObjectId
+from flask import make_response
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MIMETYPE = 'application/json'
+
+
+def default(obj):
+    """
+    Encode the types JSON doesn't know about.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(obj) -> str:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(obj) -> str:
+        return json.dumps(obj, default=default, separators=(',', ':'))
+
+    loads = json.loads
+
+
+class FastJSONProvider(JSONProvider):
+    """
+    Flask's JSON provider, for `jsonify()` and `request.json`.
+    """
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+
+def output_json(data, code, headers=None):
+    """
+    flask-restx representation for JSON, used for every Resource.
+    """
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = MIMETYPE
+    return resp
@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import server.asgi as asgi
+import server.endpoints as ep
+import data.restaurants as rst
+
+from http.client import (
+    BAD_REQUEST,
+    METHOD_NOT_ALLOWED,
+    NOT_FOUND,
+    OK,
+)
+from unittest.mock import patch
+
+
+def call(path, query='', method='GET'):
+    """
+    Drive the ASGI app through one request; returns the status and the
+    decoded JSON body, with the number of body messages it came in.
+    """
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode()}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    status = sent[0]['status']
+    body = b''.join(msg['body'] for msg in sent[1:])
+    return status, json.loads(body), len(sent) - 1
+
+
+@patch('data.restaurants.get_restaurants_async',
+       return_value={'Pizza Place': {rst.NAME: 'Pizza Place'}})
+def test_list_restaurants(mock_get):
+    rst.RESTAURANT_CACHE.clear()
+    status, body, _ = call(ep.RESTAURANTS_EP)
+    assert status == OK
+    assert body[ep.DATA] == {'Pizza Place': {rst.NAME: 'Pizza Place'}}
+    mock_get.assert_awaited_once_with(None)
+
+
+@patch('data.restaurants.get_restaurants_page_async',
+       return_value=([{rst.NAME: 'A'}], 'cursor'))
+def test_list_restaurants_page(mock_page):
+    status, body, _ = call(ep.RESTAURANTS_EP, 'limit=1&state=NY')
+    assert status == OK
+    assert body[ep.NEXT] == 'cursor'
+    mock_page.assert_awaited_once_with(1, None, state='NY', fields=None)
+
+
+def test_list_restaurants_bad_limit():
+    status, body, _ = call(ep.RESTAURANTS_EP, 'limit=0')
+    assert status == BAD_REQUEST
+    assert ep.LIMIT in body[asgi.MESSAGE]
+
+
+def test_list_restaurants_bad_fields():
+    status, _, _ = call(ep.RESTAURANTS_EP, 'fields=nope')
+    assert status == BAD_REQUEST
+
+
+def test_stream_restaurants():
+    docs = [{rst.NAME: f'Restaurant {i}', 'description': 'x' * 1000}
+            for i in range(200)]
+
+    async def iter_docs(state, fields=None):
+        for doc in docs:
+            yield doc
+
+    with patch('data.restaurants.iter_restaurants_async', iter_docs):
+        status, body, messages = call(ep.RESTAURANTS_EP, 'stream=1')
+    assert status == OK
+    assert body == docs
+    assert messages > 1
+
+
+@patch('data.restaurants.search_restaurants_async',
+       return_value=([{rst.NAME: 'Pizza Place'}], 2))
+def test_search_text(mock_search):
+    status, body, _ = call(ep.RESTAURANTS_SEARCH_EP, 'q=pizza&limit=1')
+    assert status == OK
+    assert body[ep.NEXT] == 2
+    mock_search.assert_awaited_once_with('pizza', None, 1, 1, None)
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.async_db_connect.connect_db', autospec=True)
+def test_search_bad_sort(mock_async_connect, mock_connect):
+    rst.RESTAURANT_CACHE.clear()
+    status, body, _ = call(ep.RESTAURANTS_SEARCH_EP, 'sort=nope')
+    assert status == BAD_REQUEST
+    assert 'sort' in body[asgi.MESSAGE]
+
+
+@patch('data.reviews.get_reviews_async', return_value={})
+def test_list_reviews(mock_get):
+    status, body, _ = call(ep.REVIEWS_EP)
+    assert status == OK
+    assert body[ep.TITLE] == 'All reviews'
+
+
+def test_unknown_route():
+    status, _, _ = call('/nope')
+    assert status == NOT_FOUND
+
+
+def test_wrong_method():
+    status, _, _ = call(ep.REVIEWS_EP, method='POST')
+    assert status == METHOD_NOT_ALLOWED
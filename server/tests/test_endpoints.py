@@ -1,14 +1,25 @@
+import gzip
+
 import server.endpoints as ep
 import data.restaurants as rst
 from data.restaurants import TEST_RESTAURANT_FLDS
 import data.db_connect as dbc
+import data.indexes as idx
+import data.reviews as rvws
+import data.users as usrs
 import pytest
+from types import SimpleNamespace
+from bson import ObjectId
+from flask import Flask
+from flask_restx import Api
 
 from http.client import (
     BAD_REQUEST,
+    CONFLICT,
     FORBIDDEN,
     NOT_ACCEPTABLE,
     NOT_FOUND,
+    NOT_MODIFIED,
     OK,
     SERVICE_UNAVAILABLE,
 )
@@ -22,3 +33,495 @@ def test_list_users():
     resp = TEST_CLIENT.get(ep.USERS_EP)
     resp_json = resp.get_json()
     assert isinstance(resp_json, dict)
+
+
+STREAMED_DOCS = [{rst.NAME: f'Restaurant {i}'} for i in range(3)]
+
+
+@patch('data.restaurants.iter_restaurants',
+       return_value=iter(STREAMED_DOCS), autospec=True)
+def test_list_restaurants_streamed(mock_iter):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}?{ep.STREAM}=1')
+    assert resp.status_code == OK
+    assert resp.is_streamed
+    assert resp.get_json() == STREAMED_DOCS
+
+
+@patch('data.users.iter_users', return_value=iter([]), autospec=True)
+def test_list_users_streamed_empty(mock_iter):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}?{ep.STREAM}=true')
+    assert resp.status_code == OK
+    assert resp.get_json() == []
+
+
+def test_stream_json_array_chunks():
+    docs = [{'n': i} for i in range(ep.STREAM_CHUNK_SIZE // 4)]
+    with ep.app.test_request_context():
+        resp = ep.stream_json_array(iter(docs))
+        chunks = list(resp.response)
+    assert len(chunks) > 1
+    assert ep.fast_json.loads(''.join(chunks)) == docs
+
+
+PAGE = ([{rst.NAME: 'Test Name', dbc.MONGO_ID: rst.MOCK_ID}], rst.MOCK_ID)
+
+
+@patch('data.restaurants.get_restaurants_page', return_value=PAGE,
+       autospec=True)
+def test_list_restaurants_page(mock_page):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}?{ep.LIMIT}=1'
+                           f'&{ep.AFTER}={rst.MOCK_ID}&state=NY')
+    assert resp.status_code == OK
+    resp_json = resp.get_json()
+    assert resp_json[ep.DATA] == PAGE[0]
+    assert resp_json[ep.NEXT] == rst.MOCK_ID
+    mock_page.assert_called_once_with(1, rst.MOCK_ID, state='NY',
+                                      fields=None)
+
+
+@pytest.mark.parametrize('limit', ['0', 'ten', str(dbc.MAX_PAGE_SIZE + 1)])
+def test_list_restaurants_bad_limit(limit):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}?{ep.LIMIT}={limit}')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.reviews.get_reviews_page', side_effect=ValueError(),
+       autospec=True)
+def test_list_reviews_bad_cursor(mock_page):
+    resp = TEST_CLIENT.get(f'{ep.REVIEWS_EP}?{ep.AFTER}=not-an-id')
+    assert resp.status_code == BAD_REQUEST
+
+
+NOTHING_DELETED = SimpleNamespace(deleted_count=0)
+NOTHING_MATCHED = SimpleNamespace(matched_count=0)
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.del_one', return_value=NOTHING_DELETED,
+       autospec=True)
+def test_del_restaurant_missing(mock_del, mock_connect):
+    resp = TEST_CLIENT.delete(f'{ep.DEL_RESTAURANT_EP}/{rst.MOCK_ID}')
+    assert resp.status_code == NOT_FOUND
+    mock_del.assert_called_once()
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+def test_del_user_bad_id(mock_connect):
+    resp = TEST_CLIENT.delete(f'{ep.DEL_USER_EP}/not-an-id')
+    assert resp.status_code == NOT_FOUND
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.find_and_update', return_value=None,
+       autospec=True)
+def test_update_review_missing(mock_update, mock_connect):
+    resp = TEST_CLIENT.put(f'{ep.REVIEWS_EP}/1/2/Great/5')
+    assert resp.status_code == NOT_FOUND
+    mock_update.assert_called_once()
+
+
+def test_restaurant_id_exists_bad_id():
+    assert not rst.id_exists('not-an-id')
+
+
+@patch('data.restaurants.get_restaurants_type', return_value=[],
+       autospec=True)
+def test_search_restaurants_fields(mock_type):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/search?restaurant_type=Thai'
+                           f'&{ep.FIELDS}={rst.NAME},{rst.CITY}')
+    assert resp.status_code == OK
+    mock_type.assert_called_once_with('Thai', [rst.NAME, rst.CITY])
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_text_search', autospec=True,
+       return_value=[{rst.NAME: 'Pho 1', rst.SEARCH_SCORE: 1.5}] * 3)
+def test_search_restaurants_text(mock_search, mock_connect):
+    rst.RESTAURANT_CACHE.clear()
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/search?{ep.SEARCH_TEXT}=pho'
+                           f'&{ep.PAGE}=2&{ep.LIMIT}=2')
+    assert resp.status_code == OK
+    assert len(resp.json[ep.DATA]) == 2
+    assert resp.json[ep.NEXT] == 3
+    kwargs = mock_search.call_args.kwargs
+    assert (kwargs['skip'], kwargs['limit']) == (2, 3)
+
+
+@pytest.mark.parametrize('query', [f'{ep.SEARCH_TEXT}=',
+                                   f'{ep.SEARCH_TEXT}=pho&{ep.PAGE}=0',
+                                   f'{ep.SEARCH_TEXT}=pho&{ep.LIMIT}=x',
+                                   f'{ep.SORT}=cheapest',
+                                   f'{ep.MIN_RATING}=high',
+                                   f'{ep.MIN_RATING}=6',
+                                   f'{ep.AFTER}=not-a-cursor'])
+@patch('data.db_connect.connect_db', autospec=True)
+def test_search_restaurants_bad_params(mock_connect, query):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/search?{query}')
+    assert resp.status_code == BAD_REQUEST
+
+
+def test_list_users_bad_fields():
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}?{ep.FIELDS}=password')
+    assert resp.status_code == BAD_REQUEST
+
+
+def test_make_projection():
+    assert dbc.make_projection(None, rst.FIELDS) is None
+    assert dbc.make_projection([rst.NAME], rst.FIELDS) == [rst.NAME]
+    with pytest.raises(ValueError):
+        dbc.make_projection(['password'], rst.FIELDS)
+
+
+BULK_ROWS = [
+    {fld: f'{fld} 1' for fld in rst.NEW_FIELDS},
+    {fld: f'{fld} 1' for fld in rst.NEW_FIELDS},
+    {rst.NAME: 'No address'},
+    {fld: f'{fld} 2' for fld in rst.NEW_FIELDS},
+    {fld: f'{fld} 3' for fld in rst.NEW_FIELDS},
+]
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+def test_restaurants_bulk(mock_connect):
+    chunks = []
+
+    def fake_insert_many(collection, docs):
+        chunks.append(len(docs))
+        for n, doc in enumerate(docs):
+            doc[dbc.MONGO_ID] = f'{len(chunks)}-{n}'
+        # the last new restaurant is already in the db:
+        return {0: {'code': dbc.DUPLICATE_KEY_CODE}} if len(chunks) == 2 \
+            else {}
+
+    with patch('data.db_connect.insert_many', side_effect=fake_insert_many):
+        resp = TEST_CLIENT.post(f'{ep.RESTAURANTS_BULK_EP}?{ep.CHUNK_SIZE}=2',
+                                json=BULK_ROWS)
+    assert resp.status_code == OK
+    statuses = [res[rst.BULK_STATUS] for res in resp.get_json()[ep.DATA]]
+    assert statuses == [rst.BULK_INSERTED, rst.BULK_DUPLICATE,
+                        rst.BULK_INVALID, rst.BULK_INSERTED,
+                        rst.BULK_DUPLICATE]
+    assert chunks == [2, 1]
+
+
+def test_restaurants_bulk_not_a_list():
+    resp = TEST_CLIENT.post(ep.RESTAURANTS_BULK_EP, json={rst.NAME: 'x'})
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.reviews.repair_rating_aggregates', autospec=True)
+def test_reviews_bulk_ndjson(mock_repair, mock_connect):
+    good = rvws.get_test_review()
+    good[rvws.RATING] = 4
+    body = '\n'.join([ep.fast_json.dumps(good), 'not json', '',
+                      ep.fast_json.dumps({rvws.USER_ID: '1'}),
+                      ep.fast_json.dumps(good)])
+    counts = {dbc.UPSERTED: 1, dbc.MODIFIED: 0, dbc.MATCHED: 0}
+    with patch('data.db_connect.upsert_many',
+               return_value=(counts, {}), autospec=True) as mock_upsert:
+        resp = TEST_CLIENT.post(f'{ep.REVIEWS_BULK_EP}?{ep.CHUNK_SIZE}=1',
+                                data=body,
+                                content_type='application/x-ndjson')
+    assert resp.status_code == OK
+    summary = resp.get_json()[ep.DATA]
+    assert summary[rvws.BULK_RECEIVED] == 4
+    assert summary[rvws.BULK_UPSERTED] == 2
+    assert [bad[rvws.BULK_INDEX] for bad in summary[rvws.BULK_INVALID]] \
+        == [1, 2]
+    assert mock_upsert.call_count == 2
+    mock_repair.assert_called_with({good[rvws.RESTAURANT_ID]})
+
+
+@patch('data.reviews.get_reviews', return_value={'Great': {}}, autospec=True)
+def test_reviews_not_modified(mock_get):
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP)
+    assert resp.status_code == OK
+    etag = resp.headers['ETag']
+    assert resp.headers['Cache-Control'] == ep.CACHE_CONTROL[ep.REVIEWS_EP]
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP, headers={'If-None-Match': etag})
+    assert resp.status_code == NOT_MODIFIED
+    assert resp.data == b''
+
+
+@patch('data.reviews.get_reviews', autospec=True)
+def test_reviews_modified(mock_get):
+    mock_get.return_value = {'Great': {}}
+    etag = TEST_CLIENT.get(ep.REVIEWS_EP).headers['ETag']
+    mock_get.return_value = {'Awful': {}}
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP, headers={'If-None-Match': etag})
+    assert resp.status_code == OK
+    assert resp.headers['ETag'] != etag
+
+
+BIG_REVIEWS = {f'Review {i}': {dbc.MONGO_ID: ObjectId(rst.MOCK_ID)}
+               for i in range(100)}
+
+
+@patch('data.reviews.get_reviews', return_value=BIG_REVIEWS, autospec=True)
+def test_reviews_gzipped(mock_get):
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP,
+                           headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == OK
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    body = ep.fast_json.loads(gzip.decompress(resp.data))
+    assert body[ep.DATA]['Review 0'][dbc.MONGO_ID] == rst.MOCK_ID
+
+
+@patch('data.reviews.get_reviews', return_value={}, autospec=True)
+def test_small_response_not_compressed(mock_get):
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP,
+                           headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_one', autospec=True,
+       return_value={rst.NAME: 'Pho 1', rst.RATING_SUM: 7,
+                     rst.RATING_COUNT: 2})
+def test_get_restaurant(mock_fetch, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/{rst.MOCK_ID}')
+    assert resp.status_code == OK
+    assert resp.json[ep.DATA][rst.AVG_RATING] == 3.5
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_one', return_value=None, autospec=True)
+def test_get_restaurant_missing(mock_fetch, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/{rst.MOCK_ID}')
+    assert resp.status_code == NOT_FOUND
+
+
+def test_get_restaurant_bad_id():
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/not-an-id')
+    assert resp.status_code == NOT_FOUND
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_sorted', autospec=True,
+       return_value=[{rst.NAME: 'Pho 1', rst.RATING_SUM: 9,
+                      rst.RATING_COUNT: 2}])
+def test_top_restaurants(mock_fetch, mock_connect):
+    rst.RESTAURANT_CACHE.clear()
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_TOP_EP}?state=NY'
+                           f'&restaurant_type=Thai&{ep.TOP_N}=5')
+    assert resp.status_code == OK
+    assert resp.json[ep.DATA][0][rst.AVG_RATING] == 4.5
+    args, kwargs = mock_fetch.call_args
+    assert args[1] == {rst.STATE: 'NY', rst.RESTAURANT_TYPE: 'Thai'}
+    assert kwargs['sort'] == [(rst.RATING_SCORE, idx.DESCENDING)]
+    assert kwargs['limit'] == 5
+
+
+@pytest.mark.parametrize('n', ['0', 'ten', str(rst.MAX_TOP_N + 1)])
+def test_top_restaurants_bad_n(n):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_TOP_EP}?{ep.TOP_N}={n}')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.restaurants.build_autocomplete', autospec=True)
+def test_autocomplete(mock_build):
+    rst.AUTOCOMPLETE.build([('1', {rst.NAME: 'Pho 1', rst.CITY: 'Phoenix'})])
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_AUTOCOMPLETE_EP}'
+                           f'?{ep.PREFIX}=ph&{ep.KINDS}={rst.CITY}')
+    assert resp.status_code == OK
+    assert [s['text'] for s in resp.json[ep.DATA]] == ['Phoenix']
+    mock_build.assert_not_called()
+
+
+@pytest.mark.parametrize('query', [f'{ep.PREFIX}=', f'{ep.PREFIX}=a&'
+                                   f'{ep.KINDS}=state',
+                                   f'{ep.PREFIX}=a&{ep.LIMIT}=0'])
+def test_autocomplete_bad_params(query):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_AUTOCOMPLETE_EP}?{query}')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.aggregate', autospec=True,
+       return_value=[{rst.NAME: 'Pho 1', rst.DISTANCE_MILES: 0.5}])
+def test_restaurants_near(mock_aggregate, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_NEAR_EP}?{ep.LAT}=40.73'
+                           f'&{ep.LON}=-74&{ep.RADIUS}=2'
+                           f'&{ep.FIELDS}={rst.NAME}')
+    assert resp.status_code == OK
+    assert resp.json[ep.DATA][0][rst.DISTANCE_MILES] == 0.5
+    near, limit, project = mock_aggregate.call_args.args[1]
+    assert near['$geoNear']['near']['coordinates'] == [-74, 40.73]
+    assert near['$geoNear']['maxDistance'] == 2 * ep.geo.METERS_PER_MILE
+    assert project['$project'] == {rst.NAME: 1, rst.DISTANCE_MILES: 1}
+
+
+@pytest.mark.parametrize('query', [f'{ep.LAT}=40', f'{ep.LAT}=x&{ep.LON}=1',
+                                   f'{ep.LAT}=95&{ep.LON}=1',
+                                   f'{ep.LAT}=40&{ep.LON}=1&{ep.RADIUS}=0'])
+def test_restaurants_near_bad_params(query):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_NEAR_EP}?{query}')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_keyset_page', autospec=True,
+       return_value=([{rst.NAME: 'Pho 1'}], 'next-cursor'))
+def test_search_restaurants_combined(mock_page, mock_connect):
+    rst.RESTAURANT_CACHE.clear()
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/search?state=NY&city=Troy'
+                           f'&restaurant_type=Thai&{ep.MIN_RATING}=4'
+                           f'&{ep.SORT}={rst.SORT_NAME}&{ep.LIMIT}=5')
+    assert resp.status_code == OK
+    assert resp.json[ep.NEXT] == 'next-cursor'
+    args = mock_page.call_args.args
+    assert args[1] == {rst.STATE: 'NY', rst.CITY: 'Troy',
+                       rst.RESTAURANT_TYPE: 'Thai',
+                       rst.AVG_RATING: {'$gte': 4.0}}
+    assert args[2:5] == (rst.NAME, idx.ASCENDING, 5)
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_keyset_page', autospec=True,
+       return_value=([{rvws.RATING: 5}], None))
+def test_restaurant_reviews(mock_page, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.RESTAURANTS_EP}/{rst.MOCK_ID}/{ep.REVIEWS}'
+                           f'?{ep.LIMIT}=10')
+    assert resp.status_code == OK
+    assert resp.json[ep.DATA] == [{rvws.RATING: 5}]
+    args = mock_page.call_args.args
+    assert args[1] == {rvws.RESTAURANT_ID: rst.MOCK_ID}
+    assert args[2:5] == (dbc.MONGO_ID, idx.DESCENDING, 10)
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_keyset_page', autospec=True,
+       return_value=([], None))
+def test_user_reviews(mock_page, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}/42/{ep.REVIEWS}')
+    assert resp.status_code == OK
+    assert mock_page.call_args.args[1] == {rvws.USER_ID: '42'}
+    assert mock_page.call_args.args[4] == dbc.DEFAULT_PAGE_SIZE
+
+
+def test_user_reviews_bad_limit():
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}/42/{ep.REVIEWS}?{ep.LIMIT}=0')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_keyset_page', autospec=True,
+       return_value=([{rvws.RESTAURANT_ID: 'r1'}, {rvws.RESTAURANT_ID: 'r2'},
+                      {rvws.RESTAURANT_ID: 'r1'}], None))
+@patch('data.db_connect.fetch_by_ids', autospec=True,
+       side_effect=lambda collection, ids, **kwargs: [{rst.NAME: i}
+                                                      for i in ids])
+def test_user_reviews_expanded(mock_by_ids, mock_page, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}/42/{ep.REVIEWS}'
+                           f'?{ep.EXPAND}={ep.RESTAURANT}')
+    assert resp.status_code == OK
+    names = [review[ep.RESTAURANT][rst.NAME] for review in resp.json[ep.DATA]]
+    assert names == ['r1', 'r2', 'r1']
+    # one query for all the reviews' restaurants:
+    mock_by_ids.assert_called_once()
+    assert mock_by_ids.call_args.args[1] == ['r1', 'r2']
+
+
+@patch('data.db_connect.connect_db', autospec=True)
+@patch('data.db_connect.fetch_keyset_page', autospec=True,
+       return_value=([], None))
+def test_reviews_bad_expand(mock_page, mock_connect):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}/42/{ep.REVIEWS}?{ep.EXPAND}=x')
+    assert resp.status_code == BAD_REQUEST
+
+
+def test_metrics():
+    TEST_CLIENT.get('/endpoints')
+    resp = TEST_CLIENT.get(ep.METRICS_EP)
+    assert resp.status_code == OK
+    assert resp.content_type.startswith('text/plain')
+    assert ('app_http_duration_seconds_count{endpoint="/endpoints",'
+            'method="GET",status="200"}') in resp.get_data(as_text=True)
+
+
+def test_request_id():
+    resp = TEST_CLIENT.get('/endpoints', headers={ep.REQUEST_ID_HEADER: 'r1'})
+    assert resp.headers[ep.REQUEST_ID_HEADER] == 'r1'
+    resp = TEST_CLIENT.get('/endpoints')
+    assert len(resp.headers[ep.REQUEST_ID_HEADER]) == 32
+
+
+@pytest.fixture
+def debug_client():
+    """
+    A client of an app with the debug endpoints routed, as with
+    DEBUG_ENDPOINTS=1.
+    """
+    app = Flask(__name__)
+    Api(app).add_resource(ep.SlowQueries, ep.SLOW_QUERIES_EP)
+    return app.test_client()
+
+
+def test_slow_queries_off_by_default():
+    assert not ep.DEBUG_ENDPOINTS
+    resp = TEST_CLIENT.get(ep.SLOW_QUERIES_EP)
+    assert resp.status_code == NOT_FOUND
+
+
+def test_slow_queries(debug_client):
+    resp = debug_client.get(ep.SLOW_QUERIES_EP)
+    assert resp.status_code == OK
+    assert isinstance(resp.get_json()[ep.DATA], list)
+
+
+@pytest.mark.parametrize('query', ['n=0', 'n=x', 'sort=nope'])
+def test_slow_queries_bad_params(debug_client, query):
+    resp = debug_client.get(f'{ep.SLOW_QUERIES_EP}?{query}')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('data.invalidation.version', return_value=3, autospec=True)
+@patch('data.reviews.get_reviews', return_value={'Great': {}}, autospec=True)
+def test_reviews_not_modified_before_fetch(mock_get, mock_version):
+    etag = TEST_CLIENT.get(ep.REVIEWS_EP).headers['ETag']
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP, headers={'If-None-Match': etag})
+    assert resp.status_code == NOT_MODIFIED
+    assert resp.headers['Cache-Control'] == ep.CACHE_CONTROL[ep.REVIEWS_EP]
+    # answered from the version alone:
+    mock_get.assert_called_once()
+    # another query, or a write, is another version:
+    resp = TEST_CLIENT.get(f'{ep.REVIEWS_EP}?{ep.FIELDS}={rvws.RATING}',
+                           headers={'If-None-Match': etag})
+    assert resp.status_code == OK
+    mock_version.return_value = 4
+    resp = TEST_CLIENT.get(ep.REVIEWS_EP, headers={'If-None-Match': etag})
+    assert resp.status_code == OK
+
+
+@patch('data.users.update_email', return_value=True, autospec=True)
+def test_update_email(mock_update):
+    resp = TEST_CLIENT.put(f'{ep.USERS_EP}/{usrs.MOCK_ID}/new@example.com')
+    assert resp.status_code == OK
+
+
+@patch('data.users.update_email', return_value=False, autospec=True)
+def test_update_email_no_user(mock_update):
+    resp = TEST_CLIENT.put(f'{ep.USERS_EP}/{usrs.MOCK_ID}/new@example.com')
+    assert resp.status_code == NOT_FOUND
+
+
+@patch('data.users.update_email', autospec=True,
+       side_effect=ValueError('A user with this email already exists.'))
+def test_update_email_duplicate(mock_update):
+    resp = TEST_CLIENT.put(f'{ep.USERS_EP}/{usrs.MOCK_ID}/taken@example.com')
+    assert resp.status_code == CONFLICT
+
+
+@patch('data.restaurants.exists', autospec=True)
+@patch('data.db_connect.insert_one', autospec=True,
+       side_effect=dbc.DuplicateKeyError('dup'))
+@patch('data.db_connect.connect_db', autospec=True)
+def test_add_restaurant_duplicate(mock_connect, mock_insert, mock_exists):
+    resp = TEST_CLIENT.post(ep.RESTAURANTS_EP, json={
+        rst.NAME: 'Pho 1', rst.RESTAURANT_TYPE: 'Vietnamese',
+        rst.DESCRIPTION: 'Noodles', rst.ADDRESS: '1 Main St',
+        rst.CITY: 'Boston', rst.STATE: 'MA', rst.ZIP_CODE: '02101'})
+    assert resp.status_code == NOT_ACCEPTABLE
+    mock_insert.assert_called_once()
+    mock_exists.assert_not_called()
@@ -0,0 +1,22 @@
+import datetime
+
+import pytest
+from bson import ObjectId
+
+import server.fast_json as fast_json
+
+TEST_ID = '0' * 24
+
+
+def test_dumps_mongo_types():
+    doc = {'_id': ObjectId(TEST_ID),
+           'when': datetime.datetime(2024, 1, 2, 3, 4, 5)}
+    assert fast_json.loads(fast_json.dumps(doc)) == {
+        '_id': TEST_ID,
+        'when': '2024-01-02T03:04:05',
+    }
+
+
+def test_dumps_unknown_type():
+    with pytest.raises(TypeError):
+        fast_json.dumps({'x': object()})